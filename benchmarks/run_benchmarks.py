@@ -0,0 +1,217 @@
+"""
+Benchmarks for the extraction and training hot paths on synthetic data.
+
+Builds DETER polygons, raw band GeoTIFFs and a small PRODES raster in a temporary directory,
+times every stage and writes the results to a JSON file that can be compared across commits:
+
+    python benchmarks/run_benchmarks.py --output benchmarks/results/my_branch.json
+"""
+# Std.Lib.
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# Data Science
+import numpy as np
+import geopandas as gpd
+import rasterio
+from rasterio.transform import from_bounds
+from shapely.geometry import box
+
+PROJECT_PATH = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_PATH))
+sys.path.insert(0, str(PROJECT_PATH/'deep_deter'/'deep_model'))  # deep_model uses bare imports
+
+# Area covered by the synthetic data, in EPSG:4326
+AREA = (-60.0, -10.0, -59.0, -9.0)
+# Half the side of the box pulled around every alert, same as get_rectangle_around_polygon
+DELTA = 0.14
+PRODES_CLASSES = np.array([0, 7, 8, 9, 10, 15, 20, 22, 32, 50, 55, 61, 91, 101], dtype=np.uint8)
+
+
+def time_it(fn, repeat):
+    """
+    Runs fn repeat times, returns timing statistics in seconds
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return {
+        'n': repeat,
+        'min_s': min(timings),
+        'median_s': statistics.median(timings),
+        'mean_s': statistics.mean(timings),
+    }
+
+
+def build_synthetic_data(root: Path, n_alerts: int, n_scenes: int, scene_size: int, prodes_size: int, rng):
+    """
+    Writes ./data/external (PRODES), ./data/raw (bands) and the empty processed directories under root.
+    :return: The synthetic DETER GeoDataFrame and the ids that have raw bands
+    """
+    for directory in ('data/external', 'data/raw', 'data/processed/masked_feature_bands',
+                      'data/processed/labels', 'data/images/features', 'data/images/labels'):
+        os.makedirs(root/directory, exist_ok=True)
+
+    # PRODES
+    prodes = rng.choice(PRODES_CLASSES, size=(prodes_size, prodes_size))
+    with rasterio.open(
+            root/'data/external/PDigital2000_2022_AMZ_raster.tif', 'w',
+            driver='GTiff', height=prodes_size, width=prodes_size, count=1, dtype='uint8',
+            crs='EPSG:4326', transform=from_bounds(*AREA, prodes_size, prodes_size),
+            tiled=True, compress='deflate',
+    ) as dst:
+        dst.write(prodes, 1)
+
+    # DETER alerts, small boxes away from the border so the pulled rectangles stay inside AREA
+    centers_x = rng.uniform(AREA[0] + DELTA, AREA[2] - DELTA, n_alerts)
+    centers_y = rng.uniform(AREA[1] + DELTA, AREA[3] - DELTA, n_alerts)
+    sizes = rng.uniform(0.002, 0.02, n_alerts)
+    dates = np.datetime64('2016-01-01') + rng.integers(0, 365 * 7, n_alerts)
+    gdf = gpd.GeoDataFrame(
+        {
+            'FID': [f'{i}_curr' for i in range(n_alerts)],
+            'VIEW_DATE': [str(date) for date in dates],
+        },
+        geometry=[box(x - s, y - s, x + s, y + s) for x, y, s in zip(centers_x, centers_y, sizes)],
+        crs='EPSG:4326',
+    )
+
+    # Raw bands of the first n_scenes alerts
+    scene_ids = list(gdf['FID'].values[:n_scenes])
+    for polygon_id, x, y in zip(scene_ids, centers_x, centers_y):
+        transform = from_bounds(x - DELTA, y - DELTA, x + DELTA, y + DELTA, scene_size, scene_size)
+        for band in ('blue', 'green', 'red', 'nir'):
+            with rasterio.open(
+                    root/'data/raw'/f'{polygon_id}_{band}_band.tif', 'w',
+                    driver='GTiff', height=scene_size, width=scene_size, count=1, dtype='float32',
+                    crs='EPSG:4326', transform=transform,
+            ) as dst:
+                dst.write(rng.random((scene_size, scene_size), dtype=np.float32) * 0.3, 1)
+
+    return gdf, scene_ids
+
+
+def bench_extraction(results: dict, gdf, scene_ids, scene_size: int, repeat: int) -> None:
+    from deep_deter.data_extraction.alert_index import AlertIndex
+    from deep_deter.data_extraction.mask_feature_bands import MaskFeatureBands
+    from deep_deter.data_extraction.mask_label import PRODES_FILE, MaskLabel
+    from deep_deter.data_extraction.mask_sentinel_img import GetCorrectProdesMask
+    from deep_deter.data_extraction.train_test_split import assign_files_to_datasets, build_split_manifest
+
+    alert_index = AlertIndex(gdf)
+    mask_feature_bands = MaskFeatureBands(gdf, './data/raw/', alert_index=alert_index)
+    mask_label = MaskLabel(gdf, alert_index=alert_index)
+
+    results['process_raw_raster_files'] = time_it(
+        lambda: [mask_feature_bands.process_raw_raster_files(polygon_id) for polygon_id in scene_ids], repeat,
+    )
+    results['write_label_to_disk'] = time_it(
+        lambda: [mask_label.write_label_to_disk(polygon_id) for polygon_id in scene_ids], repeat,
+    )
+
+    limits = tuple(gdf.geometry.values[0].centroid.buffer(DELTA).bounds)
+    prodes_mask = GetCorrectProdesMask(PRODES_FILE, limits, '2020-09-01')
+    results['get_mask'] = time_it(lambda: prodes_mask.get_mask((scene_size, scene_size)), repeat * 10)
+
+    results['build_split_manifest'] = time_it(lambda: build_split_manifest('./data', 80), repeat)
+
+    # assign_files_to_datasets moves the processed files, so it runs once, last
+    results['assign_files_to_datasets'] = time_it(lambda: assign_files_to_datasets('./data', 80), 1)
+    for split in ('train', 'test'):
+        for kind in ('features', 'labels'):
+            for file in Path(f'./data/model_inputs/{split}_{kind}').glob('*.tif'):
+                destination = 'masked_feature_bands' if kind == 'features' else 'labels'
+                shutil.move(str(file), f'./data/processed/{destination}/{file.name}')
+
+
+def bench_training(results: dict, repeat: int, resolutions) -> None:
+    try:
+        import torch
+    except ImportError:
+        print('torch is not installed, skipping training benchmarks...')
+        return
+    from dataset import DeterDataset
+    from model import UNET
+
+    dataset = DeterDataset('./data/processed/masked_feature_bands', './data/processed/labels')
+    results['deter_dataset_getitem'] = time_it(lambda: [dataset[i] for i in range(len(dataset))], repeat)
+    results['deter_dataset_getitem']['samples'] = len(dataset)
+    results['deter_dataset_getitem']['samples_per_s'] = len(dataset) / results['deter_dataset_getitem']['median_s']
+
+    torch.manual_seed(0)
+    model = UNET(in_channels=4, out_channels=1)
+    loss_fn = torch.nn.BCEWithLogitsLoss()
+    for resolution in resolutions:
+        x = torch.rand((2, 4, resolution, resolution))
+        y = (torch.rand((2, 1, resolution, resolution)) > 0.5).float()
+
+        def forward_backward():
+            model.zero_grad()
+            loss_fn(model(x), y).backward()
+
+        results[f'unet_forward_backward_{resolution}'] = time_it(forward_backward, repeat)
+
+
+def get_git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=PROJECT_PATH, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default=str(PROJECT_PATH/'benchmarks'/'results'/'latest.json'))
+    parser.add_argument('--n-alerts', type=int, default=5000)
+    parser.add_argument('--n-scenes', type=int, default=8)
+    parser.add_argument('--scene-size', type=int, default=1024)
+    parser.add_argument('--prodes-size', type=int, default=4096)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--resolutions', type=int, nargs='+', default=[128, 256, 512])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    results = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # The pipeline uses paths relative to the project root
+        os.chdir(tmp_dir)
+        try:
+            gdf, scene_ids = build_synthetic_data(
+                Path(tmp_dir), args.n_alerts, args.n_scenes, args.scene_size, args.prodes_size, rng,
+            )
+            bench_extraction(results, gdf, scene_ids, args.scene_size, args.repeat)
+            bench_training(results, args.repeat, args.resolutions)
+        finally:
+            os.chdir(cwd)
+
+    report = {
+        'commit': get_git_commit(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'params': vars(args),
+        'results': results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for name, result in results.items():
+        print(f"{name:>32}: median {result['median_s'] * 1000:10.1f} ms over {result['n']} runs")
+    print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
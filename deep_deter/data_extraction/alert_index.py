@@ -0,0 +1,70 @@
+# Std.Lib.
+from typing import Dict, Tuple, Union
+
+# Data Science
+import numpy as np
+import geopandas.geodataframe
+from shapely import STRtree, box
+
+
+class AlertIndex:
+    """
+    Lookup structures over the DETER alerts GeoDataFrame.
+    Finding an alert by FID is a dictionary lookup and bounding box queries go through
+    an STRtree, instead of scanning the whole table for every polygon.
+    The GeoDataFrame is expected to not change after the index is built.
+    """
+    gdf: geopandas.geodataframe.GeoDataFrame
+    fid_to_position: Dict[str, int]
+
+    def __init__(self, gdf: geopandas.geodataframe.GeoDataFrame):
+        """
+        :param gdf: The gdf from the Deter dataset
+        """
+        self.gdf = gdf
+
+        # Keep the first occurrence, as the previous `gdf[gdf['FID'] == id]...values[0]` did
+        self.fid_to_position = {}
+        for position, fid in enumerate(gdf['FID'].values):
+            self.fid_to_position.setdefault(fid, position)
+
+        self._view_dates = gdf['VIEW_DATE'].values
+        self._tree = None  # Built on the first spatial query, most stages only need the FID lookup
+
+    def __contains__(self, fid: str) -> bool:
+        return fid in self.fid_to_position
+
+    def __len__(self) -> int:
+        return len(self.fid_to_position)
+
+    @property
+    def tree(self) -> STRtree:
+        if self._tree is None:
+            self._tree = STRtree(self.gdf.geometry.values)
+        return self._tree
+
+    def get(self, fid: str) -> geopandas.geodataframe.GeoDataFrame:
+        """
+        Same result as gdf[gdf['FID'] == fid] for unique FIDs, without the full scan.
+        :param fid: The FID of the DETER alert
+        :return: A GeoDataFrame with a single row
+        """
+        return self.gdf.iloc[[self.fid_to_position[fid]]]
+
+    def get_view_date(self, fid: str) -> str:
+        return self._view_dates[self.fid_to_position[fid]]
+
+    def query_bbox(self,
+                   bounds: Tuple[float, float, float, float],
+                   max_view_date: Union[str, None] = None,
+                   ) -> geopandas.geodataframe.GeoDataFrame:
+        """
+        Alerts whose bounding box intersects the given bounds, like gdf.cx[left:right, bottom:top].
+        :param bounds: (left, bottom, right, top)
+        :param max_view_date: If given, only alerts with VIEW_DATE <= max_view_date are returned
+        :return: The matching rows, in the same order as in the original GeoDataFrame
+        """
+        positions = np.sort(self.tree.query(box(*bounds)))
+        if max_view_date is not None:
+            positions = positions[self._view_dates[positions] <= max_view_date]
+        return self.gdf.iloc[positions]
@@ -0,0 +1,233 @@
+# Std.Lib.
+import hashlib
+import json
+import math
+import os
+import tempfile
+import threading
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable, List, Sequence, Tuple, Union
+
+# Data Science and Earth Engine
+import ee
+import rasterio
+from rasterio.merge import merge
+
+# Custom functions
+from deep_deter.data_extraction.ee_scheduler import atomic_write
+from deep_deter.data_extraction.ee_session import initialize_ee
+from deep_deter.data_extraction.instrumentation import instrumentation
+from deep_deter.data_extraction.output_profile import get_output_profile
+from deep_deter.data_extraction.utils import get_pixel_degrees, snap_bounds_to_grid
+
+# Environment variables
+# Reads .env file, optionally add:
+# COMPOSITE_CACHE = True to download the missing grid tiles of an alert into the cache (defaults to False,
+# windows are still cropped from tiles that are already cached)
+# COMPOSITE_CACHE_DIR = directory of the cached tiles (defaults to ./data/interim/composites)
+from dotenv import load_dotenv
+load_dotenv()
+COMPOSITE_CACHE = os.getenv('COMPOSITE_CACHE', 'False').lower() == 'true'
+COMPOSITE_CACHE_DIR = Path(os.getenv('COMPOSITE_CACHE_DIR', './data/interim/composites'))
+
+# About a seventh of the box pulled around a single alert (+/- 0.14 degrees). The missing tiles of a box are
+# fetched with one export of their hull, at most 8x8 tiles, so a cold miss costs ~1.3x the box at worst.
+# A whole number of 10 m pixels (~0.04 degrees), so the tile edges fall on the pixel grid of the exports
+COMPOSITE_TILE_PIXELS = 445
+COMPOSITE_TILE_DEGREES = COMPOSITE_TILE_PIXELS * get_pixel_degrees(10)
+
+
+class CompositeCache:
+    """
+    Local cache of Sentinel-2 median composites, stored as tiled GeoTIFFs on a fixed global grid.
+    A tile is content-addressed by (grid tile, date window, cloud percentage, bands, scale), so
+    neighbouring alerts with the same VIEW_DATE share their composites and the box around an alert
+    is cropped from cached tiles instead of being downloaded again.
+    """
+    cache_dir: Path
+    tile_degrees: float
+    tile_pixels: int
+    pixel_degrees: float
+    bands: Tuple[str, ...]
+    scale: int
+    fetch_missing: bool
+    enabled: bool
+
+    def __init__(self,
+                 bands: Sequence[str],
+                 export: Callable[[ee.image.Image, Path, Tuple[float, float, float, float]], None],
+                 cache_dir: Union[str, Path] = COMPOSITE_CACHE_DIR,
+                 tile_degrees: float = COMPOSITE_TILE_DEGREES,
+                 scale: int = 10,
+                 fetch_missing: bool = COMPOSITE_CACHE,
+                 ee_client=None,
+                 ):
+        """
+        :param bands: Sentinel-2 bands of the composites, in the order they are stored
+        :param export: export(image, path, bounds) downloads the image inside bounds to a GeoTIFF through the
+        Earth Engine scheduler, raising RetriesExhaustedError, e.g. SaveToDisk._export_bands
+        :param tile_degrees: Size of the grid tiles, rounded to a whole number of pixels at scale
+        :param scale: Resolution of the exports in meters, part of the key
+        :param fetch_missing: Download the missing tiles of a window, otherwise only serve windows
+        that are fully cached
+        :param ee_client: Same as in FetchSentinelImg, the real Earth Engine session by default
+        """
+        self.bands = tuple(bands)
+        self.export = export
+        self.cache_dir = Path(cache_dir)
+        self.scale = scale
+        # Tiles whose edges fall between two pixels would be shifted by a fraction of a pixel
+        # when cropped, duplicating or dropping a column at the seams of the mosaics
+        self.pixel_degrees = get_pixel_degrees(scale)
+        self.tile_pixels = max(1, round(tile_degrees / self.pixel_degrees))
+        self.tile_degrees = self.tile_pixels * self.pixel_degrees
+        self.fetch_missing = fetch_missing
+        # Without fetching and without cached tiles there is nothing to look up for any alert
+        self.enabled = fetch_missing or (self.cache_dir.is_dir() and any(self.cache_dir.glob('*.tif')))
+        self._ee_client = ee_client
+        # Download threads that need tiles of the same date window wait for the first one
+        # instead of exporting them twice
+        self._window_locks = defaultdict(threading.Lock)
+        self._locks_lock = threading.Lock()
+
+    @property
+    def ee_api(self):
+        return self._ee_client if self._ee_client is not None else initialize_ee()
+
+    def get_tiles(self, bounds: Tuple[float, float, float, float]) -> List[Tuple[int, int]]:
+        """
+        Grid tiles (column, row) that cover (min_x, min_y, max_x, max_y)
+        """
+        min_x, min_y, max_x, max_y = bounds
+        columns = range(math.floor(min_x / self.tile_degrees), math.ceil(max_x / self.tile_degrees))
+        rows = range(math.floor(min_y / self.tile_degrees), math.ceil(max_y / self.tile_degrees))
+        return [(column, row) for column in columns for row in rows]
+
+    def get_tile_bounds(self, tile: Tuple[int, int]) -> Tuple[float, float, float, float]:
+        column, row = tile
+        # From whole pixel counts, so adjacent tiles share exactly the same edge
+        return (column * self.tile_pixels * self.pixel_degrees, row * self.tile_pixels * self.pixel_degrees,
+                (column + 1) * self.tile_pixels * self.pixel_degrees, (row + 1) * self.tile_pixels * self.pixel_degrees)
+
+    def get_tile_path(self, tile: Tuple[int, int], first_date: str, last_date: str, cloud_pct: int) -> Path:
+        key = {
+            'tile': list(tile),
+            'tile_degrees': self.tile_degrees,
+            'first_date': first_date,
+            'last_date': last_date,
+            'cloud_pct': cloud_pct,
+            'bands': list(self.bands),
+            'scale': self.scale,
+        }
+        digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:32]
+        return self.cache_dir/f'{digest}.tif'
+
+    def _fetch_tiles(self,
+                     get_composite: Callable[[ee.geometry.Geometry], ee.image.Image],
+                     tiles: List[Tuple[int, int]],
+                     first_date: str,
+                     last_date: str,
+                     cloud_pct: int,
+                     ) -> None:
+        """
+        Downloads the hull of the tiles with a single export and splits it into tiles
+        """
+        with self._locks_lock:
+            window_lock = self._window_locks[(first_date, last_date, cloud_pct)]
+
+        with window_lock:
+            # Another thread may have fetched some of them in the meantime
+            tiles = [tile for tile in tiles if not self.get_tile_path(tile, first_date, last_date, cloud_pct).exists()]
+            if not tiles:
+                return
+
+            tile_bounds = [self.get_tile_bounds(tile) for tile in tiles]
+            hull = (min(b[0] for b in tile_bounds), min(b[1] for b in tile_bounds),
+                    max(b[2] for b in tile_bounds), max(b[3] for b in tile_bounds))
+            region = self.ee_api.Geometry.Rectangle([(hull[0], hull[1]), (hull[2], hull[3])])
+            image = get_composite(region).select(list(self.bands))
+
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                export_path = Path(tmp_dir)/'hull.tif'
+                self.export(image, export_path, hull)
+
+                # Rewritten as internally tiled GeoTIFFs, so crops only decode the blocks they touch
+                for tile, bounds in zip(tiles, tile_bounds):
+                    tile_path = self.get_tile_path(tile, first_date, last_date, cloud_pct)
+                    with atomic_write(tile_path) as tmp_path:
+                        crop_to_bounds([export_path], bounds, tmp_path, profile_name='cog')
+                    instrumentation.add_bytes_written(tile_path)
+            instrumentation.count('composite_cache.tiles_fetched', len(tiles))
+
+    def export_window(self,
+                      get_composite: Callable[[ee.geometry.Geometry], ee.image.Image],
+                      bounds: Tuple[float, float, float, float],
+                      first_date: str,
+                      last_date: str,
+                      cloud_pct: int,
+                      output_path: Path,
+                      ) -> bool:
+        """
+        Writes the composite inside bounds to output_path, cropped from the cached tiles.
+        :param get_composite: Builds the composite of the date window over a region,
+        e.g. lambda region: fetch_sentinel_img.get_composite(region, first_date, last_date)
+        :param bounds: (min_x, min_y, max_x, max_y) in degrees
+        :return: False if the window could not be served from the cache
+        """
+        if not self.enabled:
+            return False
+
+        tiles = self.get_tiles(bounds)
+        tile_paths = [self.get_tile_path(tile, first_date, last_date, cloud_pct) for tile in tiles]
+        missing = [tile for tile, path in zip(tiles, tile_paths) if not path.exists()]
+
+        if missing and not self.fetch_missing:
+            return False
+        if not missing:
+            instrumentation.count('composite_cache.hits')
+        elif len(missing) < len(tiles):
+            instrumentation.count('composite_cache.partial_hits')
+        else:
+            instrumentation.count('composite_cache.misses')
+
+        if missing:
+            self._fetch_tiles(get_composite, missing, first_date, last_date, cloud_pct)
+
+        crop_to_bounds(tile_paths, bounds, output_path)
+        return True
+
+
+def crop_to_bounds(source_paths: Sequence[Path],
+                   bounds: Tuple[float, float, float, float],
+                   output_path: Path,
+                   profile_name: str = 'plain',
+                   ) -> None:
+    """
+    Mosaics the sources (cached tiles, a shared export...) and writes the part inside bounds
+    to output_path as a multi-band GeoTIFF.
+    The bounds are grown to the pixel grid of the sources, so every output pixel is a source pixel
+    and crops of the same area match whichever sources they come from.
+    :param bounds: (min_x, min_y, max_x, max_y) in the CRS of the sources
+    :param profile_name: One of output_profile.OUTPUT_PROFILES
+    """
+    sources = [rasterio.open(path) for path in source_paths]
+    try:
+        grid = sources[0].transform
+        pixel_x, pixel_y = grid.a, -grid.e
+        bounds = snap_bounds_to_grid(bounds, pixel_x, pixel_y, origin=(grid.c, grid.f))
+        mosaic, transform = merge(sources, bounds=bounds, res=(pixel_x, pixel_y))
+        out_meta = sources[0].meta.copy()
+    finally:
+        for src in sources:
+            src.close()
+
+    out_meta.update(
+        height=mosaic.shape[1],
+        width=mosaic.shape[2],
+        transform=transform,
+    )
+    out_meta.update(get_output_profile(out_meta['dtype'], profile_name=profile_name))
+    with rasterio.open(output_path, 'w', **out_meta) as dest:
+        dest.write(mosaic)
@@ -2,3 +2,15 @@ class NoImagesError(Exception):
     def __init__(self, message='No Images were found with these constraints'):
         self.message = message
         super().__init__(self.message)
+
+
+class ExportFailedError(Exception):
+    def __init__(self, message='Earth Engine did not return the exported image'):
+        self.message = message
+        super().__init__(self.message)
+
+
+class RetriesExhaustedError(Exception):
+    def __init__(self, message='Earth Engine request still failing after all retries'):
+        self.message = message
+        super().__init__(self.message)
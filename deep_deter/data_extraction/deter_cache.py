@@ -0,0 +1,71 @@
+# Std.Lib.
+import json
+import os
+from pathlib import Path
+from typing import Dict, List
+
+# Data Science
+import geopandas as gpd
+
+# Only these columns are used by the pipeline, the rest of the DBF is never loaded from the cache
+DETER_COLUMNS = ['FID', 'VIEW_DATE', 'geometry']
+CACHE_DIR = Path('./data/interim')
+SHAPEFILE_PARTS = ('.shp', '.shx', '.dbf', '.prj')
+
+
+def _get_source_signature(deter_file: Path) -> Dict[str, List[float]]:
+    """
+    Size and mtime of every file that makes up the shapefile.
+    If any of them changes the cache is rebuilt.
+    """
+    signature = {}
+    for suffix in SHAPEFILE_PARTS:
+        part = deter_file.with_suffix(suffix)
+        if part.exists():
+            stat = part.stat()
+            signature[part.name] = [stat.st_size, stat.st_mtime]
+    return signature
+
+
+def load_deter_gdf(deter_file: str,
+                   columns: List[str] = DETER_COLUMNS,
+                   cache_dir: Path = CACHE_DIR,
+                   ) -> gpd.GeoDataFrame:
+    """
+    Loads the DETER alerts from a GeoParquet copy of the shapefile.
+    The copy is (re)built from the shapefile when it is missing or when the shapefile changed.
+    Falls back to reading the shapefile directly if pyarrow is not installed.
+    :param deter_file: Path to the DETER .shp file
+    :param columns: Columns to keep, geometry must be one of them
+    :param cache_dir: Where the GeoParquet copy and its signature are stored
+    :return: The DETER GeoDataFrame with only the requested columns
+    """
+    deter_file = Path(deter_file)
+    cache_file = Path(cache_dir)/f'{deter_file.stem}.parquet'
+    signature_file = cache_file.with_suffix('.json')
+    signature = {'source': _get_source_signature(deter_file), 'columns': sorted(columns)}
+
+    try:
+        import pyarrow  # noqa: F401 (GeoParquet support in geopandas)
+    except ImportError:
+        print('pyarrow is not installed, reading the shapefile without cache...')
+        return gpd.read_file(deter_file)[columns]
+
+    if cache_file.exists() and signature_file.exists():
+        with open(signature_file) as f:
+            if json.load(f) == signature:
+                print(f'Reading cached DETER data from: {cache_file}')
+                return gpd.read_parquet(cache_file, columns=columns)
+
+    print(f'DETER cache is missing or outdated, rebuilding it from: {deter_file}')
+    gdf = gpd.read_file(deter_file)[columns]
+
+    # Write to a temporary file first so an interrupted run never leaves a broken cache behind
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = cache_file.with_suffix('.parquet.tmp')
+    gdf.to_parquet(tmp_file, index=False)
+    os.replace(tmp_file, cache_file)
+    with open(signature_file, 'w') as f:
+        json.dump(signature, f)
+
+    return gdf
@@ -0,0 +1,96 @@
+# Std.Lib.
+import os
+from datetime import datetime
+from typing import Callable, List, Tuple
+
+# Data Science
+import geopandas.geodataframe
+
+# Custom functions
+from deep_deter.data_extraction.utils import get_bounds_around_polygon
+
+# Environment variables
+# Reads .env file, optionally add:
+# DOWNLOAD_CLUSTER_MAX_DEGREES = largest side of the box exported for a group of alerts (defaults to 0.35)
+# DOWNLOAD_CLUSTER_MAX_DAYS = largest VIEW_DATE difference inside a group (defaults to 0, same date only)
+from dotenv import load_dotenv
+load_dotenv()
+DOWNLOAD_CLUSTER_MAX_DEGREES = float(os.getenv('DOWNLOAD_CLUSTER_MAX_DEGREES', 0.35))
+DOWNLOAD_CLUSTER_MAX_DAYS = int(os.getenv('DOWNLOAD_CLUSTER_MAX_DAYS', 0))
+
+
+class DownloadCluster:
+    """
+    DETER alerts served by a single Earth Engine export: the union of their boxes and
+    one composite shared by all of them.
+    The date window ends at the earliest VIEW_DATE of the group, so no alert ever gets
+    images taken after its own VIEW_DATE.
+    """
+    alert_rows: List[int]
+    bounds: Tuple[float, float, float, float]
+    first_date: str
+    last_date: str
+
+    def __init__(self, row: int, bounds: Tuple[float, float, float, float], first_date: str, last_date: str):
+        self.alert_rows = [row]
+        self.bounds = bounds
+        self.first_date = first_date
+        self.last_date = last_date
+
+    def get_union_bounds(self, bounds: Tuple[float, float, float, float]) -> Tuple[float, float, float, float]:
+        return (min(self.bounds[0], bounds[0]), min(self.bounds[1], bounds[1]),
+                max(self.bounds[2], bounds[2]), max(self.bounds[3], bounds[3]))
+
+    def overlaps(self, bounds: Tuple[float, float, float, float]) -> bool:
+        return (bounds[0] < self.bounds[2] and self.bounds[0] < bounds[2]
+                and bounds[1] < self.bounds[3] and self.bounds[1] < bounds[3])
+
+    def add(self, row: int, bounds: Tuple[float, float, float, float], first_date: str, last_date: str) -> None:
+        self.alert_rows.append(row)
+        self.bounds = self.get_union_bounds(bounds)
+        self.first_date = min(self.first_date, first_date)
+        self.last_date = min(self.last_date, last_date)
+
+
+def _get_days_apart(date_a: str, date_b: str) -> int:
+    return abs((datetime.strptime(date_a, '%Y-%m-%d') - datetime.strptime(date_b, '%Y-%m-%d')).days)
+
+
+def plan_download_clusters(deter_alerts: geopandas.geodataframe.GeoDataFrame,
+                           get_date_window: Callable[[geopandas.geodataframe.GeoDataFrame], Tuple[str, str]],
+                           max_extent_degrees: float = DOWNLOAD_CLUSTER_MAX_DEGREES,
+                           max_days_apart: int = DOWNLOAD_CLUSTER_MAX_DAYS,
+                           ) -> List[DownloadCluster]:
+    """
+    Greedily groups alerts whose boxes (get_rectangle_around_polygon) overlap and whose
+    VIEW_DATEs are at most max_days_apart, as long as the union box stays within
+    max_extent_degrees on each side so a single export remains under the API limits.
+    Alerts that cannot be grouped end up in a cluster of their own.
+    :param deter_alerts: Rows of the DETER dataset to download
+    :param get_date_window: (first_date, last_date) of an alert, e.g. FetchSentinelImg.get_date_window
+    :return: Clusters with the positions of their alerts in deter_alerts
+    """
+    alerts = []
+    for row in range(len(deter_alerts)):
+        alert = deter_alerts.iloc[[row]]
+        alerts.append((row, get_bounds_around_polygon(alert), *get_date_window(alert)))
+
+    # Sorted by date then by x, so the candidates of an alert are among the last clusters opened
+    alerts.sort(key=lambda alert: (alert[3], alert[1][0]))
+
+    clusters = []
+    for row, bounds, first_date, last_date in alerts:
+        for cluster in reversed(clusters):
+            if _get_days_apart(cluster.last_date, last_date) > max_days_apart:
+                # Every older cluster is even further apart in time
+                break
+            union = cluster.get_union_bounds(bounds)
+            if (cluster.overlaps(bounds)
+                    and union[2] - union[0] <= max_extent_degrees
+                    and union[3] - union[1] <= max_extent_degrees):
+                cluster.add(row, bounds, first_date, last_date)
+                break
+        else:
+            clusters.append(DownloadCluster(row, bounds, first_date, last_date))
+
+    return clusters
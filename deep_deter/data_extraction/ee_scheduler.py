@@ -0,0 +1,201 @@
+# Std.Lib.
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Union
+
+# Custom functions
+from deep_deter.data_extraction.custom_error import RetriesExhaustedError
+from deep_deter.data_extraction.instrumentation import instrumentation
+
+# Environment variables
+# Reads .env file, optionally add:
+# EE_REQUESTS_PER_SECOND = sustained Earth Engine request rate (defaults to 10)
+# EE_MAX_RETRIES = retries of a throttled or failed request before giving up (defaults to 5)
+from dotenv import load_dotenv
+load_dotenv()
+EE_REQUESTS_PER_SECOND = float(os.getenv('EE_REQUESTS_PER_SECOND', 10))
+EE_MAX_RETRIES = int(os.getenv('EE_MAX_RETRIES', 5))
+
+# Substrings of the errors Earth Engine and its HTTP stack raise when throttling or timing out
+THROTTLING_MESSAGES = ('too many', 'quota', 'rate limit', '429', 'resource exhausted')
+TRANSIENT_MESSAGES = ('timed out', 'timeout', 'deadline', 'internal error', 'internal server error', 'unavailable',
+                      'bad gateway', 'connection')
+
+
+def is_throttling_error(error: Exception) -> bool:
+    # A failed export (ExportFailedError) carries the HTTP status of the download, e.g. 'HTTP 429 Too Many Requests'
+    return any(message in str(error).lower() for message in THROTTLING_MESSAGES)
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """
+    Throttling, timeouts and dropped connections are worth another try, anything else
+    (request over the size limit, bad geometry, missing band...) would fail again.
+    """
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    return is_throttling_error(error) or any(message in str(error).lower() for message in TRANSIENT_MESSAGES)
+
+
+class TokenBucket:
+    """
+    Allows `rate` requests per second on average, with bursts of up to `capacity` requests
+    """
+    def __init__(self, rate: float, capacity: Union[float, None] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        Blocks until a token is available
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveConcurrencyLimit:
+    """
+    AIMD limit on the number of requests in flight: grows by one every `limit` successes
+    (about one per round of requests) and is halved whenever Earth Engine throttles us.
+    """
+    def __init__(self, max_limit: int, min_limit: int = 1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def set_max_limit(self, max_limit: int) -> None:
+        with self._condition:
+            raised = max_limit > self.max_limit
+            self.max_limit = max(max_limit, self.min_limit)
+            # A new pool starts at full concurrency and backs off if throttled, instead of ramping up from 1
+            self.limit = float(self.max_limit) if raised else min(self.limit, self.max_limit)
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self._condition.notify_all()
+
+    def on_success(self) -> None:
+        with self._condition:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def on_throttled(self) -> None:
+        with self._condition:
+            self.limit = max(self.min_limit, self.limit / 2)
+        instrumentation.count('ee_throttled')
+
+
+class EERequestScheduler:
+    """
+    Runs blocking Earth Engine requests (getInfo, exports) under a token bucket and an
+    adaptive concurrency limit, retrying throttled and transient failures with
+    jittered exponential backoff. Shared by all download threads of a process.
+    """
+    def __init__(self,
+                 requests_per_second: float = EE_REQUESTS_PER_SECOND,
+                 max_concurrency: int = 1,
+                 max_retries: int = EE_MAX_RETRIES,
+                 base_delay: float = 1.0,
+                 max_delay: float = 60.0,
+                 ):
+        self.token_bucket = TokenBucket(requests_per_second)
+        self.concurrency = AdaptiveConcurrencyLimit(max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def set_max_concurrency(self, max_concurrency: int) -> None:
+        self.concurrency.set_max_limit(max_concurrency)
+
+    def _get_backoff(self, attempt: int) -> float:
+        # "Full jitter": uniform in [0, base * 2^attempt], so retrying threads do not line up
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, name: str, request: Callable, *args, **kwargs):
+        """
+        Runs request(*args, **kwargs), e.g. scheduler.call('collection_size', collection.size().getInfo)
+        :param name: Name of the request in the run report
+        :return: What the request returns
+        Raises RetriesExhaustedError if a retryable error persists after max_retries,
+        other errors are raised as they are.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.token_bucket.acquire()
+            try:
+                with self.concurrency.slot(), instrumentation.ee_call(name):
+                    result = request(*args, **kwargs)
+            except Exception as e:
+                if not is_retryable_error(e):
+                    raise
+                if attempt == self.max_retries:
+                    instrumentation.count(f'ee_retries_exhausted.{name}')
+                    raise RetriesExhaustedError(f'{name} failed {attempt + 1} times, last error: {type(e).__name__}: {e}') from e
+                if is_throttling_error(e):
+                    self.concurrency.on_throttled()
+                instrumentation.count(f'ee_retries.{name}')
+                delay = self._get_backoff(attempt)
+                print(f'Earth Engine request {name} failed ({type(e).__name__}: {e}), retrying in {delay:.1f}s...')
+                time.sleep(delay)
+                continue
+
+            self.concurrency.on_success()
+            return result
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_ee_scheduler() -> EERequestScheduler:
+    """
+    The scheduler shared by every Earth Engine request of this process
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = EERequestScheduler()
+        return _scheduler
+
+
+@contextmanager
+def atomic_write(path: Union[str, Path]):
+    """
+    Yields a temporary path next to `path` and renames it to `path` only if the block succeeds,
+    so an interrupted write never leaves a partial file under the final name.
+    The temporary name does not match the *_band.tif pattern of the raw band catalog.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
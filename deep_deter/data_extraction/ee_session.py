@@ -0,0 +1,34 @@
+# Std.Lib.
+import os
+import threading
+
+# Environment variables
+# Reads .env file. You need to create a .env file and add:
+# GOOGLE_PROJECT=your_project_name
+from dotenv import load_dotenv
+load_dotenv()
+EE_PROJECT = os.getenv('GOOGLE_PROJECT')
+
+_init_lock = threading.Lock()
+_initialized = False
+
+
+def initialize_ee():
+    """
+    Authenticates and initializes Earth Engine the first time it is actually needed.
+    Importing the data_extraction modules never touches Earth Engine, so the local
+    stages (feature masking, labels, split) and their worker processes start quickly
+    and do not need credentials or network access.
+    Safe to call from several threads, the session is only created once per process.
+    :return: The initialized ee module
+    """
+    global _initialized
+    import ee
+
+    if not _initialized:
+        with _init_lock:
+            if not _initialized:
+                ee.Authenticate()
+                ee.Initialize(project=EE_PROJECT)
+                _initialized = True
+    return ee
@@ -2,6 +2,7 @@
 import os
 import sys
 from datetime import datetime, timedelta
+from typing import Dict, Tuple, Union
 
 # Data Science and Earth Engine
 import geopandas.geodataframe
@@ -10,23 +11,19 @@ import ee
 
 # Custom functions
 from deep_deter.data_extraction.custom_error import NoImagesError
+from deep_deter.data_extraction.ee_scheduler import EERequestScheduler, get_ee_scheduler
+from deep_deter.data_extraction.ee_session import initialize_ee
 from deep_deter.data_extraction.utils import mask_s2_clouds
 
 # Environment variables
 # Reads .env file. You need to create a .env file and add:
-# GOOGLE_PROJECT=your_project_name
 # PROJECT_PATH=/your/path/to/project
 from dotenv import load_dotenv
 load_dotenv()
 PROJECT_PATH = os.getenv('PROJECT_PATH')
-EE_PROJECT = os.getenv('GOOGLE_PROJECT')
 SENTINEL_COLLECTION = os.getenv('EE_COLLECTION')
 sys.path.insert(0, PROJECT_PATH)
 
-# EE authentication
-ee.Authenticate()
-ee.Initialize(project=EE_PROJECT)
-
 
 class FetchSentinelImg:
     """
@@ -39,9 +36,23 @@ class FetchSentinelImg:
     def __init__(self,
                  max_allowed_cloud_percentage: int,
                  max_allowed_lookback_days: int,
+                 ee_client=None,
+                 scheduler: Union[EERequestScheduler, None] = None,
                  ):
+        """
+        :param ee_client: Module or object exposing the ee API (Geometry, ImageCollection, Filter,
+        Dictionary...). Defaults to the real Earth Engine session, a fake client can be given to run
+        the class offline.
+        :param scheduler: Rate limits and retries the blocking requests, shared by the process by default
+        """
         self.cloud_pct = max_allowed_cloud_percentage
         self.max_lookback = max_allowed_lookback_days
+        self._ee_client = ee_client
+        self.scheduler = scheduler if scheduler is not None else get_ee_scheduler()
+
+    @property
+    def ee_api(self):
+        return self._ee_client if self._ee_client is not None else initialize_ee()
 
     @property
     def ee_polygon(self) -> ee.geometry.Geometry:
@@ -52,7 +63,7 @@ class FetchSentinelImg:
         # Need to transform from geometry to ee.Geometry.Polygon
         new_polygon_series = new_polygon_series.squeeze()
         coordinates = list(new_polygon_series['geometry'].exterior.coords)
-        self._ee_polygon = ee.Geometry.Polygon(coordinates)
+        self._ee_polygon = self.ee_api.Geometry.Polygon(coordinates)
 
     @staticmethod
     def _get_date_n_days_before(view_date: str, lookback_days: int) -> str:
@@ -79,14 +90,103 @@ class FetchSentinelImg:
         Obtains an image_collection from the Sentinel-2 satellite collection
         :return: Gets a handle to the image collection from Earth Engine
         """
-        img_collection = (
-            ee.ImageCollection(SENTINEL_COLLECTION)
+        return self._filter_sentinel_collection(ee_polygon, first_date, last_date).map(mask_s2_clouds)
+
+    def _filter_sentinel_collection(self,
+                                    ee_polygon: ee.geometry.Geometry,
+                                    first_date: str,
+                                    last_date: str,
+                                    ) -> ee.imagecollection.ImageCollection:
+        """
+        The Sentinel-2 images of the period over the polygon, below the cloud threshold, before cloud masking
+        """
+        return (
+            self.ee_api.ImageCollection(SENTINEL_COLLECTION)
             .filterDate(first_date, last_date)
             .filterBounds(ee_polygon)
-            .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', self.cloud_pct))
-            .map(mask_s2_clouds)
+            .filter(self.ee_api.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', self.cloud_pct))
         )
-        return img_collection
+
+    def _get_polygon_and_dates(self,
+                               polygon_series: geopandas.geodataframe.GeoDataFrame,
+                               ) -> Tuple[ee.geometry.Geometry, str, str]:
+        """
+        The ee.Geometry of a single DETER alert and the (first_date, last_date) of its lookback window.
+        Raises AttributeError for MultiPolygons.
+        """
+        new_polygon_series = polygon_series.squeeze()  # Transform GeoDataFrame into GeoSeries
+        coordinates = list(new_polygon_series['geometry'].exterior.coords)
+        ee_polygon = self.ee_api.Geometry.Polygon(coordinates)
+
+        first_date, last_date = self.get_date_window(polygon_series)
+        return ee_polygon, first_date, last_date
+
+    def get_date_window(self, polygon_series: geopandas.geodataframe.GeoDataFrame) -> Tuple[str, str]:
+        """
+        (first_date, last_date) of the images composed for a single DETER alert
+        """
+        # Redefining pull dates
+        ref_date = polygon_series['VIEW_DATE'].values[0]
+        first_date = self._get_date_n_days_before(ref_date, self.max_lookback)
+        return first_date, ref_date
+
+    def get_composite(self,
+                      ee_geometry: ee.geometry.Geometry,
+                      first_date: str,
+                      last_date: str,
+                      ) -> ee.image.Image:
+        """
+        Median of the cloud masked images over any geometry (an alert, a cache tile...),
+        without checking that there is at least one image
+        """
+        img_collection = self._fetch_sentinel_img(ee_geometry, first_date, last_date)
+        return self._get_median(img_collection)
+
+    @staticmethod
+    def _get_median(img_collection: ee.imagecollection.ImageCollection) -> ee.image.Image:
+        # https://developers.google.com/earth-engine/datasets/catalog/COPERNICUS_S2_SR_HARMONIZED#bands
+        bands = ['B4', 'B3', 'B2', 'B8']  # R, G, B, NIR
+        return img_collection.select(bands).median()  # Median helps mitigate clouds masked in some images
+
+    def get_image_availability(self,
+                               deter_alerts: geopandas.geodataframe.GeoDataFrame,
+                               batch_size: int = 500,
+                               ) -> Dict[str, dict]:
+        """
+        Checks which alerts have Sentinel images with a single Earth Engine round trip per batch,
+        instead of one size().getInfo() per alert.
+        The counts and image ids of every alert are gathered in one server-side ee.Dictionary.
+        :param deter_alerts: Rows of the DETER dataset
+        :param batch_size: Alerts per request, keeps the request under the Earth Engine payload limits
+        :return: FID -> {'n_images': int, 'image_ids': [system:index, ...]}.
+        MultiPolygons are left out, get_sentinel_img raises for them as before.
+        """
+        availability = {}
+        for start in range(0, len(deter_alerts), batch_size):
+            availability.update(self._get_batch_availability(deter_alerts.iloc[start:start + batch_size]))
+        return availability
+
+    def _get_batch_availability(self, deter_alerts: geopandas.geodataframe.GeoDataFrame) -> Dict[str, dict]:
+        alert_ids = []
+        availability = []
+        for i in range(len(deter_alerts)):
+            alert = deter_alerts.iloc[[i]]
+            try:
+                ee_polygon, first_date, last_date = self._get_polygon_and_dates(alert)
+            except AttributeError:
+                continue
+
+            img_collection = self._filter_sentinel_collection(ee_polygon, first_date, last_date)
+            alert_ids.append(str(alert.FID.values[0]))
+            availability.append(self.ee_api.Dictionary({
+                'n_images': img_collection.size(),
+                'image_ids': img_collection.aggregate_array('system:index'),
+            }))
+
+        if not alert_ids:
+            return {}
+
+        return self.scheduler.call('image_availability', self.ee_api.Dictionary.fromLists(alert_ids, availability).getInfo)
 
     @staticmethod
     def _get_sentinel_limits(img_collection: ee.imagecollection.ImageCollection) -> ee.geometry.Geometry:
@@ -110,29 +210,24 @@ class FetchSentinelImg:
 
     def get_sentinel_img(self,
                          polygon_series: geopandas.geodataframe.GeoDataFrame,
+                         n_images: Union[int, None] = None,
                          ) -> ee.image.Image:
         """
         Fetches the sentinel image.
+        :param n_images: Number of images available for the alert, from get_image_availability.
+        If not given, it is asked to Earth Engine with one extra request.
         :return: A single image using the composition of all images in the period
         """
         print('Fetching img...')
-        new_polygon_series = polygon_series.squeeze()  # Transform GeoDataFrame into GeoSeries
-        coordinates = list(new_polygon_series['geometry'].exterior.coords)
-        ee_polygon = ee.Geometry.Polygon(coordinates)
-
-        # Redefining pull dates
-        ref_date = polygon_series['VIEW_DATE'].values[0]
-        first_date = self._get_date_n_days_before(ref_date, self.max_lookback)
-        last_date = ref_date
+        ee_polygon, first_date, last_date = self._get_polygon_and_dates(polygon_series)
 
         img_collection = self._fetch_sentinel_img(ee_polygon, first_date, last_date)
-        n_images = img_collection.size().getInfo()
-        print(f'Earth Engine API returned {n_images} images')
+        if n_images is None:
+            n_images = self.scheduler.call('collection_size', img_collection.size().getInfo)
+            print(f'Earth Engine API returned {n_images} images')
 
         if n_images == 0:
             # This lets other objects know that they should skip this polygon due to lack of data
             raise NoImagesError
         else:
-            # https://developers.google.com/earth-engine/datasets/catalog/COPERNICUS_S2_SR_HARMONIZED#bands
-            bands = ['B4', 'B3', 'B2', 'B8']  # R, G, B, NIR
-            return img_collection.select(bands).median()  # Median helps mitigate clouds masked in some images
+            return self._get_median(img_collection)
@@ -0,0 +1,191 @@
+# Std.Lib.
+import bisect
+import cProfile
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Union
+
+# Reads .env file, optionally add:
+# RUN_REPORT_DIR = directory for the JSON-lines run reports (defaults to ./data/run_reports)
+# PROFILE_OUTPUT = path of a cProfile .prof file written for the whole run (disabled by default)
+from dotenv import load_dotenv
+load_dotenv()
+RUN_REPORT_DIR = Path(os.getenv('RUN_REPORT_DIR', './data/run_reports'))
+PROFILE_OUTPUT = os.getenv('PROFILE_OUTPUT')
+
+# Upper bounds of the latency histogram buckets, in seconds (the last bucket is everything above)
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+
+class Histogram:
+    """
+    Fixed bucket latency histogram, cheap enough to update on every call
+    """
+    def __init__(self):
+        self.bucket_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.bucket_counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'total_s': self.total,
+            'mean_s': self.total / self.count if self.count else 0.0,
+            'max_s': self.max,
+            'buckets': dict(zip([str(b) for b in LATENCY_BUCKETS] + ['inf'], self.bucket_counts)),
+        }
+
+
+class Instrumentation:
+    """
+    Per-stage and per-polygon timers, counters (bytes read/written, Earth Engine calls...)
+    and latency histograms for the extraction pipeline.
+    Every timed stage is appended as one JSON line to {RUN_REPORT_DIR}/run-{run_id}-{pid}.jsonl
+    and write_summary() appends the aggregated counters and histograms at the end of the run.
+    Worker processes inherit the run id through the environment, so their files can be merged.
+    Safe to use from several threads.
+    """
+    report_dir: Path
+    run_id: str
+    counters: Dict[str, float]
+    histograms: Dict[str, Histogram]
+
+    def __init__(self, report_dir: Union[str, Path] = RUN_REPORT_DIR):
+        self.report_dir = Path(report_dir)
+        self.run_id = os.environ.setdefault('DEEP_DETER_RUN_ID', time.strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:6])
+        self.counters = defaultdict(float)
+        self.histograms = defaultdict(Histogram)
+        self._lock = threading.Lock()
+        self._report_path = None
+        self._report_file = None
+        self._pid = None
+
+    def _check_process(self) -> None:
+        # A forked worker starts with a copy of the parent's counters and file handle,
+        # reset them and open its own file on the next write
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._report_path = self.report_dir/f'run-{self.run_id}-{self._pid}.jsonl'
+            self._report_file = None
+            self.counters = defaultdict(float)
+            self.histograms = defaultdict(Histogram)
+
+    def _write(self, event: dict) -> None:
+        event['time'] = time.time()  # Wall clock, to line events up with a py-spy recording
+        event['pid'] = os.getpid()
+        with self._lock:
+            self._check_process()
+            if self._report_file is None:
+                os.makedirs(self.report_dir, exist_ok=True)
+                # Line buffered: kept open for the whole process, every event still reaches the file
+                self._report_file = open(self._report_path, 'a', buffering=1)
+            self._report_file.write(json.dumps(event) + '\n')
+
+    def count(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._check_process()
+            self.counters[name] += value
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self._check_process()
+            self.histograms[name].observe(seconds)
+
+    @contextmanager
+    def stage(self, name: str, polygon_id: Union[str, None] = None):
+        """
+        Times a block, e.g. `with instrumentation.stage('geometry_mask', polygon_id):`
+        The event is recorded even if the block raises, with ok=False.
+        """
+        start = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe(f'stage.{name}', seconds)
+            self._write({'type': 'stage', 'stage': name, 'polygon_id': polygon_id, 'seconds': seconds, 'ok': ok})
+
+    @contextmanager
+    def ee_call(self, name: str):
+        """
+        Times a blocking Earth Engine call (getInfo, export...) and counts it
+        """
+        self.count(f'ee_calls.{name}')
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(f'ee.{name}', time.perf_counter() - start)
+
+    def add_bytes_read(self, n_bytes: int) -> None:
+        self.count('bytes_read', n_bytes)
+
+    def add_bytes_written(self, path: Union[str, Path]) -> None:
+        self.count('bytes_written', os.path.getsize(path))
+
+    def record_failures(self, stage: str, failures: Dict[str, str]) -> None:
+        """
+        Appends the polygons that failed in a stage, polygon_id -> error message
+        """
+        if failures:
+            self._write({'type': 'failures', 'stage': stage, 'failures': failures})
+
+    def get_summary(self) -> dict:
+        with self._lock:
+            self._check_process()
+            return {
+                'type': 'summary',
+                'run_id': self.run_id,
+                'counters': dict(self.counters),
+                'histograms': {name: histogram.to_dict() for name, histogram in self.histograms.items()},
+            }
+
+    def write_summary(self) -> None:
+        """
+        Appends the counters and histograms of this process, call it at the end of a run or worker
+        """
+        summary = self.get_summary()
+        if summary['counters'] or summary['histograms']:
+            self._write(summary)
+
+
+# Shared by all stages of a process
+instrumentation = Instrumentation()
+
+
+@contextmanager
+def profile_run(output_path: Union[str, None] = PROFILE_OUTPUT):
+    """
+    cProfile hook for a whole run, enabled by setting PROFILE_OUTPUT.
+    The .prof file can be opened with snakeviz or `python -m pstats`.
+    For sampling without overhead in production, run the process under `py-spy record` instead,
+    the stage events carry wall clock timestamps to match the flame graph against.
+    """
+    if output_path is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        profiler.dump_stats(output_path)
+        print(f'cProfile stats written to {output_path}')
@@ -2,41 +2,80 @@
 import os
 import sys
 import warnings
-from collections import defaultdict
+from multiprocessing.util import Finalize
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from typing import List, Tuple
+from typing import Callable, Dict, List, Tuple, Union
 
-# Data Science and Earth Engine
-import geopandas as gpd
-import ee
+# Data Science
+import rasterio
 
 # Environment variables
 from dotenv import load_dotenv
 
 # Custom functions
+from deep_deter.data_extraction.alert_index import AlertIndex
+from deep_deter.data_extraction.deter_cache import load_deter_gdf
+from deep_deter.data_extraction.instrumentation import instrumentation, profile_run
 from deep_deter.data_extraction.mask_feature_bands import MaskFeatureBands
-from deep_deter.data_extraction.mask_label import MaskLabel
-from deep_deter.data_extraction.save_to_disk import SaveToDisk
-from deep_deter.data_extraction.train_test_split import assign_files_to_datasets
+from deep_deter.data_extraction.manifest import ExtractionManifest, hash_values
+from deep_deter.data_extraction.mask_features_and_label import MaskFeaturesAndLabel
+from deep_deter.data_extraction.mask_label import PRODES_FILE, MaskLabel
+from deep_deter.data_extraction.output_profile import OUTPUT_PROFILE
+from deep_deter.data_extraction.raw_catalog import RawCatalog
+from deep_deter.data_extraction.train_test_split import build_split_manifest, materialize_split
 
 # Reads .env file. You need to create a .env file and add:
-# GOOGLE_PROJECT=your_project_name
 # PROJECT_PATH=/your/path/to/project
 # DETER_FILE = path to the .shp file
+# N_DOWNLOAD_WORKERS = number of concurrent Earth Engine downloads (optional, defaults to 1)
+# N_PROCESSES = number of processes for feature and label processing (optional, defaults to 1)
+# SPLIT_STRATIFY = stratify the train/test split by label positive fraction (optional, defaults to False)
+# SPLIT_MATERIALIZATION = 'none' (default), 'symlink' or 'hardlink' to also fill data/model_inputs/*/
 load_dotenv()
 DETER_FILE = os.getenv('DETER_FILE')
-EE_PROJECT = os.getenv('GOOGLE_PROJECT')
 PROJECT_PATH = os.getenv('PROJECT_PATH')
 N_ITERATIONS = int(os.getenv('N_ITERATIONS'))
+N_DOWNLOAD_WORKERS = int(os.getenv('N_DOWNLOAD_WORKERS', 1))
+N_PROCESSES = int(os.getenv('N_PROCESSES', 1))
+SPLIT_STRATIFY = os.getenv('SPLIT_STRATIFY', 'False').lower() == 'true'
+SPLIT_MATERIALIZATION = os.getenv('SPLIT_MATERIALIZATION', 'none')
 sys.path.insert(0, PROJECT_PATH)
 
-# Earth Engine authentication
-ee.Authenticate()
-ee.Initialize(project=EE_PROJECT)
+PATH_FEATURES = Path('./data/processed/masked_feature_bands')
+PATH_LABELS = Path('./data/processed/labels')
+PATH_IMAGES = Path('./data/images')
 
 # Ignore certain warnings
 warnings.filterwarnings("ignore", category=UserWarning)
 
+# Processing stage (MaskFeatureBands or MaskLabel) owned by each worker process
+_worker_stage = None
+
+
+def _init_worker(stage_class: type, *stage_args) -> None:
+    """
+    Builds the processing stage once per worker process instead of once per polygon.
+    """
+    global _worker_stage
+    warnings.filterwarnings("ignore", category=UserWarning)
+    _worker_stage = stage_class(*stage_args)
+    # Worker processes skip atexit, multiprocessing finalizers still run when the pool shuts down
+    Finalize(None, instrumentation.write_summary, exitpriority=10)
+
+
+def _run_worker_task(method_name: str, polygon_id: str) -> Union[str, None]:
+    """
+    Runs one polygon in a worker process.
+    :return: None on success, the error message otherwise, so one bad polygon does not stop the pool
+    """
+    try:
+        with instrumentation.stage(method_name, polygon_id):
+            getattr(_worker_stage, method_name)(polygon_id)
+    except Exception as e:
+        return f'{type(e).__name__}: {e}'
+    return None
+
 
 class ExtractFiles:
     def __init__(self,
@@ -44,88 +83,373 @@ class ExtractFiles:
                  run_feature_processing: bool = True,
                  run_label_processing: bool = True,
                  run_train_test_split: bool = True,
+                 n_processes: int = N_PROCESSES,
+                 incremental: bool = True,
+                 fused: bool = True,
                  ):
+        """
+        :param n_processes: Number of processes used for feature and label processing
+        :param incremental: Skip polygons whose outputs are up-to-date in the manifest
+        :param fused: When both features and labels run, process them in a single pass per polygon
+        """
         self.run_extraction = run_extraction
         self.run_feature_processing = run_feature_processing
         self.run_label_processing = run_label_processing
         self.run_train_test_split = run_train_test_split
+        self.n_processes = n_processes
+        self.incremental = incremental
+        self.fused = fused
 
         print('Loading DETER data...')
         print(f'Reading from path: {DETER_FILE}')
-        self.gdf = gpd.read_file(DETER_FILE)
+        self.gdf = load_deter_gdf(DETER_FILE)
+        self.alert_index = AlertIndex(self.gdf)
+        self.raw_catalog = RawCatalog('./data/raw/')
+        self.manifest = ExtractionManifest()
 
-    @staticmethod
-    def _get_raw_saved_ids() -> Tuple[List[str], int]:
+    def _get_raw_saved_ids(self) -> Tuple[List[str], int]:
         """
-        Gets all .tif files from the ./data/raw/ directory
+        Gets all polygon ids saved in the ./data/raw/ directory from the raw band catalog
         :return: A list with all polygon_ids
         """
-        # Use a dictionary to count the occurrences of each ID
-        id_counts = defaultdict(int)
-
-        # Collect all files and count occurrences of each ID
-        for file in Path('./data/raw/').glob('*.tif'):
-            id_name = file.name.split('_')[0] + '_' + file.name.split('_')[1]
-            id_counts[id_name] += 1
-
-        # Filter IDs to only those with exactly 4 entries (R + G + B + NIR)
+        # Only IDs with all 4 bands (R + G + B + NIR)
         # This avoids errors if one polygon_id was pulled in an incomplete way
-        # TODO: function to catch errors here
-        current_ids = [id_name for id_name, count in id_counts.items() if count == 4]
+        current_ids = self.raw_catalog.get_complete_ids()
         count_polygon_ids = len(current_ids)
         print(f'There are currently {count_polygon_ids} distinct ids saved in ./data/raw')
 
         return current_ids, count_polygon_ids
 
     def _run_extraction(self, n_iterations: int = 10):
-        save_to_disk = SaveToDisk(self.gdf)
-        save_to_disk.main(n_iterations=n_iterations)
-
-    def _run_feature_processing(self, polygon_ids: List[str], count_polygon_ids: int):
-        mask_feature_bands = MaskFeatureBands(self.gdf, './data/raw/')
-        for i, polygon_id in enumerate(polygon_ids):
-            print(f'{i}/{count_polygon_ids} Processing features for polygon id: {polygon_id}...')
-            if self.gdf[self.gdf['FID'] == polygon_id].shape[0] > 0:
-                mask_feature_bands.process_raw_raster_files(polygon_id)
-            else:
-                print('Raw image is not in sample dataframe, skipping feature...')
-
-    def _run_label_processing(self, polygon_ids: List[str], count_polygon_ids: int):
-        mask_label = MaskLabel(self.gdf)
-        for i, polygon_id in enumerate(polygon_ids):
-            print(f'{i}/{count_polygon_ids} Processing labels for polygon id: {polygon_id}...')
-            if self.gdf[self.gdf['FID'] == polygon_id].shape[0] > 0:
-                mask_label.write_label_to_disk(polygon_id)
-            else:
-                print('Raw image is not in sample dataframe, skipping label...')
+        # Imported here so the local stages never load Earth Engine or geemap
+        from deep_deter.data_extraction.save_to_disk import SaveToDisk
+
+        save_to_disk = SaveToDisk(self.gdf, alert_index=self.alert_index, raw_catalog=self.raw_catalog)
+        save_to_disk.main(n_iterations=n_iterations, max_workers=N_DOWNLOAD_WORKERS)
+
+    def _get_feature_task(self, polygon_id: str) -> Tuple[dict, dict, list]:
+        """
+        Inputs, parameters and outputs of the feature stage for one polygon, as stored in the manifest
+        """
+        inputs = {path.name: path for path in self.raw_catalog.get_band_paths(polygon_id)}
+        params = {'download': self.raw_catalog.get_params(polygon_id), 'output_profile': OUTPUT_PROFILE}
+        outputs = [
+            PATH_FEATURES/f'{polygon_id}_bands.tif',
+            PATH_IMAGES/'features'/f'{polygon_id}.png',
+        ]
+        return inputs, params, outputs
+
+    def _is_feature_up_to_date(self, polygon_id: str) -> bool:
+        return self.manifest.is_up_to_date('features', polygon_id, *self._get_feature_task(polygon_id))
+
+    @staticmethod
+    def _get_label_files(polygon_id: str) -> Tuple[dict, list]:
+        inputs = {'features': PATH_FEATURES/f'{polygon_id}_bands.tif', 'prodes': PRODES_FILE}
+        outputs = [
+            PATH_LABELS/f'{polygon_id}.tif',
+            PATH_IMAGES/'labels'/f'{polygon_id}.png',
+        ]
+        return inputs, outputs
+
+    def _get_raw_bounds(self, polygon_id: str) -> Union[Tuple[float, float, float, float], None]:
+        # The features have the same bounds as the raw bands, which exist before any processing
+        raw_band_paths = self.raw_catalog.get_band_paths(polygon_id)
+        if not raw_band_paths:
+            return None
+        with rasterio.open(raw_band_paths[0]) as src:
+            return tuple(src.bounds)
+
+    def _get_alerts_hash(self, view_date: str, bounds: Tuple[float, float, float, float]) -> str:
+        alerts = self.alert_index.query_bbox(tuple(bounds), max_view_date=view_date)
+        return hash_values(alerts['FID'].values)
+
+    def _get_label_task(self, polygon_id: str) -> Tuple[dict, dict, list]:
+        """
+        Inputs, parameters and outputs of the label stage for one polygon, as stored in the manifest.
+        A label also depends on every older alert inside its bounds, so their FIDs are part of the
+        parameters: new alerts only invalidate the labels they overlap.
+        The bounds are recorded too, so checking a label does not need to open its raster again.
+        """
+        inputs, outputs = self._get_label_files(polygon_id)
+        view_date = self.alert_index.get_view_date(polygon_id)
+        params = {'view_date': view_date, 'output_profile': OUTPUT_PROFILE}
+
+        bounds = self._get_raw_bounds(polygon_id)
+        if bounds is not None:
+            params['bounds'] = list(bounds)
+            params['alerts'] = self._get_alerts_hash(view_date, bounds)
+        return inputs, params, outputs
+
+    def _is_label_up_to_date(self, polygon_id: str) -> bool:
+        """
+        Same as comparing _get_label_task with the manifest, but the cheap signatures (features,
+        PRODES, outputs, view date) are checked first and the alerts inside the bounds only when
+        they match, with the bounds recorded in the manifest instead of reopening the raster.
+        """
+        recorded = self.manifest.get_params('labels', polygon_id)
+        if recorded is None:
+            return False
+
+        inputs, outputs = self._get_label_files(polygon_id)
+        view_date = self.alert_index.get_view_date(polygon_id)
+        if recorded.get('view_date') != view_date or recorded.get('output_profile') != OUTPUT_PROFILE:
+            return False
+        # The recorded parameters only leave the input and output signatures to compare
+        if not self.manifest.is_up_to_date('labels', polygon_id, inputs, recorded, outputs):
+            return False
+
+        # Entries recorded before the bounds were part of the parameters still need the raster
+        bounds = recorded['bounds'] if 'bounds' in recorded else self._get_raw_bounds(polygon_id)
+        alerts = self._get_alerts_hash(view_date, bounds) if bounds is not None else None
+        return recorded.get('alerts') == alerts
+
+    def _get_known_ids(self, polygon_ids: List[str]) -> List[str]:
+        """
+        Drops polygons that are not in the DETER data
+        """
+        known_ids = [polygon_id for polygon_id in polygon_ids if polygon_id in self.alert_index]
+        if len(known_ids) < len(polygon_ids):
+            print(f'{len(polygon_ids) - len(known_ids)} raw images are not in sample dataframe, skipping them...')
+        return known_ids
+
+    def _get_pending_tasks(self,
+                           stage: str,
+                           polygon_ids: List[str],
+                           is_up_to_date: Callable[[str], bool],
+                           get_task: Callable[[str], Tuple[dict, dict, list]],
+                           ) -> Dict[str, Tuple[dict, dict, list]]:
+        """
+        Drops polygons that are not in the DETER data and, in incremental mode,
+        polygons whose outputs are up-to-date in the manifest.
+        The full task is only built for the polygons left to process.
+        :return: polygon_id -> (inputs, params, outputs) for every polygon left to process
+        """
+        known_ids = self._get_known_ids(polygon_ids)
+
+        tasks = {}
+        for polygon_id in known_ids:
+            if self.incremental and is_up_to_date(polygon_id):
+                continue
+            tasks[polygon_id] = get_task(polygon_id)
+
+        print(f'{len(known_ids) - len(tasks)} polygons are up-to-date, {len(tasks)} left to process for {stage}')
+        return tasks
+
+    def _get_worker_catalog(self) -> RawCatalog:
+        """
+        The raw band catalog for worker processes, refreshed once here so that the workers
+        do not all rebuild it and write the same file at the same time
+        """
+        self.raw_catalog.refresh()
+        return RawCatalog('./data/raw/', read_only=True)
+
+    def _run_in_process_pool(self,
+                             tasks: Dict[str, tuple],
+                             stage_class: type,
+                             stage_args: tuple,
+                             method_name: str,
+                             on_success: Callable[[str, tuple], None],
+                             ) -> Dict[str, str]:
+        """
+        Spreads the polygons over a pool of self.n_processes worker processes.
+        Each worker builds its own stage_class(*stage_args) and calls method_name for every polygon.
+        :param on_success: Called in this process with (polygon_id, task) for every polygon that succeeded
+        :return: polygon_id -> error message for every polygon that failed
+        """
+        failures = {}
+        with ProcessPoolExecutor(max_workers=self.n_processes,
+                                 initializer=_init_worker,
+                                 initargs=(stage_class, *stage_args),
+                                 ) as executor:
+            futures = {
+                executor.submit(_run_worker_task, method_name, polygon_id): polygon_id
+                for polygon_id in tasks
+            }
+            for i, future in enumerate(as_completed(futures), 1):
+                polygon_id = futures[future]
+                error = future.result()
+                if error is not None:
+                    failures[polygon_id] = error
+                    instrumentation.count('failed_polygons')
+                    print(f'{i}/{len(tasks)} Polygon id {polygon_id} failed: {error}')
+                    continue
+
+                on_success(polygon_id, tasks[polygon_id])
+                if i % 100 == 0 or i == len(tasks):
+                    print(f'{i}/{len(tasks)} polygons processed, {len(failures)} failed')
+
+        if failures:
+            print(f'{len(failures)} out of {len(tasks)} polygons failed in {method_name}')
+        return failures
+
+    def _run_sequentially(self,
+                          tasks: Dict[str, tuple],
+                          stage,
+                          method_name: str,
+                          on_success: Callable[[str, tuple], None],
+                          ) -> Dict[str, str]:
+        """
+        Same as _run_in_process_pool, in this process with an already built stage.
+        :return: polygon_id -> error message for every polygon that failed
+        """
+        failures = {}
+        for i, (polygon_id, task) in enumerate(tasks.items(), 1):
+            print(f'{i}/{len(tasks)} Running {method_name} for polygon id: {polygon_id}...')
+            try:
+                with instrumentation.stage(method_name, polygon_id):
+                    getattr(stage, method_name)(polygon_id)
+            except Exception as e:
+                failures[polygon_id] = f'{type(e).__name__}: {e}'
+                instrumentation.count('failed_polygons')
+                print(f'{i}/{len(tasks)} Polygon id {polygon_id} failed: {failures[polygon_id]}')
+                continue
+
+            on_success(polygon_id, task)
+
+        if failures:
+            print(f'{len(failures)} out of {len(tasks)} polygons failed in {method_name}')
+        return failures
+
+    def _run_feature_processing(self, polygon_ids: List[str], count_polygon_ids: int) -> Dict[str, str]:
+        tasks = self._get_pending_tasks('features', polygon_ids, self._is_feature_up_to_date,
+                                        self._get_feature_task)
+
+        if self.n_processes > 1:
+            # Each worker builds its own index and gets a read-only copy of the catalog
+            return self._run_in_process_pool(tasks,
+                                             MaskFeatureBands,
+                                             (self.gdf, './data/raw/', None, self._get_worker_catalog()),
+                                             'process_raw_raster_files',
+                                             lambda polygon_id, task: self.manifest.record('features', polygon_id, *task),
+                                             )
+
+        mask_feature_bands = MaskFeatureBands(
+            self.gdf,
+            './data/raw/',
+            alert_index=self.alert_index,
+            raw_catalog=self.raw_catalog,
+        )
+        return self._run_sequentially(tasks,
+                                      mask_feature_bands,
+                                      'process_raw_raster_files',
+                                      lambda polygon_id, task: self.manifest.record('features', polygon_id, *task),
+                                      )
+
+    def _run_label_processing(self, polygon_ids: List[str], count_polygon_ids: int) -> Dict[str, str]:
+        tasks = self._get_pending_tasks('labels', polygon_ids, self._is_label_up_to_date, self._get_label_task)
+
+        if self.n_processes > 1:
+            return self._run_in_process_pool(tasks,
+                                             MaskLabel,
+                                             (self.gdf,),
+                                             'write_label_to_disk',
+                                             lambda polygon_id, task: self.manifest.record('labels', polygon_id, *task),
+                                             )
+
+        mask_label = MaskLabel(self.gdf, alert_index=self.alert_index)
+        return self._run_sequentially(tasks,
+                                      mask_label,
+                                      'write_label_to_disk',
+                                      lambda polygon_id, task: self.manifest.record('labels', polygon_id, *task),
+                                      )
+
+    def _record_features_and_label(self, polygon_id: str, tasks: Tuple[tuple, tuple]) -> None:
+        feature_task, label_task = tasks
+        self.manifest.record('features', polygon_id, *feature_task)
+        self.manifest.record('labels', polygon_id, *label_task)
+
+    def _run_fused_processing(self, polygon_ids: List[str], count_polygon_ids: int) -> Dict[str, str]:
+        # Both outputs are rewritten when either of them is outdated,
+        # the manifest is checked in a single pass and tasks are only built for outdated polygons
+        known_ids = self._get_known_ids(polygon_ids)
+        tasks = {}
+        for polygon_id in known_ids:
+            if self.incremental and self._is_feature_up_to_date(polygon_id) and self._is_label_up_to_date(polygon_id):
+                continue
+            tasks[polygon_id] = (self._get_feature_task(polygon_id), self._get_label_task(polygon_id))
+        print(f'{len(known_ids) - len(tasks)} polygons are up-to-date, {len(tasks)} left to process for features and labels')
+
+        if self.n_processes > 1:
+            return self._run_in_process_pool(tasks,
+                                             MaskFeaturesAndLabel,
+                                             (self.gdf, './data/raw/', None, self._get_worker_catalog()),
+                                             'process_polygon',
+                                             self._record_features_and_label,
+                                             )
+
+        mask_features_and_label = MaskFeaturesAndLabel(
+            self.gdf,
+            './data/raw/',
+            alert_index=self.alert_index,
+            raw_catalog=self.raw_catalog,
+        )
+        return self._run_sequentially(tasks,
+                                      mask_features_and_label,
+                                      'process_polygon',
+                                      self._record_features_and_label,
+                                      )
 
     @staticmethod
     def _run_train_test_split():
         base_dir = './data'
-        assign_files_to_datasets(base_dir, 80)
+        # Only writes model_inputs/split_manifest.json, the processed files stay where they are
+        build_split_manifest(base_dir, 80, stratify=SPLIT_STRATIFY)
+        if SPLIT_MATERIALIZATION != 'none':
+            materialize_split(base_dir, mode=SPLIT_MATERIALIZATION)
+
+    def main(self, n_iterations: int = 10) -> Dict[str, Dict[str, str]]:
+        """
+        Runs every enabled stage. Stage timings and counters are written to
+        {RUN_REPORT_DIR}/run-{run_id}-{pid}.jsonl, set PROFILE_OUTPUT to also get cProfile stats.
+        The polygons that failed are written to the run report as well.
+        :return: stage -> polygon_id -> error message for every polygon that failed
+        """
+        with profile_run():
+            failures = self._run_stages(n_iterations)
+        for stage, stage_failures in failures.items():
+            instrumentation.record_failures(stage, stage_failures)
+        instrumentation.write_summary()
+        print(f'Run report written to {instrumentation.report_dir} (run id {instrumentation.run_id})')
+        return failures
 
-    def main(self, n_iterations: int = 10) -> None:
+    def _run_stages(self, n_iterations: int) -> Dict[str, Dict[str, str]]:
+        failures = {}
         if self.run_extraction:
             print('Saving polygon images to disk...')
-            self._run_extraction(n_iterations=n_iterations)
+            with instrumentation.stage('extraction'):
+                self._run_extraction(n_iterations=n_iterations)
 
         polygon_ids, count_polygon_ids = self._get_raw_saved_ids()
+        instrumentation.count('raw_polygons', count_polygon_ids)
 
-        if self.run_feature_processing:
-            print('Processing Features...')
-            self._run_feature_processing(polygon_ids=polygon_ids,
-                                         count_polygon_ids=count_polygon_ids,
-                                         )
+        if self.fused and self.run_feature_processing and self.run_label_processing:
+            print('Processing Features and Labels...')
+            with instrumentation.stage('fused_processing'):
+                failures['fused_processing'] = self._run_fused_processing(polygon_ids=polygon_ids,
+                                                                          count_polygon_ids=count_polygon_ids,
+                                                                          )
 
-        if self.run_label_processing:
-            print('Processing Labels...')
-            self._run_label_processing(polygon_ids=polygon_ids,
-                                       count_polygon_ids=count_polygon_ids,
-                                       )
+        else:
+            if self.run_feature_processing:
+                print('Processing Features...')
+                with instrumentation.stage('feature_processing'):
+                    failures['feature_processing'] = self._run_feature_processing(polygon_ids=polygon_ids,
+                                                                                  count_polygon_ids=count_polygon_ids,
+                                                                                  )
+
+            if self.run_label_processing:
+                print('Processing Labels...')
+                with instrumentation.stage('label_processing'):
+                    failures['label_processing'] = self._run_label_processing(polygon_ids=polygon_ids,
+                                                                              count_polygon_ids=count_polygon_ids,
+                                                                              )
 
         if self.run_train_test_split:
             print('Splitting Train/Test...')
-            self._run_train_test_split()
+            with instrumentation.stage('train_test_split'):
+                self._run_train_test_split()
+
+        return {stage: stage_failures for stage, stage_failures in failures.items() if stage_failures}
 
 
 if __name__ == '__main__':
@@ -136,4 +460,7 @@ if __name__ == '__main__':
         run_label_processing=True,
         run_train_test_split=True,
     )
-    extract_files.main(N_ITERATIONS)
+    failures = extract_files.main(N_ITERATIONS)
+    if failures:
+        print(f'{sum(map(len, failures.values()))} polygons failed, see the run report')
+        sys.exit(1)
@@ -0,0 +1,113 @@
+# Std.Lib.
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Union
+
+MANIFEST_FILE = Path('./data/processed/manifest.jsonl')
+
+
+def get_file_signature(path: Union[str, Path]) -> Union[List[float], None]:
+    """
+    [size, mtime] of a file, None if it does not exist
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime]
+
+
+def hash_values(values: Iterable[str]) -> str:
+    """
+    Order independent hash of a set of values, e.g. the FIDs that went into a label
+    """
+    return hashlib.sha256('\n'.join(sorted(str(v) for v in values)).encode()).hexdigest()
+
+
+class ExtractionManifest:
+    """
+    Records, for every processing stage and polygon, the signature of the inputs and the
+    parameters that produced its outputs. Reruns skip polygons whose inputs, parameters and
+    outputs did not change, and since each polygon is appended as soon as it is done an
+    interrupted run resumes where it stopped.
+    The file is append-only (last entry wins), so recording a polygon is O(1).
+    """
+    manifest_file: Path
+    entries: Dict[tuple, dict]
+
+    def __init__(self, manifest_file: Union[str, Path] = MANIFEST_FILE):
+        self.manifest_file = Path(manifest_file)
+        self.entries = {}
+        self._lock = threading.Lock()
+
+        if self.manifest_file.exists():
+            with open(self.manifest_file) as f:
+                for line in f:
+                    # The last line can be cut short if a run was killed while writing it
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.entries[(entry['stage'], entry['polygon_id'])] = entry
+
+    @staticmethod
+    def _get_inputs_signature(inputs: Dict[str, Union[str, Path]]) -> Dict[str, Union[List[float], None]]:
+        return {name: get_file_signature(path) for name, path in inputs.items()}
+
+    def get_params(self, stage: str, polygon_id: str) -> Union[dict, None]:
+        """
+        Parameters recorded for a polygon, None if the stage never ran for it
+        """
+        entry = self.entries.get((stage, polygon_id))
+        return entry['params'] if entry is not None else None
+
+    def is_up_to_date(self,
+                      stage: str,
+                      polygon_id: str,
+                      inputs: Dict[str, Union[str, Path]],
+                      params: dict,
+                      outputs: List[Union[str, Path]],
+                      ) -> bool:
+        """
+        :param stage: Name of the processing stage, e.g. 'features' or 'labels'
+        :param polygon_id: The FID of the DETER alert
+        :param inputs: name -> path of every file the outputs are computed from
+        :param params: Anything else the outputs depend on, must be JSON serializable
+        :param outputs: Paths of the files written by the stage
+        :return: True if the stage can be skipped for this polygon
+        """
+        entry = self.entries.get((stage, polygon_id))
+        if entry is None:
+            return False
+        # Round trip through JSON so tuples and lists compare equal
+        if entry['params'] != json.loads(json.dumps(params)):
+            return False
+        if entry['inputs'] != self._get_inputs_signature(inputs):
+            return False
+        return all(Path(output).exists() for output in outputs)
+
+    def record(self,
+               stage: str,
+               polygon_id: str,
+               inputs: Dict[str, Union[str, Path]],
+               params: dict,
+               outputs: List[Union[str, Path]],
+               ) -> None:
+        """
+        Marks a polygon as done for a stage, call it after all outputs were written.
+        """
+        entry = {
+            'stage': stage,
+            'polygon_id': polygon_id,
+            'inputs': self._get_inputs_signature(inputs),
+            'params': params,
+            'outputs': [str(output) for output in outputs],
+        }
+        with self._lock:
+            self.entries[(stage, polygon_id)] = json.loads(json.dumps(entry))
+            os.makedirs(self.manifest_file.parent, exist_ok=True)
+            with open(self.manifest_file, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
@@ -2,30 +2,30 @@
 import os
 import sys
 from pathlib import Path
-from typing import List, Tuple
+from typing import List, Tuple, Union
 
 # Data Science and Earth Engine
 import numpy as np
 import rasterio
-import ee.geometry
+from rasterio.transform import array_bounds
 import geopandas.geodataframe
 from PIL import Image
 
+# Custom functions
+from deep_deter.data_extraction.alert_index import AlertIndex
+from deep_deter.data_extraction.instrumentation import instrumentation
+from deep_deter.data_extraction.output_profile import get_output_profile
+from deep_deter.data_extraction.raw_catalog import RawCatalog
+
 # Environment variables
 # Reads .env file. You need to create a .env file and add:
-# GOOGLE_PROJECT=your_project_name
 # PROJECT_PATH=/your/path/to/project
 from dotenv import load_dotenv
 load_dotenv()
-EE_PROJECT = os.getenv('GOOGLE_PROJECT')
 PRODES_FILE = os.getenv('PRODES_FILE')
 PROJECT_PATH = os.getenv('PROJECT_PATH')
 sys.path.insert(0, PROJECT_PATH)
 
-# EE authentication
-ee.Authenticate()
-ee.Initialize(project=EE_PROJECT)
-
 
 class MaskFeatureBands:
     """
@@ -33,18 +33,24 @@ class MaskFeatureBands:
     already declared degraded areas.
     """
     gdf: geopandas.geodataframe.GeoDataFrame
+    alert_index: AlertIndex
+    raw_catalog: RawCatalog
     path_raw_bands: Path
     gdf_slice: int
 
     def __init__(self,
                  gdf: geopandas.geodataframe.GeoDataFrame,
                  path_raw_bands: str,
+                 alert_index: Union[AlertIndex, None] = None,
+                 raw_catalog: Union[RawCatalog, None] = None,
                  ):
         """
         The ID from the degradation.
         """
         self.gdf = gdf
+        self.alert_index = alert_index if alert_index is not None else AlertIndex(gdf)
         self.path_raw_bands = Path(path_raw_bands)
+        self.raw_catalog = raw_catalog if raw_catalog is not None else RawCatalog(self.path_raw_bands)
         self.gdf_slice = None  # Placeholder until it gets defined
 
     @property
@@ -53,65 +59,55 @@ class MaskFeatureBands:
 
     @gdf_slice.setter
     def gdf_slice(self, id_polygon: str) -> None:
-        self._gdf_slice = self.gdf[self.gdf['FID'] == id_polygon]
+        self._gdf_slice = self.alert_index.get(id_polygon) if id_polygon is not None else None
 
     def _get_relevant_tif_files(self, id_polygon: str) -> List[Path]:
         """
-        This gets all *.tif files from that example that are relevant
+        This gets all *.tif files from that example that are relevant,
+        sorted by name (blue, green, nir, red)
         """
-        target_files = []
-        for file in self.path_raw_bands.glob('*.tif'):
-            file_root = file.name.split('_')[0] + '_' + file.name.split('_')[1]
-            if file_root == id_polygon:
-                target_files.append(self.path_raw_bands/Path(file_root+'_red_band.tif'))
-                target_files.append(self.path_raw_bands/Path(file_root+'_green_band.tif'))
-                target_files.append(self.path_raw_bands/Path(file_root+'_blue_band.tif'))
-                target_files.append(self.path_raw_bands/Path(file_root+'_nir_band.tif'))
-
-        # This is not exactly efficient, but let's go with it
-        target_files = list(set(target_files))
-        target_files = sorted(target_files)
-        return target_files
+        return self.raw_catalog.get_band_paths(id_polygon)
 
     @staticmethod
-    def _get_raster_limits(raster_path: Path) -> Tuple:
-        with rasterio.open(raster_path) as src:
-            bounds = src.bounds
-
-        bounds_rect = (bounds.left, bounds.bottom, bounds.right, bounds.top)
-        return bounds_rect
+    def _get_raster_limits(out_meta: dict) -> Tuple:
+        # (left, bottom, right, top)
+        return array_bounds(out_meta['height'], out_meta['width'], out_meta['transform'])
 
     @staticmethod
     def _mask_raw_bands(raster_paths: List[Path],
                         # prodes_mask: np.ndarray,
-                        ) -> List[np.ndarray]:
+                        ) -> Tuple[List[np.ndarray], dict]:
+        """
+        Reads every raw band once, along with the metadata of the first one.
+        All bands should have the same metadata.
+        """
         masked_bands = []
+        out_meta = None
 
         for raster_file in raster_paths:
             with rasterio.open(raster_file) as src:
                 band = src.read(1)
+                if out_meta is None:
+                    out_meta = src.meta.copy()
             masked_bands.append(band)
-        return masked_bands
+            instrumentation.add_bytes_read(band.nbytes)
+        return masked_bands, out_meta
 
     @staticmethod
     def _merge_masked_raw_bands_and_write_to_disk(
             masked_bands: List[np.ndarray],
             polygon_id: str,
-            target_files: List[Path],
+            out_meta: dict,
     ) -> None:
-        # This is just to obtain the metadata about the raster files
-        # All should have the same metadata
-        with rasterio.open(target_files[0]) as src:
-            out_meta = src.meta.copy()
+        out_meta = out_meta.copy()
         out_meta.update(count=4)
+        out_meta.update(get_output_profile(out_meta['dtype']))
+        output_path = Path('./data/processed/masked_feature_bands')/f'{polygon_id}_bands.tif'
 
-        with rasterio.open(
-                Path('./data/processed/masked_feature_bands')/f'{polygon_id}_bands.tif',
-                'w',
-                **out_meta,
-        ) as dest:
+        with rasterio.open(output_path, 'w', **out_meta) as dest:
             for i, ds in enumerate(masked_bands, 1):
                 dest.write_band(i, ds)
+        instrumentation.add_bytes_written(output_path)
 
     @staticmethod
     def _merge_masked_raw_bands_and_write_image(
@@ -131,14 +127,19 @@ class MaskFeatureBands:
 
         image = Image.fromarray(rgb)
         image.save(f'./data/images/features/{polygon_id}.png')
+        instrumentation.add_bytes_written(f'./data/images/features/{polygon_id}.png')
 
-    def process_raw_raster_files(self, id_polygon: str):
+    def process_raw_raster_files(self, id_polygon: str) -> dict:
         """
         This method masks all polygons specified in a PRODES mask with zeroes
         and saves all bands to a single *.tif file.
+        :return: The metadata of the raw bands (shape, transform, crs...), so the label can be
+        built without reading the file that was just written
         """
         target_files = self._get_relevant_tif_files(id_polygon)
-        limits = self._get_raster_limits(target_files[0])  # Files have the same limits so we can use any
+        with instrumentation.stage('read_raw_bands', id_polygon):
+            masked_bands, out_meta = self._mask_raw_bands(raster_paths=target_files)
+        limits = self._get_raster_limits(out_meta)  # Files have the same limits so we can use any
         self.gdf_slice = id_polygon
         ref_date = self.gdf_slice['VIEW_DATE'].values[0]
 
@@ -149,6 +150,8 @@ class MaskFeatureBands:
         #)
         #prodes_mask = prodes_mask_builder.get_mask()
 
-        masked_bands = self._mask_raw_bands(raster_paths=target_files)
-        self._merge_masked_raw_bands_and_write_to_disk(masked_bands, id_polygon, target_files)
-        self._merge_masked_raw_bands_and_write_image(masked_bands, id_polygon)
+        with instrumentation.stage('write_features', id_polygon):
+            self._merge_masked_raw_bands_and_write_to_disk(masked_bands, id_polygon, out_meta)
+        with instrumentation.stage('write_feature_png', id_polygon):
+            self._merge_masked_raw_bands_and_write_image(masked_bands, id_polygon)
+        return out_meta
@@ -0,0 +1,49 @@
+# Std.Lib.
+from typing import Union
+
+# Data Science
+import geopandas.geodataframe
+from rasterio.transform import array_bounds
+
+# Custom functions
+from deep_deter.data_extraction.alert_index import AlertIndex
+from deep_deter.data_extraction.mask_feature_bands import MaskFeatureBands
+from deep_deter.data_extraction.mask_label import MaskLabel
+from deep_deter.data_extraction.raw_catalog import RawCatalog
+
+
+class MaskFeaturesAndLabel:
+    """
+    Runs the feature and the label stages of a polygon in a single pass.
+    The raw bands are read once and the label is built from their in-memory metadata,
+    instead of reopening the {polygon_id}_bands.tif file that was just written.
+    """
+    alert_index: AlertIndex
+    mask_feature_bands: MaskFeatureBands
+    mask_label: MaskLabel
+
+    def __init__(self,
+                 gdf: geopandas.geodataframe.GeoDataFrame,
+                 path_raw_bands: str,
+                 alert_index: Union[AlertIndex, None] = None,
+                 raw_catalog: Union[RawCatalog, None] = None,
+                 ):
+        self.alert_index = alert_index if alert_index is not None else AlertIndex(gdf)
+        self.mask_feature_bands = MaskFeatureBands(
+            gdf,
+            path_raw_bands,
+            alert_index=self.alert_index,
+            raw_catalog=raw_catalog,
+        )
+        self.mask_label = MaskLabel(gdf, alert_index=self.alert_index)
+
+    def process_polygon(self, polygon_id: str) -> None:
+        """
+        Writes the features ({polygon_id}_bands.tif + .png) and the label ({polygon_id}.tif + .png)
+        """
+        out_meta = self.mask_feature_bands.process_raw_raster_files(polygon_id)
+
+        shape = (out_meta['height'], out_meta['width'])
+        limits = array_bounds(out_meta['height'], out_meta['width'], out_meta['transform'])
+        label = self.mask_label.build_label(polygon_id, shape, limits, out_meta['transform'], out_meta['dtype'])
+        self.mask_label.write_label(polygon_id, label, out_meta['crs'], out_meta['transform'])
@@ -1,72 +1,118 @@
+import os
+from typing import Tuple, Union
+
 import rasterio
+from affine import Affine
+from rasterio.crs import CRS
 from rasterio.features import geometry_mask
 import geopandas.geodataframe
+from deep_deter.data_extraction.alert_index import AlertIndex
+from deep_deter.data_extraction.instrumentation import instrumentation
 from deep_deter.data_extraction.mask_sentinel_img import GetCorrectProdesMask
+from deep_deter.data_extraction.output_profile import get_output_profile
 from PIL import Image
 import numpy as np
 
+from dotenv import load_dotenv
+load_dotenv()
+PRODES_FILE = os.getenv('PRODES_FILE', './data/external/PDigital2000_2022_AMZ_raster.tif')
+
 
 class MaskLabel:
-    def __init__(self, gdf: geopandas.geodataframe.GeoDataFrame):
+    def __init__(self,
+                 gdf: geopandas.geodataframe.GeoDataFrame,
+                 alert_index: Union[AlertIndex, None] = None,
+                 ):
         self.gdf = gdf
+        self.alert_index = alert_index if alert_index is not None else AlertIndex(gdf)
 
-    def write_label_to_disk(self, polygon_id: str):
-        # for name in current_ids:
-        # Path to your raster file
-        raster_path = f'./data/processed/masked_feature_bands/{polygon_id}_bands.tif'
+    def build_label(self,
+                    polygon_id: str,
+                    shape: Tuple[int, int],
+                    limits: Tuple[float, float, float, float],
+                    transform: Affine,
+                    dtype: str,
+                    ) -> np.ndarray:
+        """
+        Builds the label of a polygon: 1 where an older DETER alert or a PRODES class is, 0 elsewhere.
+        :param polygon_id: The FID of the DETER alert
+        :param shape: (height, width) of the feature raster
+        :param limits: (left, bottom, right, top) of the feature raster
+        :param transform: Affine transform of the feature raster
+        :param dtype: dtype of the label, same as the feature bands
+        """
+        raster_data = np.zeros(shape, dtype=dtype)
 
-        # Open the raster file
-        with rasterio.open(raster_path) as src:
-            # Read the raster data
-            raster_data = src.read(1)  # Read the first band
-            raster_data[:] = 0  # Set all values to zero
-            bounds = src.bounds
-
-        filtered_gdf = self.gdf.cx[bounds.left:bounds.right, bounds.bottom:bounds.top]
-        target_date = filtered_gdf[filtered_gdf['FID'] == polygon_id]['VIEW_DATE'].values[0]
-        filtered_gdf = filtered_gdf[filtered_gdf['VIEW_DATE'] <= target_date]
+        target_date = self.alert_index.get_view_date(polygon_id)
+        filtered_gdf = self.alert_index.query_bbox(limits, max_view_date=target_date)
 
         # Create a mask where geometries intersect
-        mask = rasterio.features.geometry_mask(
-            [geom for geom in filtered_gdf.geometry],
-            out_shape=raster_data.shape,
-            transform=src.transform,
-            invert=True
-        )
+        with instrumentation.stage('geometry_mask', polygon_id):
+            mask = rasterio.features.geometry_mask(
+                [geom for geom in filtered_gdf.geometry],
+                out_shape=raster_data.shape,
+                transform=transform,
+                invert=True
+            )
 
         # Set those locations to one
         raster_data[mask] = 1
 
-        # Define the output path for the modified raster
-        output_raster_path = f'./data/processed/labels/{polygon_id}.tif'
-
-        limits = (bounds.left, bounds.bottom, bounds.right, bounds.top)
-
-        get_correct_prodes_mask = GetCorrectProdesMask(
-            './data/external/PDigital2000_2022_AMZ_raster.tif',
-            limits,
-            target_date,
-        )
-        prodes_mask = get_correct_prodes_mask.get_mask(raster_data.shape)
+        with instrumentation.stage('prodes_mask', polygon_id):
+            get_correct_prodes_mask = GetCorrectProdesMask(
+                PRODES_FILE,
+                limits,
+                target_date,
+            )
+            prodes_mask = get_correct_prodes_mask.get_mask(raster_data.shape)
         raster_data[prodes_mask] = 1
 
+        return raster_data
+
+    @staticmethod
+    def write_label(polygon_id: str, raster_data: np.ndarray, crs: CRS, transform: Affine) -> None:
+        """
+        Saves the label as a .png image and as a GeoTIFF with the same georeference as the features.
+        """
         # Save as image
-        raster_image = raster_data.copy()
-        raster_image[raster_image == 1] = 255
-        raster_image[raster_image == 0] = 0
-        raster_image = raster_image.astype(np.uint8)
-        image = Image.fromarray(raster_image, 'L')
-        image.save(f'./data/images/labels/{polygon_id}.png')
+        with instrumentation.stage('write_label_png', polygon_id):
+            raster_image = raster_data.copy()
+            raster_image[raster_image == 1] = 255
+            raster_image[raster_image == 0] = 0
+            raster_image = raster_image.astype(np.uint8)
+            image = Image.fromarray(raster_image, 'L')
+            image.save(f'./data/images/labels/{polygon_id}.png')
+        instrumentation.add_bytes_written(f'./data/images/labels/{polygon_id}.png')
+
+        # Define the output path for the modified raster
+        output_raster_path = f'./data/processed/labels/{polygon_id}.tif'
 
         # Save the raster
-        with rasterio.open(
+        with instrumentation.stage('write_label', polygon_id), rasterio.open(
                 output_raster_path, 'w',
-                driver='GTiff',
                 height=raster_data.shape[0],
                 width=raster_data.shape[1],
                 count=1,  # number of bands
                 dtype=raster_data.dtype,
-                crs=src.crs,
-                transform=src.transform,
+                crs=crs,
+                transform=transform,
+                **get_output_profile(raster_data.dtype, is_label=True),
         ) as dst:
             dst.write(raster_data, 1)
+        instrumentation.add_bytes_written(output_raster_path)
+
+    def write_label_to_disk(self, polygon_id: str):
+        # Path to your raster file
+        raster_path = f'./data/processed/masked_feature_bands/{polygon_id}_bands.tif'
+
+        # Only the metadata of the features is needed, the label starts as zeros
+        with rasterio.open(raster_path) as src:
+            shape = (src.height, src.width)
+            bounds = src.bounds
+            transform = src.transform
+            crs = src.crs
+            dtype = src.dtypes[0]
+
+        limits = (bounds.left, bounds.bottom, bounds.right, bounds.top)
+        raster_data = self.build_label(polygon_id, shape, limits, transform, dtype)
+        self.write_label(polygon_id, raster_data, crs, transform)
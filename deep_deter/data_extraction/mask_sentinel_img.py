@@ -1,20 +1,66 @@
 import os
 import sys
+from functools import lru_cache
 from dotenv import load_dotenv
-import ee.imagecollection
 from typing import List
-import rasterio
-from rasterio.windows import from_bounds
-from rasterio.plot import show
 import numpy as np
+from deep_deter.data_extraction.prodes_reader import get_prodes_reader
 
 load_dotenv()
-
-# EE authentication
 sys.path.insert(0, os.getenv('PROJECT_PATH'))
-earth_engine_project = os.getenv('GOOGLE_PROJECT')
-ee.Authenticate()
-ee.Initialize(project=earth_engine_project)
+
+
+# "Ano Prodes" ends at YYYY-07-31 see:
+# http://mtc-m21d.sid.inpe.br/col/sid.inpe.br/mtc-m21d/2022/08.25.11.46/doc/thisInformationItemHomePage.html
+# Page 16
+# See PDDigital.txt file
+# 32 = Clouds, 91 = Rivers, 101 = Not-forest
+ALWAYS_MASKED_PIXELS = [32, 91, 101]
+
+# PRODES year -> classes added to the mask once that year has ended
+# dYYYY = deforestation, rYYYY = residual deforestation
+PRODES_YEAR_PIXELS = {
+    2007: [7],  # d2007
+    2008: [8],  # d2008
+    2009: [9],  # d2009
+    2010: [50, 10],  # r2010, d2010
+    2011: [51, 11],  # r2011, d2011
+    2012: [52, 12],  # r2012, d2012
+    2013: [53, 13],  # r2013, d2013
+    2014: [54, 14],  # r2014, d2014
+    2015: [55, 15],  # r2015, d2015
+    2016: [56, 16],  # r2016, d2016
+    2017: [57, 17],  # r2017, d2017
+    2018: [58, 18],  # r2018, d2018
+    2019: [59, 19],  # r2019, d2019
+    2020: [60, 20],  # r2020, d2020
+    2021: [61, 21],  # r2021, d2021
+    2022: [22],  # d2022
+}
+
+
+def get_last_prodes_year(ref_date: str) -> int:
+    """
+    Last PRODES year that ended strictly before ref_date ('YYYY-MM-DD').
+    """
+    year = int(ref_date[:4])
+    return year if ref_date[5:10] > '07-31' else year - 1
+
+
+@lru_cache(maxsize=None)
+def get_prodes_lookup_table(last_prodes_year: int) -> np.ndarray:
+    """
+    256 entry table, True for every 8 bit PRODES class that is masked after last_prodes_year.
+    Masking a window is then a single lookup_table[window] pass.
+    """
+    lookup_table = np.zeros(256, dtype=bool)
+    lookup_table[ALWAYS_MASKED_PIXELS] = True
+    for year, pixels in PRODES_YEAR_PIXELS.items():
+        if year <= last_prodes_year:
+            lookup_table[pixels] = True
+
+    lookup_table.setflags(write=False)  # Shared between calls
+    return lookup_table
 
 
 class GetCorrectProdesMask:
@@ -28,72 +74,34 @@ class GetCorrectProdesMask:
         self.ref_date = ref_date
 
     def _read_filtered_prodes_raster(self, shape):
-        with rasterio.open(self.prodes_path) as dataset:
-            window = from_bounds(*self.limits, transform=dataset.transform)
-            windowed_data = dataset.read(1, window=window, out_shape=shape)  # Nearest Neighbors
-            return windowed_data
+        # The PRODES raster stays open per process and decoded tiles are cached between alerts
+        return get_prodes_reader(self.prodes_path).read_window(self.limits, shape)  # Nearest Neighbors
 
     def _get_raster_pixels(self) -> List[int]:
-        # "Ano Prodes" ends at YYYY-07-31 see:
-        # http://mtc-m21d.sid.inpe.br/col/sid.inpe.br/mtc-m21d/2022/08.25.11.46/doc/thisInformationItemHomePage.html
-        # Page 16
-
-        # See PDDigital.txt file
-        # 32 = Clouds, 91 = Rivers, 101 = Not-forest
-        raster_pixels = [32, 91, 101]
-
-        if self.ref_date > '2007-07-31':
-            raster_pixels.append(7)  # d2007
-        if self.ref_date > '2008-07-31':
-            raster_pixels.append(8)  # d2008
-        if self.ref_date > '2009-07-31':
-            raster_pixels.append(9)  # d2009
-        if self.ref_date > '2010-07-31':
-            raster_pixels.append(50)  # r2010
-            raster_pixels.append(10)  # d2010
-        if self.ref_date > '2011-07-31':
-            raster_pixels.append(51)  # r2011
-            raster_pixels.append(11)  # d2011
-        if self.ref_date > '2012-07-31':
-            raster_pixels.append(52)  # r2012
-            raster_pixels.append(12)  # d2012
-        if self.ref_date > '2013-07-31':
-            raster_pixels.append(53)  # r2013
-            raster_pixels.append(13)  # d2013
-        if self.ref_date > '2014-07-31':
-            raster_pixels.append(54)  # r2014
-            raster_pixels.append(14)  # d2014
-        if self.ref_date > '2015-07-31':
-            raster_pixels.append(55)  # r2015
-            raster_pixels.append(15)  # d2015
-        if self.ref_date > '2016-07-31':
-            raster_pixels.append(56)  # r2016
-            raster_pixels.append(16)  # d2016
-        if self.ref_date > '2017-07-31':
-            raster_pixels.append(57)  # r2017
-            raster_pixels.append(17)  # d2017
-        if self.ref_date > '2018-07-31':
-            raster_pixels.append(58)  # r2018
-            raster_pixels.append(18)  # d2018
-        if self.ref_date > '2019-07-31':
-            raster_pixels.append(59)  # r2019
-            raster_pixels.append(19)  # d2019
-        if self.ref_date > '2020-07-31':
-            raster_pixels.append(60)  # r2020
-            raster_pixels.append(20)  # d2020
-        if self.ref_date > '2021-07-31':
-            raster_pixels.append(61)  # r2021
-            raster_pixels.append(21)  # d2021
-        if self.ref_date > '2022-07-31':
-            raster_pixels.append(22)  # d2022
-
-        return raster_pixels
-
-    def get_mask(self, shape) -> ee.image.Image:
+        """
+        PRODES classes that should be masked for self.ref_date
+        """
+        return np.flatnonzero(get_prodes_lookup_table(get_last_prodes_year(self.ref_date))).tolist()
+
+    def get_mask(self, shape) -> np.ndarray:
         clipped_prodes = self._read_filtered_prodes_raster(shape)
-        pixels_to_enter_mask = self._get_raster_pixels()
+        lookup_table = get_prodes_lookup_table(get_last_prodes_year(self.ref_date))
+
+        if clipped_prodes.dtype != np.uint8:
+            # The lookup table only covers 8 bit classes
+            return np.isin(clipped_prodes, np.flatnonzero(lookup_table))
+        return lookup_table[clipped_prodes]
 
-        combined_mask = np.zeros_like(clipped_prodes)
-        mask = np.isin(clipped_prodes, pixels_to_enter_mask)
+    def get_masks(self, shape, ref_dates: List[str]) -> np.ndarray:
+        """
+        Masks for several reference dates over the same window, the PRODES window is read once.
+        :param shape: (height, width) of the output
+        :param ref_dates: Reference dates in the format 'YYYY-MM-DD'
+        :return: A boolean array of shape (len(ref_dates), height, width)
+        """
+        clipped_prodes = self._read_filtered_prodes_raster(shape)
+        lookup_tables = np.stack([get_prodes_lookup_table(get_last_prodes_year(d)) for d in ref_dates])
 
-        return mask
+        if clipped_prodes.dtype != np.uint8:
+            return np.stack([np.isin(clipped_prodes, np.flatnonzero(lut)) for lut in lookup_tables])
+        return lookup_tables[:, clipped_prodes]
@@ -0,0 +1,51 @@
+# Std.Lib.
+import os
+
+# Data Science
+import numpy as np
+
+# Reads .env file, optionally add:
+# OUTPUT_PROFILE = 'cog' (default), 'cog_zstd' or 'plain' for the processed bands and labels
+from dotenv import load_dotenv
+load_dotenv()
+OUTPUT_PROFILE = os.getenv('OUTPUT_PROFILE', 'cog')
+
+# Creation options of the processed GeoTIFFs.
+# 'cog' writes Cloud-Optimized GeoTIFFs: internal 256x256 tiles, compression with a predictor
+# and overview pyramids, so windowed and patch reads only decode the tiles they touch.
+# 'plain' keeps the previous striped, uncompressed GTiff.
+# Compression stays single-threaded: files are written from pool workers, one per core already.
+OUTPUT_PROFILES = {
+    'plain': {
+        'driver': 'GTiff',
+    },
+    'cog': {
+        'driver': 'COG',
+        'blocksize': 256,
+        'compress': 'DEFLATE',
+        'overviews': 'AUTO',
+    },
+    'cog_zstd': {
+        'driver': 'COG',
+        'blocksize': 256,
+        'compress': 'ZSTD',
+        'overviews': 'AUTO',
+    },
+}
+
+
+def get_output_profile(dtype: str, is_label: bool = False, profile_name: str = OUTPUT_PROFILE) -> dict:
+    """
+    Creation options to pass to rasterio.open(..., 'w', **profile).
+    :param dtype: dtype of the raster, selects the predictor (floating point or horizontal differencing)
+    :param is_label: Labels are categorical, so their overviews use nearest instead of average
+    :param profile_name: One of OUTPUT_PROFILES
+    """
+    if profile_name not in OUTPUT_PROFILES:
+        raise ValueError(f'Unknown output profile {profile_name}, expected one of {list(OUTPUT_PROFILES)}')
+
+    profile = OUTPUT_PROFILES[profile_name].copy()
+    if profile['driver'] == 'COG':
+        profile['predictor'] = 'FLOATING_POINT' if np.issubdtype(np.dtype(dtype), np.floating) else 'STANDARD'
+        profile['overview_resampling'] = 'NEAREST' if is_label else 'AVERAGE'
+    return profile
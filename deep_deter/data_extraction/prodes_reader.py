@@ -0,0 +1,130 @@
+# Std.Lib.
+import os
+from collections import OrderedDict
+from typing import Dict, Tuple
+
+# Data Science
+import numpy as np
+import rasterio
+from rasterio.windows import Window, from_bounds
+
+# Reads .env file, optionally add:
+# PRODES_CACHE_MB = memory budget for decoded PRODES tiles per process (defaults to 256)
+from dotenv import load_dotenv
+load_dotenv()
+PRODES_CACHE_MB = int(os.getenv('PRODES_CACHE_MB', 256))
+PRODES_TILE_SIZE = 1024
+
+
+class ProdesReader:
+    """
+    Long lived reader for the PRODES raster.
+    The dataset is opened once and decoded tiles of PRODES_TILE_SIZE x PRODES_TILE_SIZE pixels
+    are kept in an LRU cache bounded by a memory budget, so neighbouring alerts that read
+    overlapping windows do not open and decompress the same region again.
+    Not thread safe, use one reader per process (see get_prodes_reader).
+    """
+    prodes_path: str
+    cache_bytes: int
+    tile_size: int
+
+    def __init__(self,
+                 prodes_path: str,
+                 cache_mb: int = PRODES_CACHE_MB,
+                 tile_size: int = PRODES_TILE_SIZE,
+                 ):
+        self.prodes_path = prodes_path
+        self.cache_bytes = cache_mb * 2**20
+        self.tile_size = tile_size
+        self.dataset = rasterio.open(prodes_path)
+
+        self._tiles = OrderedDict()
+        self._used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _get_tile(self, tile_row: int, tile_col: int) -> np.ndarray:
+        key = (tile_row, tile_col)
+        tile = self._tiles.get(key)
+        if tile is not None:
+            self._tiles.move_to_end(key)
+            self.hits += 1
+            return tile
+
+        self.misses += 1
+        row_off = tile_row * self.tile_size
+        col_off = tile_col * self.tile_size
+        window = Window(
+            col_off,
+            row_off,
+            min(self.tile_size, self.dataset.width - col_off),
+            min(self.tile_size, self.dataset.height - row_off),
+        )
+        tile = self.dataset.read(1, window=window)
+
+        self._tiles[key] = tile
+        self._used_bytes += tile.nbytes
+        while self._used_bytes > self.cache_bytes and len(self._tiles) > 1:
+            _, evicted = self._tiles.popitem(last=False)
+            self._used_bytes -= evicted.nbytes
+        return tile
+
+    def read_native(self, row_start: int, row_stop: int, col_start: int, col_stop: int) -> np.ndarray:
+        """
+        Reads a block of pixels at the native resolution from the cached tiles.
+        Pixels outside of the raster are filled with 0.
+        """
+        out = np.zeros((row_stop - row_start, col_stop - col_start), dtype=self.dataset.dtypes[0])
+
+        # Clip to the raster, anything outside stays 0
+        rows = (max(row_start, 0), min(row_stop, self.dataset.height))
+        cols = (max(col_start, 0), min(col_stop, self.dataset.width))
+        if rows[0] >= rows[1] or cols[0] >= cols[1]:
+            return out
+
+        for tile_row in range(rows[0] // self.tile_size, (rows[1] - 1) // self.tile_size + 1):
+            for tile_col in range(cols[0] // self.tile_size, (cols[1] - 1) // self.tile_size + 1):
+                tile = self._get_tile(tile_row, tile_col)
+                tile_row_off = tile_row * self.tile_size
+                tile_col_off = tile_col * self.tile_size
+
+                r0 = max(rows[0], tile_row_off)
+                r1 = min(rows[1], tile_row_off + tile.shape[0])
+                c0 = max(cols[0], tile_col_off)
+                c1 = min(cols[1], tile_col_off + tile.shape[1])
+                out[r0 - row_start:r1 - row_start, c0 - col_start:c1 - col_start] = \
+                    tile[r0 - tile_row_off:r1 - tile_row_off, c0 - tile_col_off:c1 - tile_col_off]
+        return out
+
+    def read_window(self, limits: Tuple[float, float, float, float], shape: Tuple[int, int]) -> np.ndarray:
+        """
+        Same result as dataset.read(1, window=from_bounds(*limits), out_shape=shape),
+        nearest neighbour resampling, served from the tile cache.
+        :param limits: (left, bottom, right, top) in the PRODES CRS
+        :param shape: (height, width) of the output
+        """
+        window = from_bounds(*limits, transform=self.dataset.transform)
+        out_height, out_width = shape
+
+        # Source pixel whose center is nearest to the center of every output pixel
+        src_rows = np.floor(window.row_off + (np.arange(out_height) + 0.5) * window.height / out_height).astype(int)
+        src_cols = np.floor(window.col_off + (np.arange(out_width) + 0.5) * window.width / out_width).astype(int)
+
+        native = self.read_native(src_rows[0], src_rows[-1] + 1, src_cols[0], src_cols[-1] + 1)
+        return native[np.ix_(src_rows - src_rows[0], src_cols - src_cols[0])]
+
+    def close(self) -> None:
+        self.dataset.close()
+        self._tiles.clear()
+        self._used_bytes = 0
+
+
+# One reader per (process, file), a reader inherited through fork is never reused
+_readers: Dict[Tuple[int, str], ProdesReader] = {}
+
+
+def get_prodes_reader(prodes_path: str) -> ProdesReader:
+    key = (os.getpid(), str(prodes_path))
+    if key not in _readers:
+        _readers[key] = ProdesReader(str(prodes_path))
+    return _readers[key]
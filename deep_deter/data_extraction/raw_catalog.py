@@ -0,0 +1,172 @@
+# Std.Lib.
+import json
+import os
+import threading
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Union
+
+# Bands saved for every polygon as {polygon_id}_{band}_band.tif
+RAW_BAND_NAMES = ('blue', 'green', 'red', 'nir')
+CATALOG_FILE_NAME = 'catalog.jsonl'
+
+
+class RawCatalog:
+    """
+    Persistent record of the raw bands downloaded to ./data/raw/.
+    Every download appends one line to catalog.jsonl, so recording is O(1) and
+    the processing stages can look polygons up without globbing the directory.
+    If the catalog does not exist yet (e.g. data downloaded before it was introduced) or the
+    directory changed after the last catalog write (bands deleted or copied by hand, a run killed
+    between writing a band and recording it) it is rebuilt from a single scan of the directory.
+    Worker processes get a read-only catalog that the parent refreshed before starting them,
+    so they never rebuild and rewrite the same file concurrently.
+    """
+    path_raw_bands: Path
+    catalog_file: Path
+    entries: Dict[str, dict]
+    read_only: bool
+
+    def __init__(self, path_raw_bands: Union[str, Path] = './data/raw/', read_only: bool = False):
+        """
+        :param read_only: Only load the catalog as it is on disk, it is never rebuilt nor written to
+        """
+        self.path_raw_bands = Path(path_raw_bands)
+        self.catalog_file = self.path_raw_bands/CATALOG_FILE_NAME
+        self.read_only = read_only
+        self._lock = threading.Lock()
+        self.entries = {}
+
+        if self.catalog_file.exists():
+            self._load()
+        if not read_only:
+            self.refresh()
+
+    def __getstate__(self) -> dict:
+        # Sent to worker processes, the lock is not picklable and each copy gets its own
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _check_writable(self) -> None:
+        if self.read_only:
+            raise RuntimeError(f'The raw band catalog {self.catalog_file} was opened read-only')
+
+    def _is_stale(self) -> bool:
+        # Adding, removing or renaming a band updates the directory mtime, appending to the catalog does not
+        return self.path_raw_bands.stat().st_mtime_ns > self.catalog_file.stat().st_mtime_ns
+
+    def _load(self) -> None:
+        with open(self.catalog_file) as f:
+            for line in f:
+                # A line can be cut short if a run was killed while writing it
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self.entries[entry['polygon_id']] = entry
+
+    def refresh(self) -> None:
+        """
+        Rebuilds the catalog if it does not exist or is stale
+        """
+        if not self.catalog_file.exists() or self._is_stale():
+            self.rebuild()
+
+    @staticmethod
+    def _get_band_entry(band_path: Path) -> dict:
+        return {'file': band_path.name, 'size': band_path.stat().st_size}
+
+    def rebuild(self) -> None:
+        """
+        Scans ./data/raw/ once and rewrites the catalog from what is on disk.
+        Download parameters already recorded for a polygon are kept.
+        """
+        self._check_writable()
+        print(f'Building raw band catalog from {self.path_raw_bands}...')
+        bands_per_id = defaultdict(dict)
+        for file in self.path_raw_bands.glob('*_band.tif'):
+            parts = file.name.split('_')
+            polygon_id = parts[0] + '_' + parts[1]
+            bands_per_id[polygon_id][parts[2]] = self._get_band_entry(file)
+
+        with self._lock:
+            previous_entries = self.entries
+            self.entries = {}
+            for polygon_id, bands in bands_per_id.items():
+                mtime = max((self.path_raw_bands/band['file']).stat().st_mtime for band in bands.values())
+                self.entries[polygon_id] = {
+                    'polygon_id': polygon_id,
+                    'bands': bands,
+                    'downloaded_at': datetime.fromtimestamp(mtime).isoformat(timespec='seconds'),
+                }
+                if 'params' in previous_entries.get(polygon_id, {}):
+                    self.entries[polygon_id]['params'] = previous_entries[polygon_id]['params']
+
+            os.makedirs(self.path_raw_bands, exist_ok=True)
+            tmp_file = self.catalog_file.with_suffix('.jsonl.tmp')
+            with open(tmp_file, 'w') as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry) + '\n')
+            os.replace(tmp_file, self.catalog_file)
+            # The rename itself updates the directory mtime, the catalog must not look stale because of it
+            self.catalog_file.touch()
+
+    def record_download(self,
+                        polygon_id: str,
+                        band_paths: Dict[str, Path],
+                        params: Union[dict, None] = None,
+                        ) -> None:
+        """
+        Registers the bands of a polygon that were just written to disk.
+        Safe to call from several download threads.
+        :param polygon_id: The FID of the DETER alert
+        :param band_paths: band name -> path of the saved band
+        :param params: Parameters used for the download (cloud percentage, lookback days...)
+        """
+        self._check_writable()
+        entry = {
+            'polygon_id': polygon_id,
+            'bands': {band: self._get_band_entry(Path(path)) for band, path in band_paths.items()},
+            'params': params if params is not None else {},
+            'downloaded_at': datetime.now().isoformat(timespec='seconds'),
+        }
+        with self._lock:
+            self.entries[polygon_id] = entry
+            with open(self.catalog_file, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    def is_complete(self, polygon_id: str) -> bool:
+        """
+        All of R + G + B + NIR were saved and none of them is empty.
+        """
+        entry = self.entries.get(polygon_id)
+        if entry is None:
+            return False
+        bands = entry['bands']
+        return all(band in bands and bands[band]['size'] > 0 for band in RAW_BAND_NAMES)
+
+    def get_complete_ids(self) -> List[str]:
+        return [polygon_id for polygon_id in self.entries if self.is_complete(polygon_id)]
+
+    def get_params(self, polygon_id: str) -> dict:
+        """
+        Download parameters of a polygon, empty if unknown (e.g. rebuilt from disk)
+        """
+        entry = self.entries.get(polygon_id)
+        return entry.get('params', {}) if entry is not None else {}
+
+    def get_band_paths(self, polygon_id: str) -> List[Path]:
+        """
+        Paths of the raw bands of a polygon, sorted by file name (blue, green, nir, red).
+        :return: An empty list if the polygon is not in the catalog
+        """
+        entry = self.entries.get(polygon_id)
+        if entry is None:
+            return []
+        return sorted(self.path_raw_bands/band['file'] for band in entry['bands'].values())
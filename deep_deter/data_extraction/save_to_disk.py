@@ -1,31 +1,47 @@
 # Std.Lib.
 import os
 import sys
-from typing import Union
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, Tuple, Union
 
 # Data Science and Earth Engine
 import geopandas.geodataframe
 import ee
-import geemap
+import rasterio
+import requests
 
 # Custom functions
-from deep_deter.data_extraction.custom_error import NoImagesError
+from deep_deter.data_extraction.alert_index import AlertIndex
+from deep_deter.data_extraction.composite_cache import CompositeCache, crop_to_bounds
+from deep_deter.data_extraction.custom_error import ExportFailedError, NoImagesError, RetriesExhaustedError
+from deep_deter.data_extraction.download_planner import DownloadCluster, plan_download_clusters
+from deep_deter.data_extraction.ee_scheduler import atomic_write, get_ee_scheduler
+from deep_deter.data_extraction.ee_session import initialize_ee
 from deep_deter.data_extraction.fetch_sentinel_img import FetchSentinelImg
-from deep_deter.data_extraction.utils import get_rectangle_around_polygon
+from deep_deter.data_extraction.instrumentation import instrumentation
+from deep_deter.data_extraction.raw_catalog import RawCatalog
+from deep_deter.data_extraction.utils import get_bounds_around_polygon, plan_export_chunks
 
 # Environment variables
 # Reads .env file. You need to create a .env file and add:
-# GOOGLE_PROJECT=your_project_name
 # PROJECT_PATH=/your/path/to/project
 from dotenv import load_dotenv
 load_dotenv()
-EE_PROJECT = os.getenv('GOOGLE_PROJECT')
 PROJECT_PATH = os.getenv('PROJECT_PATH')
 sys.path.insert(0, PROJECT_PATH)
 
-# EE authentication
-ee.Authenticate()
-ee.Initialize(project=EE_PROJECT)
+# Band name on disk -> Sentinel-2 band, in the order they are requested from Earth Engine
+# https://developers.google.com/earth-engine/datasets/catalog/COPERNICUS_S2_SR_HARMONIZED#bands
+RAW_BANDS = {
+    'blue': 'B2',
+    'green': 'B3',
+    'red': 'B4',
+    'nir': 'B8',  # NIR (Near Infrared)
+}
+PATH_RAW = Path('data/raw')
 
 
 class SaveToDisk:
@@ -36,78 +52,376 @@ class SaveToDisk:
     It can be a random polygon or deterministic.
     """
     deter_gdf: geopandas.geodataframe.GeoDataFrame
+    alert_index: AlertIndex
+    raw_catalog: RawCatalog
     curr_polygon: geopandas.geodataframe.GeoDataFrame
 
-    def __init__(self, deter_gdf: geopandas.geodataframe.GeoDataFrame):
+    def __init__(self,
+                 deter_gdf: geopandas.geodataframe.GeoDataFrame,
+                 alert_index: Union[AlertIndex, None] = None,
+                 raw_catalog: Union[RawCatalog, None] = None,
+                 ee_client=None,
+                 ):
         """
         :param deter_gdf: The gdf from the Deter dataset
+        :param alert_index: An AlertIndex over deter_gdf, built here if not given
+        :param raw_catalog: The catalog of ./data/raw/ that is updated after every download
+        :param ee_client: Passed to FetchSentinelImg, the real Earth Engine session is only
+        initialized when it is not given
         """
         self.deter_gdf = deter_gdf
+        self.alert_index = alert_index if alert_index is not None else AlertIndex(deter_gdf)
+        self.raw_catalog = raw_catalog if raw_catalog is not None else RawCatalog(PATH_RAW)
+        self.scheduler = get_ee_scheduler()
+        if ee_client is None:
+            initialize_ee()
 
         # Initial random row to instantiate fetch_sentinel_img
         self.curr_polygon = self._get_random_row()
         self.fetch_sentinel_img = FetchSentinelImg(
             max_allowed_cloud_percentage=20,
             max_allowed_lookback_days=14,
+            ee_client=ee_client,
+            scheduler=self.scheduler,
+        )
+        self.composite_cache = CompositeCache(
+            bands=list(RAW_BANDS.values()),
+            export=lambda image, path, bounds: self._export_bands(image, path, bounds, 'export_tiles'),
+            ee_client=ee_client,
         )
 
     def _get_random_row(self) -> geopandas.geodataframe.GeoDataFrame:
         return self.deter_gdf.sample(1)
 
-    def main(self, n_iterations: int = 10, deterministic_id: Union[str, None] = None) -> None:
+    def _split_multiband_to_disk(self,
+                                 multiband_path: Path,
+                                 alert_id: str,
+                                 extra_params: Union[dict, None] = None,
+                                 ) -> None:
+        """
+        Splits a multi-band GeoTIFF into one file per band, keeping the
+        {alert_id}_{band}_band.tif layout the rest of the pipeline expects,
+        and registers them in the raw band catalog.
+        Every band is written to a temporary file and renamed once complete, so an
+        interrupted run never leaves a partial band under its final name.
+        :param multiband_path: The GeoTIFF with the bands in RAW_BANDS order
+        :param alert_id: The FID of the DETER alert
+        :param extra_params: Download parameters recorded on top of the cloud percentage and lookback,
+        set when the bands were cropped from a composite shared with other alerts
+        """
+        band_paths = {}
+        with rasterio.open(multiband_path) as src:
+            out_meta = src.meta.copy()
+            out_meta.update(count=1)
+
+            for i, band in enumerate(RAW_BANDS, 1):
+                band_paths[band] = PATH_RAW/f'{alert_id}_{band}_band.tif'
+                with atomic_write(band_paths[band]) as tmp_path:
+                    with rasterio.open(tmp_path, 'w', **out_meta) as dest:
+                        dest.write(src.read(i), 1)
+                instrumentation.add_bytes_written(band_paths[band])
+
+        params = {
+            'cloud_pct': self.fetch_sentinel_img.cloud_pct,
+            'max_lookback': self.fetch_sentinel_img.max_lookback,
+        }
+        params.update(extra_params or {})
+        self.raw_catalog.record_download(alert_id, band_paths, params=params)
+
+    @staticmethod
+    def _export_multiband(image, multiband_path: Path, region) -> None:
+        """
+        A single getDownloadURL request, the same one geemap.ee_export_image sends.
+        geemap only prints the errors, here they are raised with their cause so the scheduler can tell
+        throttling (429, quota) from failures that would happen again (request too large, bad region...)
+        """
+        # Raises ee.EEException, e.g. when the request is over the size limit
+        url = image.getDownloadURL({
+            'name': multiband_path.stem,
+            'scale': 10,
+            'region': region,
+            'filePerBand': False,
+            'format': 'GEO_TIFF',
+        })
+        response = requests.get(url, timeout=300)
+        if response.status_code != 200:
+            raise ExportFailedError(f'HTTP {response.status_code} {response.reason}: {response.text[:200]}')
+        with open(multiband_path, 'wb') as f:
+            f.write(response.content)
+
+    def _export_bands(self,
+                      image: ee.image.Image,
+                      multiband_path: Path,
+                      bounds: Tuple[float, float, float, float],
+                      name: str = 'export_image',
+                      ) -> None:
+        """
+        Exports the RAW_BANDS of image inside bounds to multiband_path through the scheduler.
+        Exports over the Earth Engine download limit are split by band and, if a single band is
+        still too large, by region (see plan_export_chunks) and put back together locally,
+        so an oversized request is never sent just to fail.
+        :param name: Name of the requests in the run report
+        Raises RetriesExhaustedError if one of the requests kept failing
+        """
+        chunks = plan_export_chunks(bounds, len(RAW_BANDS))
+        get_region = lambda b: self.fetch_sentinel_img.ee_api.Geometry.Rectangle([(b[0], b[1]), (b[2], b[3])])
+        if len(chunks) == 1:
+            self.scheduler.call(name, self._export_multiband, image, multiband_path, get_region(bounds))
+            return
+
+        instrumentation.count(f'split_exports.{name}')
+        instrumentation.count(f'split_export_requests.{name}', len(chunks))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            band_paths_per_tile = defaultdict(dict)
+            for i, (tile_bounds, bands) in enumerate(chunks):
+                chunk_path = Path(tmp_dir)/f'chunk_{i}.tif'
+                self.scheduler.call(name, self._export_multiband, image.select(bands), chunk_path, get_region(tile_bounds))
+                for index, band in enumerate(bands, 1):
+                    band_paths_per_tile[tile_bounds][band] = (chunk_path, index)
+
+            # Every tile gets all bands back in RAW_BANDS order, then the tiles are mosaicked
+            tile_paths = []
+            for i, band_paths in enumerate(band_paths_per_tile.values()):
+                tile_paths.append(Path(tmp_dir)/f'tile_{i}.tif')
+                with rasterio.open(band_paths[0][0]) as src:
+                    out_meta = src.meta.copy()
+                out_meta.update(count=len(RAW_BANDS))
+                with rasterio.open(tile_paths[-1], 'w', **out_meta) as dest:
+                    for band, (chunk_path, index) in sorted(band_paths.items()):
+                        with rasterio.open(chunk_path) as src:
+                            dest.write(src.read(index), band + 1)
+
+            if len(tile_paths) == 1:
+                os.replace(tile_paths[0], multiband_path)
+            else:
+                crop_to_bounds(tile_paths, bounds, multiband_path)
+
+    def _export_from_composite_cache(self,
+                                     current_deter_alert: geopandas.geodataframe.GeoDataFrame,
+                                     multiband_path: Path,
+                                     ) -> bool:
+        """
+        Crops the box around the alert from the cached composites of its date window
+        :return: False if the window is not in the cache (and COMPOSITE_CACHE does not allow fetching it)
+        or if fetching the missing tiles failed, the alert is then exported on its own
+        """
+        first_date, last_date = self.fetch_sentinel_img.get_date_window(current_deter_alert)
+        try:
+            return self.composite_cache.export_window(
+                lambda region: self.fetch_sentinel_img.get_composite(region, first_date, last_date),
+                get_bounds_around_polygon(current_deter_alert),
+                first_date,
+                last_date,
+                self.fetch_sentinel_img.cloud_pct,
+                multiband_path,
+            )
+        except (RetriesExhaustedError, ExportFailedError, ee.EEException) as e:
+            print(f'Fetching composite tiles failed ({e}), exporting the polygon on its own...')
+            instrumentation.count('composite_cache.fetch_failed')
+            return False
+
+    def _export_alert(self,
+                      current_deter_alert: geopandas.geodataframe.GeoDataFrame,
+                      n_images: Union[int, None] = None,
+                      ) -> None:
+        """
+        Pulls all bands of a single DETER alert with one Earth Engine request
+        and saves them to ./data/raw/ as one file per band.
+        :param current_deter_alert: A single row from the DETER dataset
+        :param n_images: Images available for the alert if already known from get_image_availability
+        """
+        alert_id = current_deter_alert.FID.values[0]
+        print(f'Fetching images for polygon with FID: {alert_id}')
+        with instrumentation.stage('download', alert_id):
+            self._fetch_and_export_alert(current_deter_alert, alert_id, n_images)
+
+    def _fetch_and_export_alert(self,
+                                current_deter_alert: geopandas.geodataframe.GeoDataFrame,
+                                alert_id: str,
+                                n_images: Union[int, None],
+                                ) -> None:
+        try:
+            # The box around a MultiPolygon could be cropped from the cache, but they are skipped
+            # like in the per-alert export, see below
+            if current_deter_alert.geometry.values[0].geom_type != 'Polygon':
+                raise AttributeError
+
+            # The multi-band file lives outside ./data/raw/ so a partial download is never
+            # picked up as a raw band
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                multiband_path = Path(tmp_dir)/f'{alert_id}_bands.tif'
+                print(f'Getting data for {", ".join(RAW_BANDS)}...')
+
+                # Only alerts known to have images are looked up, so a cache hit needs no request at all
+                from_cache = bool(n_images) and self._export_from_composite_cache(current_deter_alert, multiband_path)
+                if not from_cache:
+                    curr_img = self.fetch_sentinel_img.get_sentinel_img(current_deter_alert, n_images=n_images)
+
+                    # A single multi-band request instead of one round trip per band, when it fits
+                    all_bands = curr_img.select(list(RAW_BANDS.values()))
+                    try:
+                        self._export_bands(all_bands, multiband_path, get_bounds_around_polygon(current_deter_alert))
+                    except (RetriesExhaustedError, ExportFailedError, ee.EEException) as e:
+                        # Retried already if it was throttling, anything else would fail again
+                        print(f'Earth Engine export failed for polygon {alert_id} ({e}), skipping...')
+                        instrumentation.count('export_failed')
+                        return
+
+                extra_params = {'composite_tile_degrees': self.composite_cache.tile_degrees} if from_cache else None
+                self._split_multiband_to_disk(multiband_path, alert_id, extra_params)
+
+        except RetriesExhaustedError as e:
+            # Throttled or unreachable for too long, the alert can be fetched again in a later run
+            print(f'Earth Engine kept failing for polygon {alert_id} ({e}), skipping...')
+            instrumentation.count('ee_failed')
+        except NoImagesError:
+            # This can happen if no images match the constraints of FetchSentinelImg
+            # (Too many clouds the last X days, etc.)
+            # Could also be caused by data not being available on those dates as well.
+            print('No images were returned for this polygon, skipping...')
+            instrumentation.count('no_images')
+        except AttributeError:
+            # We are ignoring multipolygons as they are rare (<1% of all alerts) and
+            # could introduce more difficulties in the data processing, we have enough
+            # data as it is.
+            print('An image was a MultiPolygon and was ignored, skipping...')
+            instrumentation.count('multipolygon_skipped')
+
+    def _export_cluster_bands(self, cluster: DownloadCluster, cluster_path: Path) -> Union[dict, None]:
+        """
+        Writes the shared composite of the union box of a cluster to cluster_path,
+        from the composite cache if possible, with a single export otherwise.
+        :return: The download parameters to record for the alerts, None if the export failed
+        """
+        params = {
+            'cluster_bounds': list(cluster.bounds),
+            'cluster_dates': [cluster.first_date, cluster.last_date],
+        }
+        get_composite = lambda region: self.fetch_sentinel_img.get_composite(region, cluster.first_date, cluster.last_date)
+
+        try:
+            if self.composite_cache.export_window(get_composite, cluster.bounds, cluster.first_date, cluster.last_date,
+                                                  self.fetch_sentinel_img.cloud_pct, cluster_path):
+                params['composite_tile_degrees'] = self.composite_cache.tile_degrees
+                return params
+        except (RetriesExhaustedError, ExportFailedError, ee.EEException) as e:
+            print(f'Fetching composite tiles failed ({e}), exporting the cluster directly...')
+            instrumentation.count('composite_cache.fetch_failed')
+
+        try:
+            min_x, min_y, max_x, max_y = cluster.bounds
+            region = self.fetch_sentinel_img.ee_api.Geometry.Rectangle([(min_x, min_y), (max_x, max_y)])
+            image = get_composite(region).select(list(RAW_BANDS.values()))
+            self._export_bands(image, cluster_path, cluster.bounds, 'export_cluster')
+        except (RetriesExhaustedError, ExportFailedError, ee.EEException) as e:
+            print(f'Shared export failed ({e})')
+            instrumentation.count('cluster_export_failed')
+            return None
+        return params
+
+    def _export_cluster(self,
+                        sampled_alerts: geopandas.geodataframe.GeoDataFrame,
+                        cluster: DownloadCluster,
+                        n_images: Dict[str, int],
+                        ) -> None:
+        """
+        Exports the union box of a group of alerts once, with a composite shared by all of them,
+        and crops the box of every alert from it into its own raw band files.
+        Falls back to one export per alert if the shared export fails (e.g. throttled for too long).
+        """
+        alert_ids = [sampled_alerts.FID.values[row] for row in cluster.alert_rows]
+        print(f'Fetching images for {len(alert_ids)} polygons with a single export: {", ".join(map(str, alert_ids))}')
+
+        with instrumentation.stage('download_cluster'), tempfile.TemporaryDirectory() as tmp_dir:
+            cluster_path = Path(tmp_dir)/'cluster_bands.tif'
+            params = self._export_cluster_bands(cluster, cluster_path)
+            if params is None:
+                print('Fetching the polygons one by one...')
+                for alert_id, row in zip(alert_ids, cluster.alert_rows):
+                    self._export_alert(sampled_alerts.iloc[[row]], n_images.get(str(alert_id)))
+                return
+
+            for alert_id, row in zip(alert_ids, cluster.alert_rows):
+                multiband_path = Path(tmp_dir)/f'{alert_id}_bands.tif'
+                crop_to_bounds([cluster_path], get_bounds_around_polygon(sampled_alerts.iloc[[row]]), multiband_path)
+                self._split_multiband_to_disk(multiband_path, alert_id, params)
+        instrumentation.count('alerts_in_clusters', len(alert_ids))
+
+    def _export_planned(self,
+                        sampled_alerts: geopandas.geodataframe.GeoDataFrame,
+                        cluster: DownloadCluster,
+                        n_images: Dict[str, int],
+                        ) -> None:
+        if len(cluster.alert_rows) == 1:
+            alert = sampled_alerts.iloc[cluster.alert_rows]
+            self._export_alert(alert, n_images.get(str(alert.FID.values[0])))
+        else:
+            self._export_cluster(sampled_alerts, cluster, n_images)
+
+    def main(self,
+             n_iterations: int = 10,
+             deterministic_id: Union[str, None] = None,
+             max_workers: int = 1,
+             ) -> None:
         """
         Main is the public method responsible
         for fetching all data saving to disk
 
         :param n_iterations: Number of polygons to sample from
         :param deterministic_id: An ID that can be used to pull a single geometry
+        :param max_workers: Number of Earth Engine requests in flight at the same time
         :return: None, all channels are saved to disk instead
         """
-        for i in range(n_iterations):
+        if deterministic_id is not None:
             print('**********')
+            self._export_alert(self.alert_index.get(deterministic_id))
+            return
 
-            if deterministic_id is not None:
-                current_deter_alert = self.deter_gdf[self.deter_gdf['FID'] == deterministic_id]
-            else:
-                print(f'Running iteration {i + 1} out of {n_iterations} total iterations')
-                current_deter_alert = self._get_random_row()
-            
-            alert_id = current_deter_alert.FID.values[0]
-            print(f'Fetching images for polygon with FID: {alert_id}')
-
-            try:
-                curr_img = self.fetch_sentinel_img.get_sentinel_img(current_deter_alert)
-
-                # Get limits of the img that will be pulled to local disk
-                rectangle_pull_limits = get_rectangle_around_polygon(current_deter_alert)
-
-                all_bands = dict()
-                all_bands['blue'] = curr_img.select('B2')   # Blue
-                all_bands['green'] = curr_img.select('B3')  # Green
-                all_bands['red'] = curr_img.select('B4')    # Red
-                all_bands['nir'] = curr_img.select('B8')    # NIR (Near Infrared)
-
-                for band, band_data in all_bands.items():
-                    print(f'Getting data for {band}...')
-                    geemap.ee_export_image(
-                        band_data,
-                        filename=f'data/raw/{alert_id}_{band}_band.tif',
-                        scale=10,
-                        region=rectangle_pull_limits,
-                        file_per_band=False,
-                    )
-
-            except NoImagesError:
-                # This can happen if no images match the constraints of FetchSentinelImg
-                # (Too many clouds the last X days, etc.)
-                # Could also be caused by data not being available on those dates as well.
-                print('No images were returned for this polygon, skipping...')
-            except AttributeError:
-                # We are ignoring multipolygons as they are rare (<1% of all alerts) and
-                # could introduce more difficulties in the data processing, we have enough
-                # data as it is.
-                print('An image was a MultiPolygon and was ignored, skipping...')
-
-            if deterministic_id is not None:
-                # End the loop as this method only supports a single deterministic_id
-                break
+        # The scheduler lowers the number of requests in flight below max_workers when throttled
+        self.scheduler.set_max_concurrency(max_workers)
+
+        # One availability request for the whole sample instead of one per alert
+        sampled_alerts = self.deter_gdf.sample(min(n_iterations, len(self.deter_gdf)))
+        try:
+            availability = self.fetch_sentinel_img.get_image_availability(sampled_alerts)
+        except RetriesExhaustedError as e:
+            # Every alert then checks its own images before downloading
+            print(f'Image availability check failed ({e}), checking polygons one by one...')
+            availability = {}
+        n_images = {alert_id: alert['n_images'] for alert_id, alert in availability.items()}
+        pending = [
+            i for i, alert_id in enumerate(sampled_alerts.FID.values)
+            if n_images.get(str(alert_id)) != 0
+        ]
+        print(f'{len(sampled_alerts) - len(pending)} out of {len(sampled_alerts)} polygons have no images, skipping them...')
+        instrumentation.count('no_images', len(sampled_alerts) - len(pending))
+
+        # MultiPolygons are skipped like in the per-alert export, the planner only sees their centroid
+        is_polygon = sampled_alerts.geometry.geom_type.values == 'Polygon'
+        n_multipolygons = sum(not is_polygon[i] for i in pending)
+        if n_multipolygons:
+            print(f'{n_multipolygons} polygons are MultiPolygons, skipping them...')
+            instrumentation.count('multipolygon_skipped', n_multipolygons)
+        pending = [i for i in pending if is_polygon[i]]
+
+        # Alerts with overlapping boxes and the same date window share a single export
+        pending_alerts = sampled_alerts.iloc[pending]
+        clusters = plan_download_clusters(pending_alerts, self.fetch_sentinel_img.get_date_window)
+        print(f'{len(pending_alerts)} polygons planned in {len(clusters)} downloads')
+
+        if max_workers <= 1:
+            for i, cluster in enumerate(clusters):
+                print('**********')
+                print(f'Running iteration {i + 1} out of {len(clusters)} total iterations')
+                self._export_planned(pending_alerts, cluster, n_images)
+            return
+
+        # Almost all the time spent here is network wait, so threads are enough
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(self._export_planned, pending_alerts, cluster, n_images)
+                for cluster in clusters
+            ]
+            for i, future in enumerate(as_completed(futures), 1):
+                future.result()
+                print(f'Finished {i} out of {len(futures)} downloads')
@@ -1,7 +1,11 @@
 import os
 import hashlib
+import json
 import shutil
-from typing import List
+from typing import Dict, List, Sequence, Set
+
+# Upper edges of the label positive fraction bins used to stratify the split, the last bin is (0.5, 1]
+STRATA_EDGES = (0.0, 0.01, 0.05, 0.2, 0.5)
 
 
 def ensure_directories_exist(paths: List[str]):
@@ -34,9 +38,8 @@ def assign_files_to_datasets(base_dir: str, percentage_train: float):
     label_files = [f for f in os.listdir(labels_dir) if f.endswith('.tif')]
     feature_files = [f for f in os.listdir(features_dir) if f.endswith('_bands.tif')]
 
-    # Ensure the IDs match
-    ids = set(f.split('.')[0] for f in label_files)
-    assert ids == set(f.split('_bands')[0] for f in feature_files), "Mismatch in file IDs between labels and features"
+    # Only IDs with both a label and features, a polygon can fail in one stage and not the other
+    ids = _intersect_ids(set(f.split('.')[0] for f in label_files), set(f.split('_bands')[0] for f in feature_files))
 
     # Copy files to their respective directories based on the hash
     for file_id in ids:
@@ -57,3 +60,163 @@ def assign_files_to_datasets(base_dir: str, percentage_train: float):
         # Copy files
         shutil.move(label_src, label_dst)
         shutil.move(feature_src, feature_dst)
+
+
+def _intersect_ids(label_ids: Set[str], feature_ids: Set[str]) -> Set[str]:
+    """ IDs in both sets, the IDs missing one of the two files are logged and left out. """
+    for missing, ids in (('features', label_ids - feature_ids), ('label', feature_ids - label_ids)):
+        if ids:
+            print(f'{len(ids)} IDs have no {missing} and are left out of the split: {", ".join(sorted(ids))}')
+    return label_ids & feature_ids
+
+
+def _get_matching_ids(labels_dir: str, features_dir: str) -> List[str]:
+    """ IDs that have both a label and a feature file, sorted. """
+    label_ids = set(f.split('.')[0] for f in os.listdir(labels_dir) if f.endswith('.tif'))
+    feature_ids = set(f.split('_bands')[0] for f in os.listdir(features_dir) if f.endswith('_bands.tif'))
+    return sorted(_intersect_ids(label_ids, feature_ids))
+
+
+def _get_label_positive_fractions(labels_dir: str, ids: List[str], stats_path: str) -> Dict[str, float]:
+    """
+    Fraction of positive pixels of every label.
+    Cached in stats_path by label size and mtime, so only new or changed labels are read.
+    """
+    import rasterio
+
+    cached = {}
+    if os.path.exists(stats_path):
+        with open(stats_path) as f:
+            cached = json.load(f)
+
+    stats = {}
+    for file_id in ids:
+        label_path = os.path.join(labels_dir, f"{file_id}.tif")
+        stat = os.stat(label_path)
+        signature = [stat.st_size, stat.st_mtime]
+        if file_id in cached and cached[file_id]['signature'] == signature:
+            stats[file_id] = cached[file_id]
+            continue
+
+        with rasterio.open(label_path) as src:
+            label = src.read(1)
+        stats[file_id] = {'signature': signature, 'positive_fraction': float((label > 0).mean())}
+
+    with open(stats_path, 'w') as f:
+        json.dump(stats, f)
+    return {file_id: stat['positive_fraction'] for file_id, stat in stats.items()}
+
+
+def _get_stratum(positive_fraction: float, strata_edges: Sequence[float]) -> int:
+    """ Index of the first bin whose upper edge is >= positive_fraction. """
+    for i, edge in enumerate(strata_edges):
+        if positive_fraction <= edge:
+            return i
+    return len(strata_edges)
+
+
+def build_split_manifest(base_dir: str,
+                         percentage_train: float,
+                         stratify: bool = False,
+                         strata_edges: Sequence[float] = STRATA_EDGES,
+                         ) -> Dict[str, str]:
+    """
+    Assigns every processed ID to 'train' or 'test' and saves it to model_inputs/split_manifest.json.
+    No file is moved or copied, so re-splitting is only metadata work.
+    Without stratification every ID is assigned with the same hash threshold as assign_files_to_datasets.
+    With stratification, labels are binned by positive pixel fraction on fixed edges, the IDs of
+    every bin are ranked by hash and the lowest percentage_train% of each bin go to train, so every
+    bin is split in proportion. The rank of an ID does not depend on the other IDs, adding new ones
+    only moves the IDs next to the cut of their bin.
+    The train/test counts of every bin are saved in the manifest.
+    :return: id -> 'train' or 'test'
+    """
+    labels_dir = os.path.join(base_dir, 'processed', 'labels')
+    features_dir = os.path.join(base_dir, 'processed', 'masked_feature_bands')
+    model_inputs_dir = os.path.join(base_dir, 'model_inputs')
+    ensure_directories_exist([model_inputs_dir])
+
+    ids = _get_matching_ids(labels_dir, features_dir)
+
+    strata = None
+    if stratify:
+        stats_path = os.path.join(model_inputs_dir, 'label_stats.json')
+        fractions = _get_label_positive_fractions(labels_dir, ids, stats_path)
+
+        ids_per_stratum = [[] for _ in range(len(strata_edges) + 1)]
+        for file_id in ids:
+            ids_per_stratum[_get_stratum(fractions[file_id], strata_edges)].append(file_id)
+
+        splits = {}
+        strata = []
+        for edge, stratum_ids in zip([*strata_edges, 1.0], ids_per_stratum):
+            stratum_ids.sort(key=lambda file_id: (hash_file_id(file_id), file_id))
+            n_train = round(len(stratum_ids) * percentage_train / 100)
+            for rank, file_id in enumerate(stratum_ids):
+                splits[file_id] = 'train' if rank < n_train else 'test'
+            strata.append({'max_positive_fraction': edge, 'train': n_train, 'test': len(stratum_ids) - n_train})
+        splits = {file_id: splits[file_id] for file_id in ids}
+    else:
+        splits = {file_id: 'train' if hash_file_id(file_id) < percentage_train else 'test' for file_id in ids}
+
+    manifest = {
+        'percentage_train': percentage_train,
+        'stratify': stratify,
+        'strata': strata,
+        'labels_dir': labels_dir,
+        'features_dir': features_dir,
+        'splits': splits,
+    }
+    manifest_path = os.path.join(model_inputs_dir, 'split_manifest.json')
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    n_train = sum(split == 'train' for split in splits.values())
+    print(f'Split manifest written to {manifest_path}: {n_train} train, {len(splits) - n_train} test')
+    return splits
+
+
+def materialize_split(base_dir: str, mode: str = 'symlink') -> None:
+    """
+    Optionally exposes the split manifest as the model_inputs/{train,test}_{features,labels} directories
+    using hardlinks or symlinks to the processed files, nothing is copied.
+    Links left over from a previous split are removed, regular files are never touched.
+    :param mode: 'symlink' or 'hardlink'
+    """
+    if mode not in ('symlink', 'hardlink'):
+        raise ValueError("mode must be either 'symlink' or 'hardlink'")
+
+    model_inputs_dir = os.path.join(base_dir, 'model_inputs')
+    with open(os.path.join(model_inputs_dir, 'split_manifest.json')) as f:
+        manifest = json.load(f)
+
+    expected = {}
+    for file_id, split in manifest['splits'].items():
+        expected[os.path.join(model_inputs_dir, f'{split}_labels', f"{file_id}.tif")] = \
+            os.path.join(manifest['labels_dir'], f"{file_id}.tif")
+        expected[os.path.join(model_inputs_dir, f'{split}_features', f"{file_id}_bands.tif")] = \
+            os.path.join(manifest['features_dir'], f"{file_id}_bands.tif")
+
+    split_dirs = [os.path.join(model_inputs_dir, d)
+                  for d in ('train_labels', 'test_labels', 'train_features', 'test_features')]
+    ensure_directories_exist(split_dirs)
+
+    for split_dir in split_dirs:
+        for file_name in os.listdir(split_dir):
+            path = os.path.join(split_dir, file_name)
+            is_link = os.path.islink(path) or os.stat(path).st_nlink > 1
+            if is_link and expected.get(path) is None:
+                os.remove(path)
+
+    for dst, src in expected.items():
+        if os.path.lexists(dst):
+            if os.path.exists(dst) and os.path.samefile(dst, src):
+                continue  # Already linked by a previous split
+            if not (os.path.islink(dst) or os.stat(dst).st_nlink > 1):
+                continue  # A regular file, e.g. moved here by assign_files_to_datasets
+            os.remove(dst)
+        if mode == 'symlink':
+            os.symlink(os.path.abspath(src), dst)
+        else:
+            os.link(src, dst)
@@ -1,5 +1,7 @@
 # Std.Lib.
+import math
 from pathlib import Path
+from typing import List, Tuple
 
 # Data Science and Earth Engine
 import geopandas.geodataframe
@@ -8,6 +10,13 @@ import rasterio
 import numpy as np
 import matplotlib.pyplot as plt
 
+# getDownloadURL refuses requests over 50331648 bytes (48 MB) of uncompressed pixels
+EE_DOWNLOAD_LIMIT_BYTES = 50331648
+# The median composites are assumed to come back as float32, so the estimate never falls short
+EXPORT_BYTES_PER_PIXEL = 4
+# Meters per degree Earth Engine uses to turn a scale in meters into an EPSG:4326 pixel size
+METERS_PER_DEGREE = 111319.49079327357
+
 
 def get_image_limits(input_img):
     input_img = input_img.getInfo()
@@ -80,6 +89,82 @@ def get_all_polygons_in_sentinel_img(image, gdf, ref_date, return_as_gdf=False):
         return feature_collection
 
 
+def get_bounds_around_polygon(curr_deter_alert: geopandas.geodataframe.GeoDataFrame,
+                              delta: float = 0.14,
+                              ) -> Tuple[float, float, float, float]:
+    """
+    (min_x, min_y, max_x, max_y) of the box of +/- delta degrees around the centroid of the alert
+    """
+    centroid = curr_deter_alert.geometry.centroid.values
+    centroid_x = centroid.x[0]
+    centroid_y = centroid.y[0]
+    return centroid_x - delta, centroid_y - delta, centroid_x + delta, centroid_y + delta
+
+
+def get_pixel_degrees(scale: float = 10) -> float:
+    """
+    Size in degrees of the EPSG:4326 pixels of an export at scale meters
+    """
+    return scale / METERS_PER_DEGREE
+
+
+def snap_bounds_to_grid(bounds: Tuple[float, float, float, float],
+                        pixel_x: float,
+                        pixel_y: float,
+                        origin: Tuple[float, float] = (0.0, 0.0),
+                        ) -> Tuple[float, float, float, float]:
+    """
+    Grows (min_x, min_y, max_x, max_y) to the edges of the pixels of a grid it overlaps,
+    so a crop or a tile never starts in the middle of a pixel
+    :param origin: (x, y) of a corner of any pixel of the grid, e.g. (transform.c, transform.f)
+    """
+    min_x, min_y, max_x, max_y = bounds
+    origin_x, origin_y = origin
+    # The tolerance keeps bounds that are already on the grid from growing by a pixel
+    return (origin_x + math.floor((min_x - origin_x) / pixel_x + 1e-6) * pixel_x,
+            origin_y + math.floor((min_y - origin_y) / pixel_y + 1e-6) * pixel_y,
+            origin_x + math.ceil((max_x - origin_x) / pixel_x - 1e-6) * pixel_x,
+            origin_y + math.ceil((max_y - origin_y) / pixel_y - 1e-6) * pixel_y)
+
+
+def plan_export_chunks(bounds: Tuple[float, float, float, float],
+                       n_bands: int,
+                       scale: float = 10,
+                       limit_bytes: int = EE_DOWNLOAD_LIMIT_BYTES,
+                       bytes_per_pixel: int = EXPORT_BYTES_PER_PIXEL,
+                       ) -> List[Tuple[Tuple[float, float, float, float], List[int]]]:
+    """
+    Splits an export into requests under the Earth Engine download limit.
+    The bands are split first and the region only when a single band does not fit,
+    in tiles whose edges fall on the pixel grid of the whole export.
+    :param bounds: (min_x, min_y, max_x, max_y) of the export in degrees
+    :return: (tile bounds, band indices) of every request, a single request covering
+    everything if the export fits
+    """
+    min_x, min_y, max_x, max_y = bounds
+    pixel = get_pixel_degrees(scale)
+    width = math.ceil((max_x - min_x) / pixel - 1e-6)
+    height = math.ceil((max_y - min_y) / pixel - 1e-6)
+
+    n_tiles = 1
+    while math.ceil(width / n_tiles) * math.ceil(height / n_tiles) * bytes_per_pixel > limit_bytes:
+        n_tiles += 1
+    tile_width, tile_height = math.ceil(width / n_tiles), math.ceil(height / n_tiles)
+    bands_per_request = min(n_bands, limit_bytes // (tile_width * tile_height * bytes_per_pixel))
+    # Same number of requests with groups of even size, e.g. 2 + 2 bands instead of 3 + 1
+    bands_per_request = math.ceil(n_bands / math.ceil(n_bands / bands_per_request))
+
+    chunks = []
+    for column in range(0, width, tile_width):
+        for row in range(0, height, tile_height):
+            tile_bounds = (min_x + column * pixel, min_y + row * pixel,
+                           min(max_x, min_x + (column + tile_width) * pixel),
+                           min(max_y, min_y + (row + tile_height) * pixel))
+            for first_band in range(0, n_bands, bands_per_request):
+                chunks.append((tile_bounds, list(range(first_band, min(n_bands, first_band + bands_per_request)))))
+    return chunks
+
+
 def get_rectangle_around_polygon(curr_deter_alert: geopandas.geodataframe.GeoDataFrame,
                                  delta: float = 0.14,
                                  ) -> ee.geometry.Geometry.Rectangle:
@@ -90,15 +175,7 @@ def get_rectangle_around_polygon(curr_deter_alert: geopandas.geodataframe.GeoDat
     :param delta: The change in degrees to get a bounding box
     :return: The rectangle around the area of interest
     """
-    centroid = curr_deter_alert.geometry.centroid.values
-    centroid_x = centroid.x[0]
-    centroid_y = centroid.y[0]
-
-    min_lat = centroid_x - delta
-    max_lat = centroid_x + delta
-
-    min_lng = centroid_y - delta
-    max_lng = centroid_y + delta
+    min_lat, min_lng, max_lat, max_lng = get_bounds_around_polygon(curr_deter_alert, delta)
 
     lower_left = (min_lat, min_lng)
     upper_right = (max_lat, max_lng)
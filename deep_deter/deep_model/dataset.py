@@ -1,36 +1,121 @@
 import os
+import json
+import random
 from PIL import Image
 from torch.utils.data import Dataset
 import numpy as np
 import rasterio
+from rasterio.windows import Window
+from tensor_cache import build_tensor_cache, get_cache_paths
+
+
+def load_split_manifest(manifest_path, split):
+    """
+    Reads the split_manifest.json written by the data extraction train/test split.
+    :param split: 'train' or 'test'
+    :return: (features_dir, labels_dir, ids of that split)
+    """
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    ids = sorted(file_id for file_id, file_split in manifest['splits'].items() if file_split == split)
+    return manifest['features_dir'], manifest['labels_dir'], ids
 
 
 class DeterDataset(Dataset):
-    def __init__(self, image_dir, mask_dir, transform=None):
+    def __init__(self, image_dir, mask_dir, transform=None, ids=None, cache_dir=None):
+        """
+        :param ids: Only use these ids from image_dir, e.g. one split of the split manifest.
+        If None every file in image_dir is used.
+        :param cache_dir: If given, every sample is converted once to .npy arrays in this directory
+        and read memory mapped afterwards, instead of decoding the GeoTIFFs every epoch.
+        """
         self.image_dir = image_dir
         self.mask_dir = mask_dir
         self.transform = transform
-        self.images = os.listdir(image_dir)
+        if ids is None:
+            self.images = os.listdir(image_dir)
+        else:
+            self.images = [f'{file_id}_bands.tif' for file_id in ids]
+
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            build_tensor_cache(image_dir, mask_dir, self.images, cache_dir)
 
     def __len__(self):
         return len(self.images)
 
-    def __getitem__(self, index):
+    def _read_sample(self, index):
+        if self.cache_dir is not None:
+            # Zero-copy: pages are shared between epochs and DataLoader workers through the page cache.
+            # Copy-on-write maps are writable, so tensors and transforms can use them without a copy
+            # and only the pages they modify are copied
+            image_cache, mask_cache = get_cache_paths(self.cache_dir, self.images[index])
+            return np.load(image_cache, mmap_mode='c'), np.load(mask_cache, mmap_mode='c')
+
         img_path = os.path.join(self.image_dir, self.images[index])
         mask_path = os.path.join(self.mask_dir, self.images[index].replace('_bands.tif', '.tif'))
 
         with rasterio.open(img_path) as src:
-            # Optional: Read and print data for each band
-            band1 = src.read(1)  # Read the first band
-            band2 = src.read(2)  # Read the second band
-            band3 = src.read(3)  # Read the third band
-            band4 = src.read(4)  # Read the third band
-
-        image = np.stack((band1, band2, band3, band4), axis=-1)
+            # All 4 bands in a single read, as (H, W, 4)
+            image = np.ascontiguousarray(src.read([1, 2, 3, 4]).transpose(1, 2, 0))
 
         with rasterio.open(mask_path) as src:
             mask = src.read(1)
 
+        return image, mask
+
+    def __getitem__(self, index):
+        image, mask = self._read_sample(index)
+
+        if self.transform is not None:
+            augmentations = self.transform(image=image, mask=mask)
+            image = augmentations['image']
+            mask = augmentations['mask']
+
+        return image, mask
+
+
+class PatchDeterDataset(Dataset):
+    """
+    Fixed-size patches read straight from the feature and label rasters with windowed reads,
+    instead of loading and resizing whole scenes. Every scene yields patches_per_scene patches
+    per epoch, at random positions. With a seed the positions are the same every epoch (validation).
+    Scenes smaller than the patch are padded with zeros.
+    """
+    def __init__(self, image_dir, mask_dir, patch_size=256, patches_per_scene=16,
+                 transform=None, ids=None, seed=None):
+        self.image_dir = image_dir
+        self.mask_dir = mask_dir
+        self.patch_size = patch_size
+        self.patches_per_scene = patches_per_scene
+        self.transform = transform
+        self.seed = seed
+        if ids is None:
+            self.images = os.listdir(image_dir)
+        else:
+            self.images = [f'{file_id}_bands.tif' for file_id in ids]
+
+    def __len__(self):
+        return len(self.images) * self.patches_per_scene
+
+    def __getitem__(self, index):
+        image_name = self.images[index // self.patches_per_scene]
+        img_path = os.path.join(self.image_dir, image_name)
+        mask_path = os.path.join(self.mask_dir, image_name.replace('_bands.tif', '.tif'))
+
+        # The random module is seeded per DataLoader worker by PyTorch
+        rng = random.Random(self.seed + index) if self.seed is not None else random
+
+        with rasterio.open(img_path) as src:
+            row_off = rng.randint(0, max(src.height - self.patch_size, 0))
+            col_off = rng.randint(0, max(src.width - self.patch_size, 0))
+            window = Window(col_off, row_off, self.patch_size, self.patch_size)
+            image = src.read([1, 2, 3, 4], window=window, boundless=True, fill_value=0)
+        image = np.ascontiguousarray(image.transpose(1, 2, 0))
+
+        with rasterio.open(mask_path) as src:
+            mask = src.read(1, window=window, boundless=True, fill_value=0)
+
         if self.transform is not None:
             augmentations = self.transform(image=image, mask=mask)
             image = augmentations['image']
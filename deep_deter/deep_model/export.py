@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import numpy as np
+import torch
+from model import UNET
+
+# Settings for running this file directly
+CHECKPOINT = 'experiment1.pth.tar'
+EXPORT_DIR = 'data/model_results/exported/'
+TILE_SIZE = 256
+BATCH_SIZE = 8
+N_WARMUP = 3
+N_RUNS = 20
+
+
+def load_model(checkpoint_path=CHECKPOINT):
+    model = UNET(in_channels=4, out_channels=1)
+    if os.path.exists(checkpoint_path):
+        model.load_state_dict(torch.load(checkpoint_path, map_location='cpu')['state_dict'])
+    else:
+        print(f'=> {checkpoint_path} not found, exporting an untrained model')
+    return model.eval()
+
+
+def export_torchscript(model, example, path):
+    """
+    Traced, frozen TorchScript module. The UNET only resizes when shapes do not match,
+    tracing fixes that decision for the height and width of the example.
+    """
+    with torch.inference_mode():
+        traced = torch.jit.freeze(torch.jit.trace(model, example))
+    traced.save(path)
+    return traced
+
+
+def export_onnx(model, example, path):
+    """
+    ONNX model with a dynamic batch size, the height and width of the example are fixed.
+    """
+    torch.onnx.export(
+        model,
+        example,
+        path,
+        input_names=['input'],
+        output_names=['logits'],
+        dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}},
+        opset_version=17,
+    )
+
+
+def quantize_onnx(onnx_path, quantized_path):
+    """
+    Dynamic int8 quantization with ONNX Runtime.
+    torch.ao.quantization.quantize_dynamic only covers Linear and recurrent layers, which the
+    UNET does not have, while ONNX Runtime also quantizes the convolutions (ConvInteger).
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    quantize_dynamic(onnx_path, quantized_path, weight_type=QuantType.QUInt8)
+
+
+def get_onnxruntime_runner(onnx_path, n_threads=None):
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if n_threads is not None:
+        options.intra_op_num_threads = n_threads
+    session = ort.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+
+    def run(x):
+        return torch.from_numpy(session.run(['logits'], {'input': x.numpy()})[0])
+    return run
+
+
+def get_torch_runner(model, channels_last=False):
+    def run(x):
+        if channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        with torch.inference_mode():
+            return model(x)
+    return run
+
+
+def get_backends(model, example, export_dir=EXPORT_DIR):
+    """
+    Every CPU runtime that can be built here, backend name -> function from an input batch to logits.
+    Backends whose optional dependency is missing are skipped with a message.
+    """
+    os.makedirs(export_dir, exist_ok=True)
+    backends = {'eager': get_torch_runner(model)}
+
+    channels_last_model = UNET(in_channels=4, out_channels=1)
+    channels_last_model.load_state_dict(model.state_dict())
+    channels_last_model = channels_last_model.eval().to(memory_format=torch.channels_last)
+    backends['eager_channels_last'] = get_torch_runner(channels_last_model, channels_last=True)
+
+    torchscript_path = os.path.join(export_dir, 'unet.torchscript.pt')
+    backends['torchscript'] = get_torch_runner(export_torchscript(model, example, torchscript_path))
+
+    try:
+        backends['torch_compile'] = get_torch_runner(torch.compile(model))
+    except Exception as e:
+        print(f'=> Skipping torch.compile: {e}')
+
+    onnx_path = os.path.join(export_dir, 'unet.onnx')
+    try:
+        export_onnx(model, example, onnx_path)
+        backends['onnxruntime'] = get_onnxruntime_runner(onnx_path)
+
+        quantized_path = os.path.join(export_dir, 'unet.int8.onnx')
+        quantize_onnx(onnx_path, quantized_path)
+        backends['onnxruntime_int8'] = get_onnxruntime_runner(quantized_path)
+    except ImportError as e:
+        print(f'=> Skipping ONNX backends, missing dependency: {e}')
+
+    return backends
+
+
+def check_parity(reference, output, threshold=0.5):
+    """
+    Compares the probabilities of a backend against eager PyTorch.
+    """
+    reference = torch.sigmoid(reference.float())
+    output = torch.sigmoid(output.float())
+    return {
+        'max_abs_diff': float((reference - output).abs().max()),
+        'mask_agreement': float(((reference > threshold) == (output > threshold)).float().mean()),
+    }
+
+
+def benchmark(run, example, n_warmup=N_WARMUP, n_runs=N_RUNS):
+    """
+    Latency per batch (median and p90, in ms) and throughput in tiles per second.
+    """
+    for _ in range(n_warmup):
+        run(example)
+
+    timings = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        run(example)
+        timings.append(time.perf_counter() - start)
+
+    timings = np.array(timings)
+    return {
+        'latency_median_ms': float(np.median(timings) * 1000),
+        'latency_p90_ms': float(np.percentile(timings, 90) * 1000),
+        'throughput_tiles_per_s': float(example.shape[0] / np.median(timings)),
+    }
+
+
+def main():
+    torch.manual_seed(0)
+    model = load_model()
+    example = torch.rand((BATCH_SIZE, 4, TILE_SIZE, TILE_SIZE))
+
+    backends = get_backends(model, example)
+    reference = backends['eager'](example)
+
+    report = {'batch_size': BATCH_SIZE, 'tile_size': TILE_SIZE, 'threads': torch.get_num_threads(), 'backends': {}}
+    for name, run in backends.items():
+        print(f'=> Benchmarking {name}...')
+        try:
+            result = check_parity(reference, run(example))
+            result.update(benchmark(run, example))
+        except Exception as e:
+            print(f'=> {name} failed: {e}')
+            continue
+        report['backends'][name] = result
+        print(f"{name:>22}: {result['latency_median_ms']:8.1f} ms/batch, "
+              f"{result['throughput_tiles_per_s']:7.1f} tiles/s, "
+              f"max diff {result['max_abs_diff']:.2e}, mask agreement {result['mask_agreement']:.4f}")
+
+    with open(os.path.join(EXPORT_DIR, 'cpu_runtime_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
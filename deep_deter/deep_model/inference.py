@@ -0,0 +1,148 @@
+import os
+import numpy as np
+import rasterio
+import torch
+from rasterio.windows import Window
+from model import UNET
+
+# Settings for running this file directly
+DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+CHECKPOINT = 'experiment1.pth.tar'
+INPUT_DIR = 'data/model_inputs/test_features/'
+OUTPUT_DIR = 'data/model_results/probabilities/'
+TILE_SIZE = 256
+OVERLAP = 64
+TILE_BATCH_SIZE = 16
+# Block size of the probability GeoTIFFs
+OUTPUT_BLOCK_SIZE = 256
+
+
+def get_tile_weights(tile_size, blend='cosine'):
+    """
+    Weight of every pixel of a tile when overlapping predictions are averaged.
+    Pixels near the border of a tile, where the model sees less context, count less.
+    :param blend: 'cosine' (Hann window), 'gaussian' or 'uniform'
+    """
+    if blend == 'uniform':
+        return np.ones((tile_size, tile_size), dtype=np.float32)
+
+    coords = (np.arange(tile_size) + 0.5) / tile_size  # Pixel centers in (0, 1)
+    if blend == 'cosine':
+        weights_1d = 0.5 - 0.5 * np.cos(2 * np.pi * coords)
+    elif blend == 'gaussian':
+        sigma = 1 / 8
+        weights_1d = np.exp(-((coords - 0.5) ** 2) / (2 * sigma ** 2))
+    else:
+        raise ValueError("blend must be one of 'cosine', 'gaussian' or 'uniform'")
+
+    # Never exactly zero, so pixels only covered by the border of a tile still get a prediction
+    weights = np.outer(weights_1d, weights_1d) + 1e-3
+    return weights.astype(np.float32)
+
+
+def get_tile_offsets(length, tile_size, stride):
+    """
+    Start of every tile along one axis, the last tile is aligned with the end of the raster.
+    """
+    if length <= tile_size:
+        return [0]
+    offsets = list(range(0, length - tile_size, stride))
+    offsets.append(length - tile_size)
+    return offsets
+
+
+def predict_raster(model, image_path, output_path, tile_size=TILE_SIZE, overlap=OVERLAP,
+                   batch_size=TILE_BATCH_SIZE, device=DEVICE, blend='cosine', max_pixel_value=255.0):
+    """
+    Sliding-window inference over a full resolution {id}_bands.tif.
+    Overlapping tiles are read with windowed reads, run through the model batch_size at a time and
+    blended with get_tile_weights. The blended sums are only kept for a strip of rows: once a row of
+    tiles is done, the rows above the next one are final and are written out, so peak memory depends
+    on the tile size and the scene width, not on the scene height.
+    The probabilities are written as a float32 GeoTIFF with the transform and CRS of the source.
+    :param max_pixel_value: Inputs are divided by it, same as the A.Normalize used in training
+    """
+    stride = tile_size - overlap
+    weights = get_tile_weights(tile_size, blend)
+    model.eval()
+
+    with rasterio.open(image_path) as src:
+        height, width = src.height, src.width
+        profile = src.profile.copy()
+        profile.update(
+            driver='GTiff',
+            count=1,
+            dtype='float32',
+            nodata=None,
+            tiled=True,
+            blockxsize=OUTPUT_BLOCK_SIZE,
+            blockysize=OUTPUT_BLOCK_SIZE,
+            compress='deflate',
+            predictor=3,
+        )
+
+        # Strips are flushed in whole rows of output blocks, so every compressed block is written once.
+        # The strip starts at most one block above the current row of tiles
+        strip_height = min(height, tile_size + OUTPUT_BLOCK_SIZE)
+        probabilities = np.zeros((strip_height, width), dtype=np.float32)
+        weight_sum = np.zeros((strip_height, width), dtype=np.float32)
+        strip_start = 0
+
+        row_offsets = get_tile_offsets(height, tile_size, stride)
+        col_offsets = get_tile_offsets(width, tile_size, stride)
+
+        with rasterio.open(output_path, 'w', **profile) as dst:
+            for i, row in enumerate(row_offsets):
+                windows = [Window(col, row, tile_size, tile_size) for col in col_offsets]
+                for start in range(0, len(windows), batch_size):
+                    batch_windows = windows[start:start + batch_size]
+                    tiles = np.stack([
+                        src.read([1, 2, 3, 4], window=window, boundless=True, fill_value=0)
+                        for window in batch_windows
+                    ]).astype(np.float32) / max_pixel_value
+
+                    with torch.inference_mode():
+                        x = torch.from_numpy(tiles).to(device)
+                        preds = torch.sigmoid(model(x)).squeeze(1).float().cpu().numpy()
+
+                    for window, pred in zip(batch_windows, preds):
+                        # Tiles can go past the raster when it is smaller than one tile
+                        rows = slice(window.row_off - strip_start, min(window.row_off + tile_size, height) - strip_start)
+                        cols = slice(window.col_off, min(window.col_off + tile_size, width))
+                        n_rows, n_cols = rows.stop - rows.start, cols.stop - cols.start
+                        probabilities[rows, cols] += pred[:n_rows, :n_cols] * weights[:n_rows, :n_cols]
+                        weight_sum[rows, cols] += weights[:n_rows, :n_cols]
+
+                # No later tile reaches the rows above the next row of tiles
+                if i + 1 < len(row_offsets):
+                    done = row_offsets[i + 1] // OUTPUT_BLOCK_SIZE * OUTPUT_BLOCK_SIZE
+                else:
+                    done = height
+                n_done = done - strip_start
+                if n_done <= 0:
+                    continue
+
+                dst.write(probabilities[:n_done] / np.maximum(weight_sum[:n_done], 1e-8), 1,
+                          window=Window(0, strip_start, width, n_done))
+                probabilities[:strip_height - n_done] = probabilities[n_done:].copy()
+                weight_sum[:strip_height - n_done] = weight_sum[n_done:].copy()
+                probabilities[strip_height - n_done:] = 0
+                weight_sum[strip_height - n_done:] = 0
+                strip_start = done
+
+
+def main():
+    model = UNET(in_channels=4, out_channels=1).to(DEVICE)
+    checkpoint = torch.load(CHECKPOINT, map_location=DEVICE)
+    model.load_state_dict(checkpoint['state_dict'])
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    images = sorted(f for f in os.listdir(INPUT_DIR) if f.endswith('_bands.tif'))
+    for i, image_name in enumerate(images):
+        print(f'{i}/{len(images)} Predicting {image_name}...')
+        output_path = os.path.join(OUTPUT_DIR, image_name.replace('_bands.tif', '_probability.tif'))
+        predict_raster(model, os.path.join(INPUT_DIR, image_name), output_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import os
+import json
+import numpy as np
+import rasterio
+from torch.utils.data import IterableDataset, get_worker_info
+
+
+def write_shards(image_dir, mask_dir, images, shard_dir, prefix, max_shard_bytes=2**30):
+    """
+    Packs feature/label pairs into a few large shard files plus an index.
+    Every sample is stored as the raw bytes of its (H, W, 4) image followed by its (H, W) mask,
+    so a shard is read with sequential IO instead of opening two GeoTIFFs per sample.
+    :param images: File names of the features in image_dir ({id}_bands.tif)
+    :param prefix: Name of the shard set, e.g. 'train' -> train-00000.bin ... and train-index.json
+    :param max_shard_bytes: A new shard is started once the current one reaches this size
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    shards = []
+    shard_file = None
+
+    for image_name in images:
+        if shard_file is None or shard_file.tell() >= max_shard_bytes:
+            if shard_file is not None:
+                shard_file.close()
+            shard_name = f'{prefix}-{len(shards):05d}.bin'
+            shard_file = open(os.path.join(shard_dir, shard_name), 'wb')
+            shards.append({'file': shard_name, 'samples': []})
+
+        with rasterio.open(os.path.join(image_dir, image_name)) as src:
+            image = np.ascontiguousarray(src.read([1, 2, 3, 4]).transpose(1, 2, 0))
+        with rasterio.open(os.path.join(mask_dir, image_name.replace('_bands.tif', '.tif'))) as src:
+            mask = src.read(1)
+
+        sample = {'name': image_name, 'offset': shard_file.tell()}
+        for key, array in (('image', image), ('mask', mask)):
+            sample[key] = {'shape': list(array.shape), 'dtype': array.dtype.str}
+            shard_file.write(array.tobytes())
+        shards[-1]['samples'].append(sample)
+
+    if shard_file is not None:
+        shard_file.close()
+
+    with open(os.path.join(shard_dir, f'{prefix}-index.json'), 'w') as f:
+        json.dump({'shards': shards}, f)
+    print(f'=> Wrote {len(images)} samples to {len(shards)} shards in {shard_dir}')
+
+
+class ShardedDeterDataset(IterableDataset):
+    """
+    Streams the samples written by write_shards.
+    Shards are shuffled every epoch and split between DataLoader workers, and samples go
+    through a shuffle buffer, so reads stay sequential while the order is still random.
+    With a fixed seed the order is the same every epoch.
+    """
+    def __init__(self, shard_dir, prefix, transform=None, shuffle=True, shuffle_buffer=8, seed=None):
+        self.shard_dir = shard_dir
+        self.transform = transform
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+
+        with open(os.path.join(shard_dir, f'{prefix}-index.json')) as f:
+            self.shards = json.load(f)['shards']
+        self.images = [sample['name'] for shard in self.shards for sample in shard['samples']]
+
+    def __len__(self):
+        return len(self.images)
+
+    def _read_shard(self, shard):
+        with open(os.path.join(self.shard_dir, shard['file']), 'rb') as f:
+            for sample in shard['samples']:
+                f.seek(sample['offset'])
+                arrays = []
+                for key in ('image', 'mask'):
+                    shape = sample[key]['shape']
+                    arrays.append(np.fromfile(f, dtype=sample[key]['dtype'], count=int(np.prod(shape))).reshape(shape))
+                yield arrays[0], arrays[1]
+
+    def _get_samples(self, rng):
+        shards = list(self.shards)
+        if self.shuffle:
+            rng.shuffle(shards)
+
+        # Every worker streams its own subset of shards
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            shards = shards[worker_info.id::worker_info.num_workers]
+
+        for shard in shards:
+            yield from self._read_shard(shard)
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        if self.seed is not None:
+            seed = self.seed
+        elif worker_info is not None:
+            # The DataLoader draws a new base seed every epoch, shared by all its workers
+            seed = worker_info.seed - worker_info.id
+        else:
+            seed = np.random.SeedSequence().entropy
+        # Same shard order in every worker, so the shards are split without overlap
+        shard_rng = np.random.default_rng(seed)
+        buffer_rng = np.random.default_rng([seed, worker_info.id if worker_info is not None else 0])
+
+        samples = self._get_samples(shard_rng)
+        if not self.shuffle:
+            buffered = samples
+        else:
+            buffered = self._shuffle_buffer(samples, buffer_rng)
+
+        for image, mask in buffered:
+            if self.transform is not None:
+                augmentations = self.transform(image=image, mask=mask)
+                image = augmentations['image']
+                mask = augmentations['mask']
+            yield image, mask
+
+    def _shuffle_buffer(self, samples, rng):
+        buffer = []
+        for sample in samples:
+            buffer.append(sample)
+            if len(buffer) >= self.shuffle_buffer:
+                yield buffer.pop(rng.integers(len(buffer)))
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+if __name__ == '__main__':
+    # Packs the train and test ids of the split manifest into data/model_inputs/shards/
+    from dataset import load_split_manifest
+
+    for split in ('train', 'test'):
+        features_dir, labels_dir, ids = load_split_manifest('data/model_inputs/split_manifest.json', split)
+        write_shards(features_dir, labels_dir, [f'{file_id}_bands.tif' for file_id in ids],
+                     'data/model_inputs/shards/', split)
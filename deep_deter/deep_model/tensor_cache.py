@@ -0,0 +1,65 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import rasterio
+
+
+def get_cache_paths(cache_dir, image_name):
+    """
+    Paths of the cached image and mask arrays of one sample
+    """
+    stem = image_name.replace('_bands.tif', '')
+    return os.path.join(cache_dir, f'{stem}_image.npy'), os.path.join(cache_dir, f'{stem}_mask.npy')
+
+
+def _is_up_to_date(cache_path, source_paths):
+    if not os.path.exists(cache_path):
+        return False
+    cache_mtime = os.path.getmtime(cache_path)
+    return all(os.path.getmtime(path) <= cache_mtime for path in source_paths)
+
+
+def _save_atomic(path, array):
+    # np.save adds .npy to names that do not end with it
+    tmp_path = path + '.tmp.npy'
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+def _build_sample(image_dir, mask_dir, image_name, cache_dir):
+    """
+    Converts one feature/label pair, unless its cache is newer than both GeoTIFFs.
+    :return: True if the pair was converted
+    """
+    img_path = os.path.join(image_dir, image_name)
+    mask_path = os.path.join(mask_dir, image_name.replace('_bands.tif', '.tif'))
+    image_cache, mask_cache = get_cache_paths(cache_dir, image_name)
+
+    if _is_up_to_date(image_cache, [img_path]) and _is_up_to_date(mask_cache, [mask_path]):
+        return False
+
+    with rasterio.open(img_path) as src:
+        image = np.ascontiguousarray(src.read([1, 2, 3, 4]).transpose(1, 2, 0))
+    with rasterio.open(mask_path) as src:
+        mask = src.read(1)
+
+    _save_atomic(image_cache, image)
+    _save_atomic(mask_cache, mask)
+    return True
+
+
+def build_tensor_cache(image_dir, mask_dir, images, cache_dir, max_workers=None):
+    """
+    Converts every feature/label pair once into .npy arrays that can be memory mapped.
+    Images are stored as contiguous (H, W, 4) arrays, the same layout DeterDataset returns,
+    and masks as (H, W). Pairs whose cache is newer than both GeoTIFFs are skipped.
+    Pairs are converted by a pool of threads, GDAL decodes and np.save release the GIL.
+    :param max_workers: Number of threads, defaults to the number of CPUs
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        n_built = sum(executor.map(lambda image_name: _build_sample(image_dir, mask_dir, image_name, cache_dir),
+                                   images))
+
+    print(f'=> Tensor cache: {n_built} samples converted, {len(images) - n_built} already cached')
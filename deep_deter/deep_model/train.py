@@ -1,3 +1,5 @@
+import contextlib
+import os
 import torch
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
@@ -9,27 +11,63 @@ from utils import (
     load_checkpoint,
     save_checkpoint,
     get_loaders,
-    check_accuracy,
-    save_predictions_as_imgs,
+    evaluate,
 )
 
 # Hyperparameters etc.
 LEARNING_RATE = 1e-4
 DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+# 'fp32', 'bf16' or 'fp16' (CUDA only). Override with the PRECISION environment variable, e.g. 'bf16'
+# speeds up CPU training on CPUs with AVX512-BF16/AMX but is much slower on CPUs without them
+PRECISION = os.getenv('PRECISION', 'fp16' if DEVICE == 'cuda' else 'fp32')
 BATCH_SIZE = 2
 NUM_EPOCHS = 20
 NUM_WORKERS = 2
 IMAGE_HEIGHT = 3200
 IMAGE_WIDTH = 3200
+# Train on PATCH_SIZE x PATCH_SIZE windows read from the rasters instead of whole scenes resized
+# to IMAGE_HEIGHT x IMAGE_WIDTH. Allows a much larger BATCH_SIZE. None uses whole scenes
+PATCH_SIZE = None  # e.g. 256
+PATCHES_PER_SCENE = 16
 PIN_MEMORY = True
 LOAD_MODEL = False
+SAVE_PREDICTIONS = True
 TRAIN_IMG_DIR = 'data/model_inputs/train_features/'
 TRAIN_MASK_DIR = 'data/model_inputs/train_labels/'
 VAL_IMG_DIR = 'data/model_inputs/test_features/'
 VAL_MASK_DIR = 'data/model_inputs/test_labels/'
-
-
-def train_fn(loader, model, optimizer, loss_fn, scaler):
+# Train/test ids from the split manifest, set to None to use the directories above instead
+SPLIT_MANIFEST = 'data/model_inputs/split_manifest.json'
+# Memory-mapped .npy copy of the samples, built on the first run. None reads the GeoTIFFs every epoch
+TENSOR_CACHE_DIR = None  # e.g. 'data/model_inputs/tensor_cache/'
+# Stream training samples from shards written by shards.py. None uses DeterDataset
+SHARD_DIR = None  # e.g. 'data/model_inputs/shards/'
+
+
+def get_autocast(device, precision):
+    """
+    Autocast context for the device type of DEVICE, or no autocast at all for fp32
+    """
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    if precision == 'fp16' and device != 'cuda':
+        raise ValueError("fp16 is only supported on CUDA, use 'bf16' or 'fp32' on CPU")
+    if precision not in ('bf16', 'fp16'):
+        raise ValueError("precision must be one of 'fp32', 'bf16' or 'fp16'")
+
+    dtype = torch.bfloat16 if precision == 'bf16' else torch.float16
+    return torch.autocast(device_type=device, dtype=dtype)
+
+
+def get_grad_scaler(precision=PRECISION):
+    """
+    Only fp16 needs loss scaling, a disabled scaler passes the loss and the optimizer step through.
+    torch.cuda.amp.GradScaler is the API of the pinned torch 2.2, harmless on CPU when disabled
+    """
+    return torch.cuda.amp.GradScaler(enabled=(precision == 'fp16'))
+
+
+def train_fn(loader, model, optimizer, loss_fn, scaler, precision=PRECISION):
     loop = tqdm(loader)
 
     for batch_idx, (data, targets) in enumerate(loop):
@@ -37,7 +75,7 @@ def train_fn(loader, model, optimizer, loss_fn, scaler):
         targets = targets.float().unsqueeze(1).to(device=DEVICE)
 
         # forward
-        with torch.cuda.amp.autocast():
+        with get_autocast(DEVICE, precision):
             predictions = model(data)
             loss = loss_fn(predictions, targets)
 
@@ -52,9 +90,12 @@ def train_fn(loader, model, optimizer, loss_fn, scaler):
 
 
 def main():
+    # Patches already have a fixed size, only whole scenes are resized
+    resize = [A.Resize(height=IMAGE_HEIGHT, width=IMAGE_WIDTH)] if PATCH_SIZE is None else []
+
     train_transform = A.Compose(
         [
-            A.Resize(height=IMAGE_HEIGHT, width=IMAGE_WIDTH),
+            *resize,
             A.Rotate(limit=35, p=1.0),
             A.HorizontalFlip(p=0.5),
             A.VerticalFlip(p=0.1),
@@ -69,7 +110,7 @@ def main():
 
     val_transform = A.Compose(
         [
-            A.Resize(height=IMAGE_HEIGHT, width=IMAGE_WIDTH),
+            *resize,
             A.Normalize(
                 mean=[0.0, 0.0, 0.0, 0.0],
                 std=[1.0, 1.0, 1.0, 1.0],
@@ -93,12 +134,17 @@ def main():
         val_transform,
         NUM_WORKERS,
         PIN_MEMORY,
+        split_manifest=SPLIT_MANIFEST,
+        cache_dir=TENSOR_CACHE_DIR,
+        shard_dir=SHARD_DIR,
+        patch_size=PATCH_SIZE,
+        patches_per_scene=PATCHES_PER_SCENE,
     )
 
     if LOAD_MODEL:
         load_checkpoint(torch.load('experiment1.pth.tar'), model)
 
-    scaler = torch.cuda.amp.GradScaler()
+    scaler = get_grad_scaler(PRECISION)
 
     for epoch in range(NUM_EPOCHS):
         #print(torch.cuda.memory_summary())
@@ -111,12 +157,9 @@ def main():
         }
         save_checkpoint(checkpoint)
 
-        # check accuracy
-        check_accuracy(val_loader, model, device=DEVICE)
-
-        # print some examples
-        save_predictions_as_imgs(
-            val_loader, model, folder='data/model_results', device=DEVICE,
+        # check accuracy and print some examples in a single pass over the validation set
+        evaluate(
+            val_loader, model, device=DEVICE, folder='data/model_results' if SAVE_PREDICTIONS else None,
         )
 
 
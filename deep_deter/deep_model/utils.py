@@ -1,6 +1,7 @@
 import torch
 import torchvision
-from dataset import DeterDataset
+from dataset import DeterDataset, PatchDeterDataset, load_split_manifest
+from shards import ShardedDeterDataset
 from torch.utils.data import DataLoader
 
 
@@ -24,26 +25,85 @@ def get_loaders(
     val_transform,
     num_workers=4,
     pin_memory=True,
+    split_manifest=None,
+    cache_dir=None,
+    shard_dir=None,
+    patch_size=None,
+    patches_per_scene=16,
 ):
-    train_ds = DeterDataset(
-        image_dir=train_dir,
-        mask_dir=train_maskdir,
-        transform=train_transform,
-    )
-
-    train_loader = DataLoader(
-        train_ds,
-        batch_size=batch_size,
-        num_workers=num_workers,
-        pin_memory=pin_memory,
-        shuffle=True,
-    )
-
-    val_ds = DeterDataset(
-        image_dir=val_dir,
-        mask_dir=val_maskdir,
-        transform=val_transform,
-    )
+    """
+    If split_manifest is given, the train and val ids are read from it and the directories
+    come from the manifest (the processed data), train_dir/val_dir and their mask dirs are ignored.
+    If cache_dir is given, samples are read from a memory-mapped .npy cache (see tensor_cache.py).
+    If shard_dir is given, training samples are streamed from the 'train' shards (see shards.py).
+    Validation keeps using DeterDataset so predictions can be matched to their file names.
+    If patch_size is given, both loaders use PatchDeterDataset: random patch_size x patch_size windows
+    for training and fixed ones for validation, instead of whole scenes.
+    """
+    train_ids, val_ids = None, None
+    if split_manifest is not None:
+        train_dir, train_maskdir, train_ids = load_split_manifest(split_manifest, 'train')
+        val_dir, val_maskdir, val_ids = load_split_manifest(split_manifest, 'test')
+
+    if patch_size is not None:
+        train_ds = PatchDeterDataset(
+            image_dir=train_dir,
+            mask_dir=train_maskdir,
+            patch_size=patch_size,
+            patches_per_scene=patches_per_scene,
+            transform=train_transform,
+            ids=train_ids,
+        )
+        train_loader = DataLoader(
+            train_ds,
+            batch_size=batch_size,
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+            shuffle=True,
+        )
+    elif shard_dir is not None:
+        # Shuffled by the dataset itself, DataLoader shuffling is not supported for iterable datasets
+        train_ds = ShardedDeterDataset(shard_dir, 'train', transform=train_transform)
+        train_loader = DataLoader(
+            train_ds,
+            batch_size=batch_size,
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+        )
+    else:
+        train_ds = DeterDataset(
+            image_dir=train_dir,
+            mask_dir=train_maskdir,
+            transform=train_transform,
+            ids=train_ids,
+            cache_dir=cache_dir,
+        )
+        train_loader = DataLoader(
+            train_ds,
+            batch_size=batch_size,
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+            shuffle=True,
+        )
+
+    if patch_size is not None:
+        val_ds = PatchDeterDataset(
+            image_dir=val_dir,
+            mask_dir=val_maskdir,
+            patch_size=patch_size,
+            patches_per_scene=patches_per_scene,
+            transform=val_transform,
+            ids=val_ids,
+            seed=0,
+        )
+    else:
+        val_ds = DeterDataset(
+            image_dir=val_dir,
+            mask_dir=val_maskdir,
+            transform=val_transform,
+            ids=val_ids,
+            cache_dir=cache_dir,
+        )
 
     val_loader = DataLoader(
         val_ds,
@@ -87,7 +147,70 @@ def save_predictions_as_imgs(loader, model, folder='model_results/', device='cud
             preds = torch.sigmoid(model(x))
             preds = (preds > 0.5).float()
 
-        torchvision.utils.save_image(preds, f'{folder}/predictions/pred_{loader.dataset.images[idx][:-4]}.png')
-        torchvision.utils.save_image(y.unsqueeze(1), f'{folder}/actuals/{loader.dataset.images[idx][:-4]}.png')
+        # Patch datasets have more batches than scenes
+        name = loader.dataset.images[idx][:-4] if idx < len(loader.dataset.images) else f'batch_{idx}'
+        torchvision.utils.save_image(preds, f'{folder}/predictions/pred_{name}.png')
+        torchvision.utils.save_image(y.unsqueeze(1), f'{folder}/actuals/{name}.png')
 
     model.train()
+
+
+def _get_ratio(numerator, denominator, empty_value=1.0):
+    # An image without positives in both the label and the prediction is a perfect score
+    return torch.where(denominator > 0, numerator / denominator.clamp(min=1), torch.full_like(numerator, empty_value))
+
+
+def evaluate(loader, model, device='cuda', threshold=0.5, folder=None):
+    """
+    Single pass over the loader that replaces check_accuracy + save_predictions_as_imgs.
+    TP/FP/FN/TN are accumulated per image on the device and only copied back once at the end.
+    Reports global (pooled over all pixels) and per-image mean Dice, IoU, precision and recall.
+    :param folder: If given, the predictions and actuals of every batch are saved there as .png
+    :return: A dict with the metrics
+    """
+    model.eval()
+    counts = []
+
+    with torch.no_grad():
+        for idx, (x, y) in enumerate(loader):
+            x = x.to(device)
+            target = y.to(device).unsqueeze(1) > 0.5
+            preds = torch.sigmoid(model(x)) > threshold
+
+            dims = (1, 2, 3)
+            counts.append(torch.stack([
+                (preds & target).sum(dims),  # TP
+                (preds & ~target).sum(dims),  # FP
+                (~preds & target).sum(dims),  # FN
+                (~preds & ~target).sum(dims),  # TN
+            ], dim=1))
+
+            if folder is not None:
+                # Patch datasets have more batches than scenes
+                name = loader.dataset.images[idx][:-4] if idx < len(loader.dataset.images) else f'batch_{idx}'
+                torchvision.utils.save_image(preds.float(), f'{folder}/predictions/pred_{name}.png')
+                torchvision.utils.save_image(target.float(), f'{folder}/actuals/{name}.png')
+
+    model.train()
+
+    per_image = torch.cat(counts).double()  # (n_images, 4)
+    metrics = {}
+    for prefix, (tp, fp, fn, tn) in (('', per_image.sum(0)), ('per_image_', per_image.T)):
+        values = {
+            'dice': _get_ratio(2 * tp, 2 * tp + fp + fn),
+            'iou': _get_ratio(tp, tp + fp + fn),
+            'precision': _get_ratio(tp, tp + fp),
+            'recall': _get_ratio(tp, tp + fn),
+            'accuracy': _get_ratio(tp + tn, tp + fp + fn + tn),
+        }
+        for name, value in values.items():
+            metrics[prefix + name] = value.mean()
+
+    # Single device to host copy
+    metrics = dict(zip(metrics, torch.stack(list(metrics.values())).tolist()))
+
+    print(f"Global: dice {metrics['dice']:.4f}, IoU {metrics['iou']:.4f}, "
+          f"precision {metrics['precision']:.4f}, recall {metrics['recall']:.4f}, acc {metrics['accuracy']*100:.2f}")
+    print(f"Per image: dice {metrics['per_image_dice']:.4f}, IoU {metrics['per_image_iou']:.4f}, "
+          f"precision {metrics['per_image_precision']:.4f}, recall {metrics['per_image_recall']:.4f}")
+    return metrics
@@ -0,0 +1,8 @@
+# Std.Lib.
+import sys
+from pathlib import Path
+
+# The tests import the deep_deter package from the root of the repository
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+# The deep_model scripts import each other as top-level modules (from model import UNET)
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]/'deep_deter'/'deep_model'))
@@ -0,0 +1,138 @@
+"""
+A local stand-in for the parts of the ee API used by FetchSentinelImg, so its requests can be
+built and resolved without credentials or network access.
+Server-side values are FakeComputed objects that only become Python values in getInfo(),
+and every getInfo() is counted as one round trip.
+"""
+# Std.Lib.
+from typing import Dict, List, Sequence, Tuple, Union
+
+
+class FakeComputed:
+    def __init__(self, client: 'FakeEE', value):
+        self.client = client
+        self.value = value
+
+    def getInfo(self):
+        self.client.get_info_calls += 1
+        return _resolve(self.value)
+
+
+def _resolve(value):
+    if isinstance(value, FakeComputed):
+        return _resolve(value.value)
+    if isinstance(value, dict):
+        return {key: _resolve(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_resolve(item) for item in value]
+    return value
+
+
+class FakeGeometry:
+    def __init__(self, bounds: Tuple[float, float, float, float]):
+        self.bounds = bounds
+
+    def intersects(self, bounds: Tuple[float, float, float, float]) -> bool:
+        return (self.bounds[0] <= bounds[2] and bounds[0] <= self.bounds[2]
+                and self.bounds[1] <= bounds[3] and bounds[1] <= self.bounds[3])
+
+
+class FakeGeometryFactory:
+    @staticmethod
+    def Polygon(coordinates: Sequence[Tuple[float, float]]) -> FakeGeometry:
+        xs = [x for x, _ in coordinates]
+        ys = [y for _, y in coordinates]
+        return FakeGeometry((min(xs), min(ys), max(xs), max(ys)))
+
+    @staticmethod
+    def Rectangle(corners: Sequence[Tuple[float, float]]) -> FakeGeometry:
+        (min_x, min_y), (max_x, max_y) = corners
+        return FakeGeometry((min_x, min_y, max_x, max_y))
+
+
+class FakeFilter:
+    def __init__(self, predicate):
+        self.predicate = predicate
+
+    @staticmethod
+    def lt(name: str, value) -> 'FakeFilter':
+        return FakeFilter(lambda image: image[name] < value)
+
+
+class FakeImageCollection:
+    """
+    Images are dicts with 'system:index', 'date' ('YYYY-MM-DD'), 'bounds' and 'CLOUDY_PIXEL_PERCENTAGE'
+    """
+    def __init__(self, client: 'FakeEE', images: List[dict]):
+        self.client = client
+        self.images = images
+
+    def filterDate(self, first_date: str, last_date: str) -> 'FakeImageCollection':
+        # Same as Earth Engine, the end date is exclusive
+        return FakeImageCollection(self.client, [i for i in self.images if first_date <= i['date'] < last_date])
+
+    def filterBounds(self, geometry: FakeGeometry) -> 'FakeImageCollection':
+        return FakeImageCollection(self.client, [i for i in self.images if geometry.intersects(i['bounds'])])
+
+    def filter(self, ee_filter: FakeFilter) -> 'FakeImageCollection':
+        return FakeImageCollection(self.client, [i for i in self.images if ee_filter.predicate(i)])
+
+    def map(self, function) -> 'FakeImageCollection':
+        # Per-image algorithms (cloud masking...) do not change which images are available
+        return self
+
+    def size(self) -> FakeComputed:
+        return FakeComputed(self.client, len(self.images))
+
+    def aggregate_array(self, name: str) -> FakeComputed:
+        return FakeComputed(self.client, [image[name] for image in self.images])
+
+    def select(self, bands: List[str]) -> 'FakeImageCollection':
+        return self
+
+    def median(self) -> 'FakeImage':
+        return FakeImage([image['system:index'] for image in self.images])
+
+
+class FakeImage:
+    """
+    A composite, only remembers which images went into it and which bands were selected
+    """
+    def __init__(self, image_ids: List[str], bands: Union[List[str], None] = None):
+        self.image_ids = image_ids
+        self.bands = bands
+
+    def select(self, bands: List[Union[str, int]]) -> 'FakeImage':
+        # Same as Earth Engine, bands can be selected by name or by index
+        return FakeImage(self.image_ids, [self.bands[band] if isinstance(band, int) else band for band in bands])
+
+
+class FakeDictionary(FakeComputed):
+    def __init__(self, client: 'FakeEE', mapping: Dict):
+        super().__init__(client, dict(mapping))
+
+
+class FakeEE:
+    """
+    Use as FetchSentinelImg(..., ee_client=FakeEE(images))
+    """
+    def __init__(self, images: List[dict]):
+        self.images = images
+        self.get_info_calls = 0
+        self.Geometry = FakeGeometryFactory
+        self.Filter = FakeFilter
+
+        client = self
+
+        class Dictionary(FakeDictionary):
+            def __init__(self, mapping: Dict):
+                super().__init__(client, mapping)
+
+            @staticmethod
+            def fromLists(keys: List[str], values: List) -> FakeDictionary:
+                return FakeDictionary(client, dict(zip(keys, values)))
+
+        self.Dictionary = Dictionary
+
+    def ImageCollection(self, collection_id: str) -> FakeImageCollection:
+        return FakeImageCollection(self, self.images)
@@ -0,0 +1,46 @@
+"""
+Stand-in for SaveToDisk._export_multiband (called with an ee region) or the export of a
+CompositeCache (called with bounds): writes a raster over the requested region and records the
+exported regions, instead of downloading from Earth Engine.
+Same as Earth Engine, the raster covers the whole pixels of the global grid of the resolution
+that the region overlaps.
+Every selected band is filled with its Sentinel-2 band number (B8 -> 8), 4 bands of ones otherwise.
+With positional=True every pixel also encodes its column and row on the global grid of the resolution,
+like an Earth Engine export, so crops of the same area can be compared pixel for pixel.
+"""
+# Data Science
+import numpy as np
+import rasterio
+from rasterio.transform import from_bounds
+
+# Custom functions
+from deep_deter.data_extraction.utils import snap_bounds_to_grid
+
+# Degrees per pixel of the fake exports
+RESOLUTION = 0.001
+
+
+class FakeExport:
+    def __init__(self, resolution: float = RESOLUTION, positional: bool = False):
+        self.resolution = resolution
+        self.positional = positional
+        self.regions = []
+
+    def __call__(self, image, path, region):
+        bounds = getattr(region, 'bounds', region)
+        self.regions.append(bounds)
+        bounds = snap_bounds_to_grid(bounds, self.resolution, self.resolution)
+        min_x, min_y, max_x, max_y = bounds
+        width = round((max_x - min_x) / self.resolution)
+        height = round((max_y - min_y) / self.resolution)
+        bands = getattr(image, 'bands', None)
+        values = [float(band[1:]) for band in bands] if bands else [1.0] * 4
+        position, band_scale = np.zeros((height, width)), 1
+        if self.positional:
+            # Global column and row of the pixel centres, kept under 2 ** 24 to stay exact in float32
+            columns = np.floor((min_x + (np.arange(width) + 0.5) * self.resolution) / self.resolution) % 1000
+            rows = np.floor((max_y - (np.arange(height) + 0.5) * self.resolution) / self.resolution) % 1000
+            position, band_scale = columns[None, :] + 1000 * rows[:, None], 1e6
+        with rasterio.open(path, 'w', driver='GTiff', height=height, width=width, count=len(values),
+                           dtype='float32', crs='EPSG:4326', transform=from_bounds(*bounds, width, height)) as dest:
+            dest.write(np.stack([(value * band_scale + position).astype('float32') for value in values]))
@@ -0,0 +1,82 @@
+# Std.Lib.
+import pytest
+
+rasterio = pytest.importorskip('rasterio')
+
+# Data Science
+import numpy as np
+
+# Custom functions
+from deep_deter.data_extraction.composite_cache import CompositeCache, crop_to_bounds
+from deep_deter.data_extraction.utils import get_pixel_degrees
+from fake_ee import FakeEE, FakeImage
+from fake_export import RESOLUTION, FakeExport
+
+
+def _get_cache(tmp_path, export, fetch_missing=True) -> CompositeCache:
+    return CompositeCache(
+        bands=['B2', 'B3', 'B4', 'B8'],
+        export=export,
+        cache_dir=tmp_path/'composites',
+        fetch_missing=fetch_missing,
+        ee_client=FakeEE([]),
+    )
+
+
+def _get_area(bounds):
+    return (bounds[2] - bounds[0]) * (bounds[3] - bounds[1])
+
+
+def test_cold_miss_costs_about_one_box_and_neighbour_hits(tmp_path):
+    export = FakeExport()
+    cache = _get_cache(tmp_path, export)
+    box = (-60.13, -10.11, -59.85, -9.83)  # +/- 0.14 degrees around an alert
+
+    assert cache.export_window(lambda region: FakeImage([]), box, '2023-06-01', '2023-06-15', 20, tmp_path/'a.tif')
+    assert len(export.regions) == 1
+    assert _get_area(export.regions[0]) <= 1.35 * _get_area(box)
+
+    # A neighbouring alert with the same date window only fetches the tiles it does not share
+    neighbour = (box[0] + 0.02, box[1], box[2] + 0.02, box[3])
+    assert cache.export_window(lambda region: FakeImage([]), neighbour, '2023-06-01', '2023-06-15', 20, tmp_path/'b.tif')
+    assert len(export.regions) == 2
+    assert _get_area(export.regions[1]) < 0.2 * _get_area(box)
+
+    with rasterio.open(tmp_path/'b.tif') as src:
+        assert src.count == 4
+        assert src.bounds.left == pytest.approx(neighbour[0], abs=RESOLUTION)
+        assert src.bounds.right == pytest.approx(neighbour[2], abs=RESOLUTION)
+
+
+def test_window_mosaicked_from_tiles_matches_a_single_source_crop(tmp_path):
+    export = FakeExport(resolution=get_pixel_degrees(10), positional=True)
+    cache = _get_cache(tmp_path, export)
+    # Neither on the tile grid nor on the pixel grid, and spanning several tiles
+    box = (-60.0512, -10.0333, -59.9487, -9.9444)
+
+    assert cache.export_window(lambda region: FakeImage([]), box, '2023-06-01', '2023-06-15', 20, tmp_path/'a.tif')
+    assert len(cache.get_tiles(box)) == 12
+
+    # The same area exported at once, as the download of a single alert would be
+    export(FakeImage([]).select(['B2', 'B3', 'B4', 'B8']), tmp_path/'single.tif', export.regions[0])
+    crop_to_bounds([tmp_path/'single.tif'], box, tmp_path/'b.tif')
+
+    with rasterio.open(tmp_path/'a.tif') as mosaic, rasterio.open(tmp_path/'b.tif') as reference:
+        assert mosaic.shape == reference.shape
+        assert mosaic.transform.almost_equals(reference.transform)
+        assert np.array_equal(mosaic.read(), reference.read())
+        # No column or row is duplicated or dropped at the seams
+        columns = mosaic.read(1)[0] % 1000
+        rows = mosaic.read(1)[:, 0] // 1000 % 1000
+        assert np.all(np.diff(columns) % 1000 == 1)
+        assert np.all(np.diff(rows) % 1000 == 999)
+
+
+def test_disabled_cache_does_not_look_up_tiles(tmp_path):
+    export = FakeExport()
+    cache = _get_cache(tmp_path, export, fetch_missing=False)
+
+    assert not cache.enabled
+    assert not cache.export_window(lambda region: FakeImage([]), (0, 0, 0.28, 0.28), '2023-06-01', '2023-06-15', 20,
+                                   tmp_path/'a.tif')
+    assert export.regions == []
@@ -0,0 +1,82 @@
+# Std.Lib.
+import pytest
+
+# Custom functions
+from deep_deter.data_extraction.custom_error import ExportFailedError, RetriesExhaustedError
+from deep_deter.data_extraction.ee_scheduler import AdaptiveConcurrencyLimit, EERequestScheduler
+
+
+def _get_scheduler(max_retries: int = 3) -> EERequestScheduler:
+    return EERequestScheduler(requests_per_second=1000, max_retries=max_retries, base_delay=0.0)
+
+
+def test_raising_max_concurrency_raises_current_limit():
+    concurrency = AdaptiveConcurrencyLimit(1)
+    concurrency.set_max_limit(8)
+    assert concurrency.limit == 8
+
+    concurrency.on_throttled()
+    concurrency.set_max_limit(8)
+    assert concurrency.limit == 4
+
+
+def test_throttled_exports_halve_concurrency():
+    scheduler = _get_scheduler()
+    scheduler.set_max_concurrency(8)
+    attempts = []
+
+    def export():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ExportFailedError('HTTP 429 Too Many Requests: Quota exceeded')
+        return 'done'
+
+    assert scheduler.call('export_image', export) == 'done'
+    assert scheduler.concurrency.limit < 8
+
+
+def test_non_throttling_export_failures_fail_fast_and_keep_concurrency():
+    scheduler = _get_scheduler()
+    scheduler.set_max_concurrency(8)
+    attempts = []
+
+    def export():
+        attempts.append(1)
+        raise ExportFailedError('HTTP 400 Bad Request: Total request size (77594624 bytes) must be less than '
+                                'or equal to 50331648 bytes.')
+
+    with pytest.raises(ExportFailedError):
+        scheduler.call('export_image', export)
+    assert len(attempts) == 1
+    assert scheduler.concurrency.limit == 8
+
+
+def test_transient_export_failures_are_retried_without_backing_off():
+    scheduler = _get_scheduler()
+    scheduler.set_max_concurrency(8)
+    attempts = []
+
+    def export():
+        attempts.append(1)
+        if len(attempts) < 2:
+            raise ExportFailedError('HTTP 503 Service Unavailable: ')
+        return 'done'
+
+    assert scheduler.call('export_image', export) == 'done'
+    assert scheduler.concurrency.limit == 8
+
+
+def test_exhausted_retries_raise_retries_exhausted_error():
+    def export():
+        raise ExportFailedError('HTTP 429 Too Many Requests: ')
+
+    with pytest.raises(RetriesExhaustedError):
+        _get_scheduler(max_retries=2).call('export_image', export)
+
+
+def test_non_retryable_errors_are_raised_as_they_are():
+    def request():
+        raise ValueError('Invalid geometry')
+
+    with pytest.raises(ValueError):
+        _get_scheduler().call('collection_size', request)
@@ -0,0 +1,42 @@
+# Data Science
+import pytest
+import torch
+import torch.nn as nn
+
+# Custom functions
+from utils import evaluate
+
+
+def _get_logits(predicted) -> torch.Tensor:
+    # The model is the identity, the inputs are the logits of the predictions
+    return (torch.tensor(predicted, dtype=torch.float32) * 2 - 1).unsqueeze(0).unsqueeze(0)
+
+
+def test_evaluate_counts_on_a_hand_built_batch():
+    # TP 1, FP 1, FN 1, TN 1
+    first = (_get_logits([[1, 1], [0, 0]]), torch.tensor([[[1., 0.], [1., 0.]]]))
+    # Nothing predicted and nothing to find: TN 4, a perfect score for the per-image means
+    second = (_get_logits([[0, 0], [0, 0]]), torch.tensor([[[0., 0.], [0., 0.]]]))
+
+    metrics = evaluate([first, second], nn.Identity(), device='cpu')
+
+    # Pooled: TP 1, FP 1, FN 1, TN 5
+    assert metrics['dice'] == pytest.approx(2 / 4)
+    assert metrics['iou'] == pytest.approx(1 / 3)
+    assert metrics['precision'] == pytest.approx(1 / 2)
+    assert metrics['recall'] == pytest.approx(1 / 2)
+    assert metrics['accuracy'] == pytest.approx(6 / 8)
+    # Mean of the first image and of the empty one
+    assert metrics['per_image_dice'] == pytest.approx((1 / 2 + 1) / 2)
+    assert metrics['per_image_iou'] == pytest.approx((1 / 3 + 1) / 2)
+    assert metrics['per_image_precision'] == pytest.approx((1 / 2 + 1) / 2)
+    assert metrics['per_image_recall'] == pytest.approx((1 / 2 + 1) / 2)
+    assert metrics['per_image_accuracy'] == pytest.approx((2 / 4 + 1) / 2)
+
+
+def test_evaluate_uses_the_threshold_on_probabilities():
+    # sigmoid(0.5) ~ 0.62: positive at the default threshold, negative at 0.7
+    batch = (torch.full((1, 1, 2, 2), 0.5), torch.ones(1, 2, 2))
+
+    assert evaluate([batch], nn.Identity(), device='cpu')['recall'] == 1.0
+    assert evaluate([batch], nn.Identity(), device='cpu', threshold=0.7)['recall'] == 0.0
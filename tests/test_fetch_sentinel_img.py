@@ -0,0 +1,83 @@
+# Std.Lib.
+import pytest
+
+geopandas = pytest.importorskip('geopandas')
+shapely_geometry = pytest.importorskip('shapely.geometry')
+
+# Custom functions
+from deep_deter.data_extraction.ee_scheduler import EERequestScheduler
+from deep_deter.data_extraction.fetch_sentinel_img import FetchSentinelImg
+from fake_ee import FakeEE
+
+
+def _square(x: float, y: float, size: float = 0.01):
+    return shapely_geometry.box(x, y, x + size, y + size)
+
+
+@pytest.fixture
+def deter_alerts():
+    return geopandas.GeoDataFrame({
+        'FID': ['deter_1', 'deter_2', 'deter_3', 'deter_4'],
+        'VIEW_DATE': ['2023-06-15', '2023-06-15', '2023-07-01', '2023-06-15'],
+        'geometry': [
+            _square(-60.0, -10.0),
+            _square(-55.0, -5.0),
+            _square(-60.0, -10.0),
+            shapely_geometry.MultiPolygon([_square(-50.0, -3.0), _square(-50.5, -3.5)]),
+        ],
+    }, crs='EPSG:4326')
+
+
+@pytest.fixture
+def fake_ee():
+    images = [
+        # Over deter_1 and deter_3, inside the lookback window of deter_1 only
+        {'system:index': 'a', 'date': '2023-06-10', 'bounds': (-60.5, -10.5, -59.5, -9.5), 'CLOUDY_PIXEL_PERCENTAGE': 5},
+        {'system:index': 'b', 'date': '2023-06-12', 'bounds': (-60.5, -10.5, -59.5, -9.5), 'CLOUDY_PIXEL_PERCENTAGE': 10},
+        # Too cloudy
+        {'system:index': 'c', 'date': '2023-06-12', 'bounds': (-60.5, -10.5, -59.5, -9.5), 'CLOUDY_PIXEL_PERCENTAGE': 80},
+        # Inside the lookback window of deter_3
+        {'system:index': 'd', 'date': '2023-06-25', 'bounds': (-60.5, -10.5, -59.5, -9.5), 'CLOUDY_PIXEL_PERCENTAGE': 0},
+    ]
+    return FakeEE(images)
+
+
+def _get_fetch_sentinel_img(fake_ee: FakeEE) -> FetchSentinelImg:
+    return FetchSentinelImg(
+        max_allowed_cloud_percentage=20,
+        max_allowed_lookback_days=14,
+        ee_client=fake_ee,
+        scheduler=EERequestScheduler(requests_per_second=1000),
+    )
+
+
+def test_get_image_availability_maps_fid_to_images(deter_alerts, fake_ee):
+    availability = _get_fetch_sentinel_img(fake_ee).get_image_availability(deter_alerts)
+
+    assert {fid: alert['n_images'] for fid, alert in availability.items()} == {
+        'deter_1': 2,
+        'deter_2': 0,
+        'deter_3': 1,
+    }
+    assert availability['deter_1']['image_ids'] == ['a', 'b']
+    assert availability['deter_3']['image_ids'] == ['d']
+    # MultiPolygons are left out
+    assert 'deter_4' not in availability
+    assert fake_ee.get_info_calls == 1
+
+
+def test_get_image_availability_batches_requests(deter_alerts, fake_ee):
+    availability = _get_fetch_sentinel_img(fake_ee).get_image_availability(deter_alerts, batch_size=2)
+
+    assert set(availability) == {'deter_1', 'deter_2', 'deter_3'}
+    assert fake_ee.get_info_calls == 2
+
+
+def test_get_sentinel_img_skips_size_request_when_count_is_known(deter_alerts, fake_ee):
+    fetch_sentinel_img = _get_fetch_sentinel_img(fake_ee)
+    fetch_sentinel_img._get_median = staticmethod(lambda img_collection: img_collection)
+
+    img_collection = fetch_sentinel_img.get_sentinel_img(deter_alerts.iloc[[0]], n_images=2)
+
+    assert [image['system:index'] for image in img_collection.images] == ['a', 'b']
+    assert fake_ee.get_info_calls == 0
@@ -0,0 +1,62 @@
+# Data Science
+import numpy as np
+import pytest
+import rasterio
+import torch
+
+# Custom functions
+import inference
+from model import UNET
+
+TILE_SIZE = 32
+OVERLAP = 8
+
+
+def _predict_full_scene(model, image: np.ndarray, batch_size: int) -> np.ndarray:
+    """
+    Reference: the same tiles and weights, blended in arrays as large as the scene
+    """
+    _, height, width = image.shape
+    weights = inference.get_tile_weights(TILE_SIZE)
+    probabilities = np.zeros((height, width), dtype=np.float32)
+    weight_sum = np.zeros((height, width), dtype=np.float32)
+    padded = np.zeros((4, height + TILE_SIZE, width + TILE_SIZE), dtype=np.float32)
+    padded[:, :height, :width] = image / 255.0
+
+    stride = TILE_SIZE - OVERLAP
+    for row in inference.get_tile_offsets(height, TILE_SIZE, stride):
+        cols = inference.get_tile_offsets(width, TILE_SIZE, stride)
+        for start in range(0, len(cols), batch_size):
+            batch_cols = cols[start:start + batch_size]
+            tiles = np.stack([padded[:, row:row + TILE_SIZE, col:col + TILE_SIZE] for col in batch_cols])
+            with torch.inference_mode():
+                preds = torch.sigmoid(model(torch.from_numpy(tiles))).squeeze(1).numpy()
+            for col, pred in zip(batch_cols, preds):
+                n_rows, n_cols = min(TILE_SIZE, height - row), min(TILE_SIZE, width - col)
+                probabilities[row:row + n_rows, col:col + n_cols] += pred[:n_rows, :n_cols] * weights[:n_rows, :n_cols]
+                weight_sum[row:row + n_rows, col:col + n_cols] += weights[:n_rows, :n_cols]
+    return probabilities / np.maximum(weight_sum, 1e-8)
+
+
+# Heights that are not multiples of the output blocks, several strips and a scene smaller than a tile
+@pytest.mark.parametrize('height', [75, 50, 20])
+def test_strip_blending_matches_a_full_scene_blend(tmp_path, monkeypatch, height):
+    # Blocks smaller than the tiles, so several strips are flushed per scene
+    monkeypatch.setattr(inference, 'OUTPUT_BLOCK_SIZE', 16)
+    torch.manual_seed(0)
+    model = UNET(in_channels=4, out_channels=1, features=[4, 8]).eval()
+    width = 45
+    image = np.random.default_rng(0).integers(0, 256, (4, height, width)).astype('uint8')
+    with rasterio.open(tmp_path/'deter_1_bands.tif', 'w', driver='GTiff', height=height, width=width,
+                       count=4, dtype='uint8', crs='EPSG:4326',
+                       transform=rasterio.transform.from_origin(-60, -10, 0.001, 0.001)) as dst:
+        dst.write(image)
+
+    inference.predict_raster(model, tmp_path/'deter_1_bands.tif', tmp_path/'deter_1_probability.tif',
+                             tile_size=TILE_SIZE, overlap=OVERLAP, batch_size=2, device='cpu')
+
+    with rasterio.open(tmp_path/'deter_1_probability.tif') as src:
+        assert (src.height, src.width) == (height, width)
+        assert src.transform == rasterio.transform.from_origin(-60, -10, 0.001, 0.001)
+        probabilities = src.read(1)
+    np.testing.assert_allclose(probabilities, _predict_full_scene(model, image, batch_size=2), atol=1e-6)
@@ -0,0 +1,63 @@
+# Data Science
+import numpy as np
+import pytest
+
+# Custom functions
+from deep_deter.data_extraction.mask_sentinel_img import GetCorrectProdesMask
+
+
+def _get_raster_pixels_if_chain(ref_date: str) -> list:
+    """
+    The chain of date comparisons the lookup table replaced
+    """
+    raster_pixels = [32, 91, 101]
+    if ref_date > '2007-07-31':
+        raster_pixels.append(7)
+    if ref_date > '2008-07-31':
+        raster_pixels.append(8)
+    if ref_date > '2009-07-31':
+        raster_pixels.append(9)
+    for year in range(2010, 2022):
+        if ref_date > f'{year}-07-31':
+            raster_pixels.append(year - 1960)
+            raster_pixels.append(year - 2000)
+    if ref_date > '2022-07-31':
+        raster_pixels.append(22)
+    return raster_pixels
+
+
+# Both sides of the end of every PRODES year, and dates before and after the table
+REF_DATES = [f'{year}-{month_day}' for year in range(2005, 2026) for month_day in ('01-15', '07-31', '08-01', '12-31')]
+
+
+def _get_mask(ref_date: str, window: np.ndarray) -> GetCorrectProdesMask:
+    prodes_mask = GetCorrectProdesMask('prodes.tif', (0, 0, 1, 1), ref_date)
+    prodes_mask._read_filtered_prodes_raster = lambda shape: window
+    return prodes_mask
+
+
+@pytest.mark.parametrize('ref_date', REF_DATES)
+def test_masked_classes_match_the_if_chain(ref_date):
+    prodes_mask = _get_mask(ref_date, None)
+
+    assert sorted(prodes_mask._get_raster_pixels()) == sorted(_get_raster_pixels_if_chain(ref_date))
+
+
+@pytest.mark.parametrize('dtype', ['uint8', 'uint16'])
+def test_mask_matches_isin_over_every_class(dtype):
+    # Every 8 bit class at least once, in a non-square window
+    window = (np.arange(256 * 3).reshape(24, 32) % 256).astype(dtype)
+
+    for ref_date in REF_DATES:
+        expected = np.isin(window, _get_raster_pixels_if_chain(ref_date))
+        assert np.array_equal(_get_mask(ref_date, window).get_mask(window.shape), expected)
+
+
+def test_masks_for_several_dates_match_one_mask_per_date():
+    window = np.random.default_rng(0).integers(0, 256, (16, 16), dtype='uint8')
+
+    masks = _get_mask(REF_DATES[0], window).get_masks(window.shape, REF_DATES)
+
+    assert masks.shape == (len(REF_DATES), 16, 16)
+    for ref_date, mask in zip(REF_DATES, masks):
+        assert np.array_equal(mask, _get_mask(ref_date, window).get_mask(window.shape))
@@ -0,0 +1,43 @@
+# Std.Lib.
+import os
+import pickle
+
+import pytest
+
+# Custom functions
+from deep_deter.data_extraction.raw_catalog import RawCatalog
+
+
+def _write_bands(path_raw_bands, polygon_id: str) -> None:
+    for band in ('blue', 'green', 'red', 'nir'):
+        with open(path_raw_bands/f'{polygon_id}_{band}_band.tif', 'wb') as f:
+            f.write(b'band')
+
+
+def test_read_only_catalog_never_rewrites_the_file(tmp_path):
+    _write_bands(tmp_path, 'deter_1')
+    RawCatalog(tmp_path)
+    catalog_stat = os.stat(tmp_path/'catalog.jsonl')
+
+    # A band written by hand makes the catalog stale, only a writable catalog rebuilds it
+    _write_bands(tmp_path, 'deter_2')
+    os.utime(tmp_path, ns=(catalog_stat.st_mtime_ns + 10 ** 9, catalog_stat.st_mtime_ns + 10 ** 9))
+    read_only = RawCatalog(tmp_path, read_only=True)
+
+    assert read_only.get_complete_ids() == ['deter_1']
+    assert os.stat(tmp_path/'catalog.jsonl').st_mtime_ns == catalog_stat.st_mtime_ns
+    assert not (tmp_path/'catalog.jsonl.tmp').exists()
+    with pytest.raises(RuntimeError):
+        read_only.record_download('deter_2', {'blue': tmp_path/'deter_2_blue_band.tif'})
+
+    assert sorted(RawCatalog(tmp_path).get_complete_ids()) == ['deter_1', 'deter_2']
+
+
+def test_catalog_can_be_sent_to_worker_processes(tmp_path):
+    _write_bands(tmp_path, 'deter_1')
+    catalog = RawCatalog(tmp_path, read_only=True)
+
+    copy = pickle.loads(pickle.dumps(catalog))
+
+    assert copy.read_only
+    assert copy.get_band_paths('deter_1') == catalog.get_band_paths('deter_1')
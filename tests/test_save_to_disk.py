@@ -0,0 +1,105 @@
+# Std.Lib.
+import os
+
+import pytest
+
+geopandas = pytest.importorskip('geopandas')
+pytest.importorskip('ee')
+shapely_geometry = pytest.importorskip('shapely.geometry')
+rasterio = pytest.importorskip('rasterio')
+
+# Custom functions
+from deep_deter.data_extraction.ee_scheduler import EERequestScheduler
+from deep_deter.data_extraction.raw_catalog import RawCatalog
+from deep_deter.data_extraction.save_to_disk import SaveToDisk
+from deep_deter.data_extraction.utils import get_pixel_degrees
+from fake_ee import FakeEE, FakeImage
+from fake_export import RESOLUTION, FakeExport
+
+
+def _square(x: float, y: float, size: float = 0.01):
+    return shapely_geometry.box(x, y, x + size, y + size)
+
+
+@pytest.fixture
+def save_to_disk(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('data/raw')
+
+    deter_gdf = geopandas.GeoDataFrame({
+        'FID': ['deter_1', 'deter_2', 'deter_3', 'deter_4'],
+        'VIEW_DATE': ['2023-06-15'] * 4,
+        'geometry': [
+            _square(-60.00, -10.00),
+            _square(-59.98, -10.00),  # Overlaps deter_1
+            shapely_geometry.MultiPolygon([_square(-59.99, -10.01), _square(-59.97, -9.99)]),  # Overlaps too
+            _square(-50.00, -5.00),  # Far away
+        ],
+    }, crs='EPSG:4326')
+    images = [
+        {'system:index': 'a', 'date': '2023-06-10', 'bounds': (-61, -11, -49, -4), 'CLOUDY_PIXEL_PERCENTAGE': 0},
+    ]
+
+    export = FakeExport()
+    monkeypatch.setattr(SaveToDisk, '_export_multiband', staticmethod(export))
+    monkeypatch.setattr('deep_deter.data_extraction.ee_scheduler._scheduler',
+                        EERequestScheduler(requests_per_second=1000))
+    save_to_disk = SaveToDisk(deter_gdf, raw_catalog=RawCatalog('data/raw'), ee_client=FakeEE(images))
+    return save_to_disk, export
+
+
+def test_main_exports_clusters_once_and_skips_multipolygons(save_to_disk):
+    save_to_disk, export = save_to_disk
+
+    save_to_disk.main(n_iterations=4)
+
+    # One shared export for deter_1 + deter_2, one for deter_4, both sent as one request per band
+    assert len(set(export.regions)) == 2
+    assert len(export.regions) == 8
+    assert sorted(save_to_disk.raw_catalog.get_complete_ids()) == ['deter_1', 'deter_2', 'deter_4']
+    assert 'cluster_bounds' in save_to_disk.raw_catalog.get_params('deter_1')
+
+
+def test_clusters_are_served_from_composite_cache(save_to_disk):
+    save_to_disk, export = save_to_disk
+    save_to_disk.composite_cache.fetch_missing = True
+    save_to_disk.composite_cache.enabled = True
+
+    save_to_disk.main(n_iterations=4)
+    n_exports = len(export.regions)
+    assert 'composite_tile_degrees' in save_to_disk.raw_catalog.get_params('deter_1')
+
+    # Everything is cached now, downloading the same alerts again needs no export
+    save_to_disk.main(n_iterations=4)
+    assert len(export.regions) == n_exports
+
+
+def test_oversized_cluster_export_is_split_and_reassembled(save_to_disk, tmp_path, monkeypatch):
+    save_to_disk, _ = save_to_disk
+    # Exports on the real pixel grid, the tiles are cut on it
+    export = FakeExport(resolution=get_pixel_degrees(10))
+    monkeypatch.setattr(SaveToDisk, '_export_multiband', staticmethod(export))
+    image = FakeImage(['a']).select(['B2', 'B3', 'B4', 'B8'])
+    bounds = (-60.0, -10.0, -59.65, -9.65)  # 0.35 degrees, a single band is over the download limit
+
+    save_to_disk._export_bands(image, tmp_path/'cluster.tif', bounds, 'export_cluster')
+
+    # 2 x 2 tiles, each exported as 2 requests of 2 bands
+    assert len(export.regions) == 8
+    assert len(set(export.regions)) == 4
+    with rasterio.open(tmp_path/'cluster.tif') as src:
+        assert [src.read(i).mean() for i in range(1, 5)] == [2, 3, 4, 8]
+        assert src.bounds.left == pytest.approx(bounds[0], abs=RESOLUTION)
+        assert src.bounds.top == pytest.approx(bounds[3], abs=RESOLUTION)
+
+
+def test_alert_export_over_the_limit_is_split_by_band(save_to_disk, tmp_path):
+    save_to_disk, export = save_to_disk
+    image = FakeImage(['a']).select(['B2', 'B3', 'B4', 'B8'])
+    bounds = (-60.14, -10.14, -59.86, -9.86)  # +/- 0.14 degrees, fits one band at a time
+
+    save_to_disk._export_bands(image, tmp_path/'alert.tif', bounds)
+
+    assert export.regions == [bounds] * 4
+    with rasterio.open(tmp_path/'alert.tif') as src:
+        assert [src.read(i).mean() for i in range(1, 5)] == [2, 3, 4, 8]
@@ -0,0 +1,65 @@
+# Std.Lib.
+import os
+
+# Data Science
+import numpy as np
+import pytest
+import rasterio
+from torch.utils.data import DataLoader
+
+# Custom functions
+from dataset import DeterDataset
+from shards import ShardedDeterDataset, write_shards
+
+N_SAMPLES = 10
+
+
+def _make_dataset(tmp_path) -> tuple:
+    image_dir, mask_dir = tmp_path/'features', tmp_path/'labels'
+    os.makedirs(image_dir)
+    os.makedirs(mask_dir)
+    rng = np.random.default_rng(0)
+    images = []
+    for i in range(N_SAMPLES):
+        height, width = 8 + i, 12 - i // 2
+        images.append(f'deter_{i}_bands.tif')
+        with rasterio.open(image_dir/images[-1], 'w', driver='GTiff', height=height, width=width,
+                           count=4, dtype='float32') as dst:
+            dst.write(rng.random((4, height, width), dtype='float32'))
+        # The mask holds the index of the sample, so it can be told apart after shuffling
+        with rasterio.open(mask_dir/f'deter_{i}.tif', 'w', driver='GTiff', height=height, width=width,
+                           count=1, dtype='uint8') as dst:
+            dst.write(np.full((1, height, width), i, dtype='uint8'))
+    return str(image_dir), str(mask_dir), images
+
+
+def test_shards_round_trip_the_geotiff_samples(tmp_path):
+    image_dir, mask_dir, images = _make_dataset(tmp_path)
+    # Small shards, so the samples are spread over several files
+    write_shards(image_dir, mask_dir, images, str(tmp_path/'shards'), 'train', max_shard_bytes=4000)
+
+    sharded = ShardedDeterDataset(str(tmp_path/'shards'), 'train', shuffle=False)
+    reference = DeterDataset(image_dir, mask_dir, ids=[image[:-len('_bands.tif')] for image in images])
+
+    assert len(sharded.shards) > 1
+    assert len(sharded) == N_SAMPLES
+    samples = list(sharded)
+    assert len(samples) == N_SAMPLES
+    for index, (image, mask) in enumerate(samples):
+        expected_image, expected_mask = reference[index]
+        assert image.dtype == expected_image.dtype and mask.dtype == expected_mask.dtype
+        assert np.array_equal(image, expected_image)
+        assert np.array_equal(mask, expected_mask)
+
+
+@pytest.mark.parametrize('seed', [None, 3])
+def test_workers_split_the_shards_without_overlap(tmp_path, seed):
+    image_dir, mask_dir, images = _make_dataset(tmp_path)
+    write_shards(image_dir, mask_dir, images, str(tmp_path/'shards'), 'train', max_shard_bytes=1)
+
+    sharded = ShardedDeterDataset(str(tmp_path/'shards'), 'train', shuffle_buffer=3, seed=seed)
+    loader = DataLoader(sharded, batch_size=None, num_workers=3)
+
+    for _ in range(2):
+        seen = sorted(int(mask[0, 0]) for _, mask in loader)
+        assert seen == list(range(N_SAMPLES))
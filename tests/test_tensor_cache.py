@@ -0,0 +1,63 @@
+# Std.Lib.
+import os
+
+# Data Science
+import numpy as np
+import rasterio
+
+# Custom functions
+from dataset import DeterDataset
+from tensor_cache import get_cache_paths
+
+
+def _write_tif(path, array: np.ndarray) -> None:
+    array = array if array.ndim == 3 else array[None]
+    with rasterio.open(path, 'w', driver='GTiff', height=array.shape[1], width=array.shape[2],
+                       count=array.shape[0], dtype=array.dtype) as dst:
+        dst.write(array)
+
+
+def _make_dataset(tmp_path) -> tuple:
+    image_dir, mask_dir = tmp_path/'features', tmp_path/'labels'
+    os.makedirs(image_dir)
+    os.makedirs(mask_dir)
+    rng = np.random.default_rng(0)
+    for file_id, (height, width) in [('deter_1', (12, 20)), ('deter_2', (17, 9))]:
+        _write_tif(image_dir/f'{file_id}_bands.tif', rng.random((4, height, width), dtype='float32'))
+        _write_tif(mask_dir/f'{file_id}.tif', rng.integers(0, 2, (height, width), dtype='uint8'))
+    return str(image_dir), str(mask_dir)
+
+
+def test_cached_samples_match_the_geotiffs(tmp_path):
+    image_dir, mask_dir = _make_dataset(tmp_path)
+
+    reference = DeterDataset(image_dir, mask_dir, ids=['deter_1', 'deter_2'])
+    cached = DeterDataset(image_dir, mask_dir, ids=['deter_1', 'deter_2'], cache_dir=str(tmp_path/'cache'))
+
+    for index in range(len(reference)):
+        image, mask = reference[index]
+        cached_image, cached_mask = cached[index]
+        assert isinstance(cached_image, np.memmap)
+        assert cached_image.dtype == image.dtype and cached_image.shape == image.shape
+        assert cached_mask.dtype == mask.dtype and cached_mask.shape == mask.shape
+        assert np.array_equal(cached_image, image)
+        assert np.array_equal(cached_mask, mask)
+
+
+def test_cache_is_rebuilt_when_a_geotiff_changes(tmp_path, capsys):
+    image_dir, mask_dir = _make_dataset(tmp_path)
+    cache_dir = str(tmp_path/'cache')
+    DeterDataset(image_dir, mask_dir, ids=['deter_1', 'deter_2'], cache_dir=cache_dir)
+    assert '2 samples converted' in capsys.readouterr().out
+
+    # Relabelled after the cache was built
+    new_mask = np.ones((12, 20), dtype='uint8')
+    _write_tif(os.path.join(mask_dir, 'deter_1.tif'), new_mask)
+    mask_cache = get_cache_paths(cache_dir, 'deter_1_bands.tif')[1]
+    later = os.path.getmtime(mask_cache) + 10
+    os.utime(os.path.join(mask_dir, 'deter_1.tif'), (later, later))
+
+    cached = DeterDataset(image_dir, mask_dir, ids=['deter_1', 'deter_2'], cache_dir=cache_dir)
+
+    assert '1 samples converted, 1 already cached' in capsys.readouterr().out
+    assert np.array_equal(cached[0][1], new_mask)
@@ -0,0 +1,29 @@
+# Data Science
+import pytest
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+# Custom functions
+import train
+from model import UNET
+
+
+@pytest.mark.parametrize('precision', ['fp32', 'bf16', 'fp16'])
+def test_train_fn_runs_one_step_for_every_precision(precision):
+    if precision == 'fp16' and train.DEVICE != 'cuda':
+        pytest.skip('fp16 autocast is CUDA only')
+
+    torch.manual_seed(0)
+    model = UNET(in_channels=4, out_channels=1, features=[4, 8]).to(train.DEVICE)
+    optimizer = optim.Adam(model.parameters(), lr=1e-3)
+    scaler = train.get_grad_scaler(precision)
+    assert scaler.is_enabled() == (precision == 'fp16')
+
+    data = torch.rand(2, 4, 32, 32)
+    targets = (torch.rand(2, 32, 32) > 0.5).long()
+    weights_before = [p.detach().clone() for p in model.parameters()]
+
+    train.train_fn([(data, targets)], model, optimizer, nn.BCEWithLogitsLoss(), scaler, precision=precision)
+
+    assert any(not torch.equal(before, after) for before, after in zip(weights_before, model.parameters()))
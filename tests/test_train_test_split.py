@@ -0,0 +1,71 @@
+# Std.Lib.
+import json
+import os
+
+# Data Science
+import numpy as np
+import rasterio
+
+# Custom functions
+from deep_deter.data_extraction.train_test_split import build_split_manifest, hash_file_id
+
+
+def _write_sample(base_dir, file_id: str, positive_fraction: float) -> None:
+    label = np.zeros((10, 10), dtype='uint8')
+    label.flat[:round(positive_fraction * label.size)] = 1
+    with rasterio.open(os.path.join(base_dir, 'processed', 'labels', f'{file_id}.tif'), 'w',
+                       driver='GTiff', height=10, width=10, count=1, dtype='uint8') as dst:
+        dst.write(label, 1)
+    open(os.path.join(base_dir, 'processed', 'masked_feature_bands', f'{file_id}_bands.tif'), 'w').close()
+
+
+def _make_dataset(base_dir, n_empty: int, n_positive: int) -> list:
+    os.makedirs(os.path.join(base_dir, 'processed', 'labels'))
+    os.makedirs(os.path.join(base_dir, 'processed', 'masked_feature_bands'))
+    positive_ids = []
+    for i in range(n_empty):
+        _write_sample(base_dir, f'{i}_empty', 0.0)
+    for i in range(n_positive):
+        positive_ids.append(f'{i}_positive')
+        _write_sample(base_dir, positive_ids[-1], 0.9)
+    return positive_ids
+
+
+def test_stratified_split_splits_a_skewed_bin_in_proportion(tmp_path):
+    positive_ids = _make_dataset(tmp_path, n_empty=200, n_positive=10)
+
+    splits = build_split_manifest(str(tmp_path), 80, stratify=True)
+
+    assert sum(splits[file_id] == 'train' for file_id in positive_ids) == 8
+    with open(tmp_path/'model_inputs'/'split_manifest.json') as f:
+        strata = json.load(f)['strata']
+    assert strata[0] == {'max_positive_fraction': 0.0, 'train': 160, 'test': 40}
+    assert strata[-1] == {'max_positive_fraction': 1.0, 'train': 8, 'test': 2}
+
+
+def test_stratified_split_keeps_the_hash_order_inside_a_bin(tmp_path):
+    positive_ids = _make_dataset(tmp_path, n_empty=0, n_positive=10)
+
+    splits = build_split_manifest(str(tmp_path), 80, stratify=True)
+
+    ranked = sorted(positive_ids, key=lambda file_id: (hash_file_id(file_id), file_id))
+    assert [splits[file_id] for file_id in ranked] == ['train'] * 8 + ['test'] * 2
+
+
+def test_unstratified_split_uses_the_hash_threshold(tmp_path):
+    _make_dataset(tmp_path, n_empty=50, n_positive=0)
+
+    splits = build_split_manifest(str(tmp_path), 80)
+
+    assert all((split == 'train') == (hash_file_id(file_id) < 80) for file_id, split in splits.items())
+
+
+def test_ids_missing_a_label_or_features_are_left_out(tmp_path):
+    _make_dataset(tmp_path, n_empty=5, n_positive=0)
+    # Features were written but the label stage failed, and the other way around
+    open(tmp_path/'processed'/'masked_feature_bands'/'no_label_bands.tif', 'w').close()
+    os.remove(tmp_path/'processed'/'masked_feature_bands'/'0_empty_bands.tif')
+
+    splits = build_split_manifest(str(tmp_path), 80)
+
+    assert sorted(splits) == ['1_empty', '2_empty', '3_empty', '4_empty']